@@ -1,6 +1,15 @@
-from fastapi import APIRouter
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Response
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
-from app.db.manager import manager, ActiveDB
+from app.db.manager import DATABASE_COOKIE, manager, ActiveDB
+from app.db.schema_registry import schema_registry
+from app.cache.sql_cache import sql_cache
+from app.cache.result_cache import result_cache
+from app.llm.router import router as model_router
+from app.llm.schema_linker import schema_linker
+from app.security.rbac import policy_engine
+from app.tools.query_planner import query_planner
 
 router = APIRouter()
 
@@ -15,12 +24,66 @@ class SwitchDBBody(BaseModel):
 
 
 @router.post("/switch_db")
-async def switch_db(body: SwitchDBBody) -> dict:
-	active = manager.switch(body.target)
-	return {"active_db": active}
+async def switch_db(body: SwitchDBBody, response: Response) -> dict:
+	"""把目标数据库记在会话 cookie 中，只影响本会话之后的请求，不改变其他用户的数据库"""
+	response.set_cookie(DATABASE_COOKIE, body.target, httponly=True, samesite="lax")
+	return {"active_db": body.target}
 
 
 @router.get("/test_db_connections")
 async def test_db_connections() -> dict:
 	"""测试所有数据库连接"""
+	if manager.async_enabled:
+		return await manager.atest_connections()
 	return manager.test_connections()
+
+
+@router.get("/db/pool")
+async def db_pool_status() -> dict:
+	"""查看数据库连接池占用情况"""
+	return manager.pool_status()
+
+
+@router.get("/schema")
+async def schema_status() -> dict:
+	"""查看各数据库表结构的版本、来源（live/static）与行数估计"""
+	return schema_registry.stats()
+
+
+@router.post("/schema/refresh")
+async def refresh_schema(database: Optional[ActiveDB] = None) -> dict:
+	"""立即重新反射表结构，返回各数据库的版本"""
+	return await run_in_threadpool(schema_registry.refresh, database)
+
+
+@router.get("/cache/stats")
+async def cache_stats() -> dict:
+	"""查看缓存命中统计"""
+	return {"sql": sql_cache.stats(), "result": result_cache.stats(), "rbac": policy_engine.stats(), "schema": schema_linker.stats(), "plan": query_planner.stats()}
+
+
+@router.post("/cache/sql/flush")
+async def flush_sql_cache() -> dict:
+	"""清空 NL→SQL 生成缓存"""
+	return {"flushed": sql_cache.clear()}
+
+
+@router.post("/cache/result/flush")
+async def flush_result_cache() -> dict:
+	"""清空查询结果缓存"""
+	return {"flushed": result_cache.clear()}
+
+
+@router.get("/router/keywords")
+async def router_keywords() -> dict:
+	"""查看路由关键词集合与自动机规模"""
+	return model_router.keyword_stats()
+
+
+@router.post("/router/reload")
+async def reload_router_keywords() -> dict:
+	"""从 ROUTER_KEYWORDS_FILE 重新加载路由关键词"""
+	try:
+		return model_router.reload_keywords()
+	except Exception as e:
+		raise HTTPException(status_code=400, detail=f"关键词加载失败: {e}")
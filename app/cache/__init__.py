@@ -0,0 +1 @@
+# Cache package for in-process LRU/TTL caches
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+	"""线程安全的 LRU + TTL 缓存，可选按条目权重（如字节数）限制总容量"""
+
+	def __init__(
+		self,
+		max_entries: int = 1024,
+		ttl: float = 3600.0,
+		max_weight: Optional[int] = None,
+		on_remove: Optional[Callable[[Hashable], None]] = None
+	):
+		self.max_entries = max(1, max_entries)
+		self.ttl = ttl
+		self.max_weight = max_weight
+		self._on_remove = on_remove
+		self._data: "OrderedDict[Hashable, Tuple[float, Any, int]]" = OrderedDict()
+		self._weight = 0
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+
+	def _remove(self, key: Hashable) -> Optional[Tuple[float, Any, int]]:
+		item = self._data.pop(key, None)
+		if item is not None:
+			self._weight -= item[2]
+			if self._on_remove is not None:
+				self._on_remove(key)
+		return item
+
+	def get(self, key: Hashable, record_stats: bool = True) -> Optional[Any]:
+		"""读取缓存；过期或不存在时返回 None"""
+		with self._lock:
+			item = self._data.get(key)
+			if item is not None and item[0] < time.monotonic():
+				self._remove(key)
+				self.expirations += 1
+				item = None
+			if item is None:
+				if record_stats:
+					self.misses += 1
+				return None
+			self._data.move_to_end(key)
+			if record_stats:
+				self.hits += 1
+			return item[1]
+
+	def record(self, hit: bool) -> None:
+		"""由调用方记录一次命中/未命中（一次逻辑查找对应多个键时使用）"""
+		with self._lock:
+			if hit:
+				self.hits += 1
+			else:
+				self.misses += 1
+
+	def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, weight: int = 1) -> bool:
+		"""写入缓存，超出容量时淘汰最久未使用的条目；单条超过权重上限时不缓存"""
+		if self.max_weight is not None and weight > self.max_weight:
+			return False
+		expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+		with self._lock:
+			self._remove(key)
+			self._data[key] = (expires_at, value, weight)
+			self._weight += weight
+			while len(self._data) > self.max_entries or (
+				self.max_weight is not None and self._weight > self.max_weight
+			):
+				oldest = next(iter(self._data))
+				self._remove(oldest)
+				self.evictions += 1
+		return True
+
+	def __contains__(self, key: Hashable) -> bool:
+		"""键是否仍在缓存中（不检查过期、不计统计）；不加锁，可在 on_remove 回调使用的锁内调用而不形成锁顺序反转"""
+		return key in self._data
+
+	def pop(self, key: Hashable) -> Optional[Any]:
+		with self._lock:
+			item = self._remove(key)
+			return item[1] if item else None
+
+	def clear(self) -> int:
+		"""清空缓存，返回清除的条目数"""
+		with self._lock:
+			count = len(self._data)
+			for key in list(self._data):
+				self._remove(key)
+			return count
+
+	def stats(self) -> Dict[str, Any]:
+		"""获取缓存统计"""
+		with self._lock:
+			total = self.hits + self.misses
+			stats = {
+				"entries": len(self._data),
+				"max_entries": self.max_entries,
+				"ttl": self.ttl,
+				"hits": self.hits,
+				"misses": self.misses,
+				"hit_rate": round(self.hits / total, 4) if total else 0.0,
+				"evictions": self.evictions,
+				"expirations": self.expirations
+			}
+			if self.max_weight is not None:
+				stats["weight"] = self._weight
+				stats["max_weight"] = self.max_weight
+			return stats
@@ -0,0 +1,152 @@
+import re
+import sys
+import threading
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Set, Tuple
+
+from app.cache.lru import TTLCache
+from app.config import settings
+from app.db.bounded import is_query_sql
+
+
+TABLE_REF = re.compile(r"\b(?:from|join|update|into|table)\s+[`\"]?([a-zA-Z_][\w]*)", re.IGNORECASE)
+
+# (列名, 行, 是否截断)
+CachedResult = Tuple[Tuple[str, ...], Tuple[Tuple[Any, ...], ...], bool]
+
+
+def normalize_sql(sql: str) -> str:
+	"""归一化 SQL：折叠引号外的空白、去掉结尾分号，引号内的字面量保持不变"""
+	out: List[str] = []
+	quote: Optional[str] = None
+	pending_space = False
+	for ch in sql.strip().rstrip(";").strip():
+		if quote:
+			out.append(ch)
+			if ch == quote:
+				quote = None
+			continue
+		if ch.isspace():
+			pending_space = True
+			continue
+		if pending_space and out:
+			out.append(" ")
+		pending_space = False
+		if ch in ("'", '"', "`"):
+			quote = ch
+		out.append(ch)
+	return "".join(out)
+
+
+def is_write_sql(sql: str) -> bool:
+	"""不是单条只读 SELECT 的语句都按写操作处理（含 WITH ... DELETE、多条语句与无法确定词法的 SQL）：不缓存，执行后按表失效"""
+	return not is_query_sql(sql)
+
+
+def referenced_tables(sql: str) -> Set[str]:
+	return {m.lower() for m in TABLE_REF.findall(sql)}
+
+
+def estimate_size(columns: Sequence[str], rows: Sequence[Sequence[Any]]) -> int:
+	"""粗略估算结果集占用的字节数"""
+	size = sys.getsizeof(rows) + sum(sys.getsizeof(c) for c in columns)
+	for row in rows:
+		size += sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+	return size
+
+
+class QueryResultCache:
+	"""查询结果缓存：按 (数据库, 归一化 SQL) 缓存，按表设置 TTL，应用内写操作时按表失效"""
+
+	def __init__(self, max_entries: int, max_bytes: int, default_ttl: float, table_ttls: Dict[str, float]):
+		self.default_ttl = default_ttl
+		self.table_ttls = {k.lower(): v for k, v in table_ttls.items()}
+		self._cache = TTLCache(
+			max_entries=max_entries,
+			ttl=default_ttl,
+			max_weight=max_bytes,
+			on_remove=self._unindex
+		)
+		# (数据库, 表名) -> 引用该表的缓存键
+		self._table_index: Dict[Tuple[str, str], Set[Hashable]] = {}
+		self._key_tables: Dict[Hashable, Set[Tuple[str, str]]] = {}
+		self._index_lock = threading.Lock()
+		self.invalidations = 0
+
+	def _unindex(self, key: Hashable) -> None:
+		with self._index_lock:
+			for table_key in self._key_tables.pop(key, ()):
+				keys = self._table_index.get(table_key)
+				if keys is not None:
+					keys.discard(key)
+					if not keys:
+						del self._table_index[table_key]
+
+	def ttl_for(self, tables: Set[str]) -> float:
+		"""多表查询取各表 TTL 的最小值"""
+		if not tables:
+			return self.default_ttl
+		return min(self.table_ttls.get(t, self.default_ttl) for t in tables)
+
+	def get(self, database: str, sql: str) -> Optional[CachedResult]:
+		if is_write_sql(sql):
+			return None
+		return self._cache.get((database, normalize_sql(sql)))
+
+	def store(
+		self,
+		database: str,
+		sql: str,
+		columns: Sequence[str],
+		rows: Sequence[Sequence[Any]],
+		truncated: bool = False
+	) -> None:
+		if is_write_sql(sql):
+			return
+		tables = referenced_tables(sql)
+		ttl = self.ttl_for(tables)
+		if ttl <= 0:
+			return
+		key = (database, normalize_sql(sql))
+		value: CachedResult = (tuple(columns), tuple(tuple(row) for row in rows), truncated)
+		if self._cache.set(key, value, ttl=ttl, weight=estimate_size(value[0], value[1])):
+			with self._index_lock:
+				# set 返回后该键可能已被并发写入淘汰，且 on_remove 已先于这里执行：此时不再建立索引
+				if key not in self._cache:
+					return
+				table_keys = {(database, t) for t in tables}
+				self._key_tables[key] = table_keys
+				for table_key in table_keys:
+					self._table_index.setdefault(table_key, set()).add(key)
+
+	def invalidate_tables(self, database: str, tables: Set[str]) -> int:
+		"""使引用指定表的缓存失效，返回失效的条目数"""
+		with self._index_lock:
+			keys: Set[Hashable] = set()
+			for table in tables:
+				keys |= self._table_index.get((database, table.lower()), set())
+		for key in keys:
+			self._cache.pop(key)
+		self.invalidations += len(keys)
+		return len(keys)
+
+	def on_write(self, database: str, sql: str) -> int:
+		"""应用执行写操作后调用，按写入的表失效缓存"""
+		return self.invalidate_tables(database, referenced_tables(sql))
+
+	def clear(self) -> int:
+		return self._cache.clear()
+
+	def stats(self) -> Dict[str, Any]:
+		stats = self._cache.stats()
+		stats["invalidations"] = self.invalidations
+		stats["table_ttls"] = self.table_ttls
+		return stats
+
+
+# 全局实例
+result_cache = QueryResultCache(
+	max_entries=settings.result_cache_max_entries,
+	max_bytes=settings.result_cache_max_bytes,
+	default_ttl=settings.result_cache_ttl,
+	table_ttls=settings.result_cache_table_ttls
+)
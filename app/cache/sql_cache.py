@@ -0,0 +1,55 @@
+import hashlib
+import re
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from app.cache.lru import TTLCache
+from app.config import settings
+
+
+def normalize_question(question: str) -> str:
+	"""归一化问题文本：去除首尾空白与句末标点、折叠空白、英文转小写"""
+	q = re.sub(r"\s+", " ", question.strip().lower())
+	return q.rstrip("?？。.!！ ")
+
+
+def schema_hash(table_schema: str) -> str:
+	"""表结构提示词的内容哈希，表结构变化时缓存自动失效"""
+	return hashlib.sha256(table_schema.encode("utf-8")).hexdigest()[:16]
+
+
+class SQLGenerationCache:
+	"""NL→SQL 生成缓存：按 (问题, 数据库, 表结构版本, 模型) 精确匹配"""
+
+	def __init__(self, max_entries: int, ttl: float):
+		self._cache = TTLCache(max_entries=max_entries, ttl=ttl)
+
+	@staticmethod
+	def _key(question: str, database: str, schema_version: str, model: str) -> Tuple[str, str, str, str]:
+		return (normalize_question(question), database, schema_version, model)
+
+	def lookup(self, question: str, database: str, schema_version: str, models: Iterable[str]) -> Optional[Tuple[str, str]]:
+		"""按模型优先级查找缓存，命中时返回 (sql, model)"""
+		for model in models:
+			sql = self._cache.get(self._key(question, database, schema_version, model), record_stats=False)
+			if sql is not None:
+				self._cache.record(hit=True)
+				return sql, model
+		self._cache.record(hit=False)
+		return None
+
+	def store(self, question: str, database: str, schema_version: str, model: str, sql: str) -> None:
+		if sql:
+			self._cache.set(self._key(question, database, schema_version, model), sql)
+
+	def clear(self) -> int:
+		return self._cache.clear()
+
+	def stats(self) -> Dict[str, Any]:
+		return self._cache.stats()
+
+
+# 全局实例
+sql_cache = SQLGenerationCache(
+	max_entries=settings.sql_cache_max_entries,
+	ttl=settings.sql_cache_ttl
+)
@@ -0,0 +1,109 @@
+import re
+from typing import Any, List, NamedTuple, Optional, Sequence, Tuple
+
+from app.security.sql_parser import tokenize
+
+
+# 末尾的加锁子句：LIMIT 需要放在它之前
+LOCKING_CLAUSE = re.compile(
+	r"\bfor\s+(update|share)\b(\s+of\s+[\w\s,.`\"]+?)?(\s+(nowait|skip\s+locked))?\s*$|\block\s+in\s+share\s+mode\s*$",
+	re.IGNORECASE
+)
+LOCKING_KEYWORDS = re.compile(r"\bfor\s+(update|share)\b|\block\s+in\s+share\s+mode\b", re.IGNORECASE)
+# 已有行数限制的写法：LIMIT n / FETCH FIRST|NEXT / TOP n
+ROW_LIMIT = re.compile(r"\blimit\s+\d+|\bfetch\s+(first|next)\b|\btop\s*\(?\s*\d+", re.IGNORECASE)
+# 字符串字面量与注释，检测 LIMIT 前去掉，避免误判
+LITERALS_AND_COMMENTS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+
+class FetchResult(NamedTuple):
+	"""查询结果：列名、行（不超过行数上限）、是否截断、是否命中结果缓存"""
+	columns: List[str]
+	rows: List[Any]
+	truncated: bool = False
+	cache_hit: bool = False
+
+
+def _statement_verb(tokens: List[str]) -> str:
+	"""语句的动词：跳过开头的括号与 WITH [RECURSIVE] 定义列表（名字 [(列...)] AS [[NOT] MATERIALIZED] (...)）"""
+	i = 0
+	while i < len(tokens) and tokens[i] == "(":
+		i += 1
+	if i < len(tokens) and tokens[i] == "with":
+		i += 1
+		if i < len(tokens) and tokens[i] == "recursive":
+			i += 1
+		while i < len(tokens):
+			# 跳到 AS 之后的第一个括号，再跳过与之配对的括号
+			while i < len(tokens) and tokens[i] != "as":
+				i += 1
+			while i < len(tokens) and tokens[i] != "(":
+				i += 1
+			depth = 0
+			while i < len(tokens):
+				depth += {"(": 1, ")": -1}.get(tokens[i], 0)
+				i += 1
+				if depth == 0:
+					break
+			if i < len(tokens) and tokens[i] == ",":
+				i += 1
+				continue
+			break
+		while i < len(tokens) and tokens[i] == "(":
+			i += 1
+	return tokens[i] if i < len(tokens) else ""
+
+
+def is_query_sql(sql: str, dialect: Optional[str] = None) -> bool:
+	"""只读查询：单条语句，动词（WITH 定义之后）为 SELECT；方言未知或依赖服务器设置时每种词法解释都须满足，有歧义时视为否"""
+	variants = tokenize(sql, dialect)
+	if variants is None:
+		return False
+	for tokens in variants:
+		while tokens and tokens[-1] == ";":
+			tokens.pop()
+		if ";" in tokens or _statement_verb(tokens) != "select":
+			return False
+	return True
+
+
+def apply_row_cap(sql: str, max_rows: int) -> Tuple[str, bool]:
+	"""没有行数限制的查询追加 LIMIT max_rows + 1（多取一行用于判断是否截断），返回 (SQL, 是否注入)"""
+	if max_rows <= 0 or not is_query_sql(sql) or ROW_LIMIT.search(LITERALS_AND_COMMENTS.sub(" ", sql)):
+		return sql, False
+	body = sql.strip().rstrip(";").rstrip()
+	if LOCKING_KEYWORDS.search(LITERALS_AND_COMMENTS.sub(" ", body)):
+		locking = LOCKING_CLAUSE.search(body)
+		if locking is None:
+			# 加锁子句不在末尾（如后面还有注释）时不注入，仍由按批读取限制行数
+			return sql, False
+		return f"{body[:locking.start()].rstrip()}\nLIMIT {max_rows + 1}\n{locking.group().strip()}", True
+	# 换行追加，避免被末尾的 -- 注释吞掉
+	return f"{body}\nLIMIT {max_rows + 1}", True
+
+
+def _cap(rows: List[Any], batch: Sequence[Any], max_rows: int) -> bool:
+	rows.extend(batch)
+	return 0 < max_rows < len(rows)
+
+
+def fetch_rows(result: Any, max_rows: int, batch_size: int) -> Tuple[List[Any], bool]:
+	"""按批 fetchmany 读取，最多保留 max_rows 行（0 表示不限制），返回 (行, 是否截断)"""
+	rows: List[Any] = []
+	while True:
+		batch = result.fetchmany(batch_size)
+		if not batch:
+			return rows, False
+		if _cap(rows, batch, max_rows):
+			return rows[:max_rows], True
+
+
+async def afetch_rows(result: Any, max_rows: int, batch_size: int) -> Tuple[List[Any], bool]:
+	"""fetch_rows 的异步版本，用于 AsyncSession.stream 返回的服务端游标"""
+	rows: List[Any] = []
+	while True:
+		batch = await result.fetchmany(batch_size)
+		if not batch:
+			return rows, False
+		if _cap(rows, batch, max_rows):
+			return rows[:max_rows], True
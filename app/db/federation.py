@@ -0,0 +1,612 @@
+import datetime
+import decimal
+import heapq
+import os
+import pickle
+import queue
+import tempfile
+import threading
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+
+from app.db.bounded import FetchResult, apply_row_cap, is_query_sql
+from app.db.manager import manager
+from app.security.rbac import check_sql_permission
+
+
+FILTER_OPS = ("=", "!=", ">", ">=", "<", "<=", "in", "not in", "contains", "is null", "is not null")
+ORDERED_OPS = (">", ">=", "<", "<=")
+AGGREGATE_FUNCS = ("count", "count_distinct", "sum", "avg", "min", "max")
+JOIN_TYPES = ("inner", "left")
+
+
+class FederationCancelled(RuntimeError):
+	pass
+
+
+class RowStream(NamedTuple):
+	"""算子之间传递的行流：列名（来源别名.列名）与按需产生的行元组"""
+	columns: List[str]
+	rows: Iterator[tuple]
+
+
+class SourceSpec(NamedTuple):
+	alias: str
+	database: str
+	sql: str
+
+
+class JoinSpec(NamedTuple):
+	right: str
+	on: List[Tuple[str, str]]
+	how: str = "inner"
+
+
+class FederatedPlan(NamedTuple):
+	"""联邦执行计划：各库的源查询，按顺序哈希连接（right 为构建侧，应为较小的一侧），再过滤、分组聚合、排序与截取"""
+	sources: List[SourceSpec]
+	joins: List[JoinSpec]
+	where: List[Tuple[str, str, Any]]
+	group_by: List[str]
+	aggregates: List[Tuple[str, str, str]]
+	select: List[str]
+	order_by: List[Tuple[str, str]]
+	limit: Optional[int]
+
+
+class FederatedResult(NamedTuple):
+	"""最终结果、各源读取的行数、溢写行数；truncated_sources 为超过读取上限被截断的源，此时结果（含聚合值）不完整"""
+	result: FetchResult
+	scanned: Dict[str, int]
+	spilled_rows: int
+	truncated_sources: List[str]
+
+
+def _as_list(value: Any, name: str) -> list:
+	if value is None:
+		return []
+	if not isinstance(value, list):
+		raise ValueError(f"执行计划字段 {name} 应为数组")
+	return value
+
+
+def parse_plan(data: Dict[str, Any]) -> FederatedPlan:
+	"""校验并解析 JSON 形式的执行计划，格式错误时抛出 ValueError"""
+	if not isinstance(data, dict):
+		raise ValueError("执行计划应为 JSON 对象")
+	sources = []
+	for item in _as_list(data.get("sources"), "sources"):
+		source = SourceSpec(str(item["alias"]), str(item["database"]), str(item["sql"]).strip().rstrip(";"))
+		if source.database not in ("hospital", "warehouse"):
+			raise ValueError(f"未知数据库: {source.database}")
+		if not is_query_sql(source.sql):
+			raise ValueError(f"源查询只能是 SELECT: {source.sql[:80]}")
+		sources.append(source)
+	if not sources:
+		raise ValueError("执行计划没有源查询")
+	aliases = [source.alias for source in sources]
+	if len(set(aliases)) != len(aliases):
+		raise ValueError("源查询别名重复")
+
+	joins = []
+	for item in _as_list(data.get("joins"), "joins"):
+		join = JoinSpec(str(item["right"]), [(str(l), str(r)) for l, r in item["on"]], str(item.get("how", "inner")).lower())
+		if join.right not in aliases or join.right == aliases[0]:
+			raise ValueError(f"连接的源不存在或为首个源: {join.right}")
+		if join.how not in JOIN_TYPES or not join.on:
+			raise ValueError(f"不支持的连接: {join.how}")
+		joins.append(join)
+	if len(joins) != len(sources) - 1 or len({join.right for join in joins}) != len(joins):
+		raise ValueError("除首个源外，每个源都需要且只能连接一次")
+
+	where = []
+	for item in _as_list(data.get("where"), "where"):
+		column, op = str(item[0]), str(item[1]).lower()
+		if op not in FILTER_OPS:
+			raise ValueError(f"不支持的过滤条件: {op}")
+		value = item[2] if len(item) > 2 else None
+		if op in ("in", "not in"):
+			if not isinstance(value, list) or any(isinstance(v, (list, dict)) for v in value):
+				raise ValueError(f"过滤条件 {op} 的值应为标量数组: {value!r}")
+		elif op in ORDERED_OPS and (value is None or isinstance(value, (list, dict))):
+			raise ValueError(f"过滤条件 {op} 的值应为标量: {value!r}")
+		where.append((column, op, value))
+
+	aggregates = []
+	for item in _as_list(data.get("aggregates"), "aggregates"):
+		func = str(item[0]).lower()
+		if func not in AGGREGATE_FUNCS:
+			raise ValueError(f"不支持的聚合函数: {func}")
+		column = str(item[1]) if len(item) > 1 else "*"
+		aggregates.append((func, column, str(item[2]) if len(item) > 2 else f"{func}_{column}".replace("*", "all")))
+
+	order_by = []
+	for item in _as_list(data.get("order_by"), "order_by"):
+		column, direction = (item, "asc") if isinstance(item, str) else (str(item[0]), str(item[1]).lower())
+		order_by.append((column, "desc" if direction == "desc" else "asc"))
+
+	limit = data.get("limit")
+	return FederatedPlan(
+		sources, joins, where,
+		[str(c) for c in _as_list(data.get("group_by"), "group_by")],
+		aggregates,
+		[str(c) for c in _as_list(data.get("select"), "select")],
+		order_by,
+		int(limit) if limit is not None else None
+	)
+
+
+def resolve_column(columns: Sequence[str], name: str) -> int:
+	"""按 别名.列名 或唯一的列名查找列位置"""
+	name = name.lower()
+	if name in columns:
+		return columns.index(name)
+	matches = [i for i, column in enumerate(columns) if column.split(".", 1)[-1] == name]
+	if len(matches) == 1:
+		return matches[0]
+	raise ValueError(f"列 {name} {'不唯一' if matches else '不存在'}，可用列：{list(columns)}")
+
+
+def join_key_value(value: Any) -> Any:
+	"""连接键归一化：两个库的同一含义的键类型可能不同（INT / DECIMAL / VARCHAR），整数值统一为 int，字符串去空白"""
+	if isinstance(value, bool):
+		return value
+	if isinstance(value, (int, decimal.Decimal, float)):
+		return int(value) if value == int(value) else value
+	if isinstance(value, str):
+		value = value.strip()
+		return int(value) if value.isdigit() else value
+	return value
+
+
+def scan(
+	source: SourceSpec,
+	max_rows: int,
+	batch_size: int,
+	scanned: Dict[str, int],
+	truncated: List[str],
+	cancel: threading.Event
+) -> RowStream:
+	"""源查询：服务端游标按批读取，列名加上来源别名；最多读取 max_rows 行（0 表示不限制），超出时记入 truncated"""
+	sql, _ = apply_row_cap(source.sql, max_rows)
+	engine = manager.engine(source.database)
+	conn = engine.connect()
+	try:
+		result = conn.execution_options(stream_results=True).execute(text(sql))
+		columns = [f"{source.alias}.{column}".lower() for column in result.keys()]
+	except Exception:
+		conn.close()
+		raise
+	scanned[source.alias] = 0
+
+	def rows() -> Iterator[tuple]:
+		try:
+			while True:
+				if cancel.is_set():
+					raise FederationCancelled("联邦执行已取消")
+				batch = result.fetchmany(batch_size)
+				if not batch:
+					return
+				if 0 < max_rows < scanned[source.alias] + len(batch):
+					batch = batch[:max_rows - scanned[source.alias]]
+					truncated.append(source.alias)
+				scanned[source.alias] += len(batch)
+				for row in batch:
+					yield tuple(row)
+				if source.alias in truncated:
+					return
+		finally:
+			result.close()
+			conn.close()
+
+	return RowStream(columns, rows())
+
+
+def prefetch(stream: RowStream, max_batches: int, batch_size: int, finished: threading.Event) -> RowStream:
+	"""在后台线程中提前读取行流（有界队列），使多个源查询同时在各自的数据库上执行；finished 置位后线程停止并关闭连接"""
+	buffer: "queue.Queue" = queue.Queue(maxsize=max_batches)
+	stop = threading.Event()
+	done = object()
+
+	def put(item: Any) -> bool:
+		while not stop.is_set() and not finished.is_set():
+			try:
+				buffer.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+	def produce() -> None:
+		try:
+			batch = []
+			for row in stream.rows:
+				batch.append(row)
+				if len(batch) >= batch_size:
+					if not put(batch):
+						return
+					batch = []
+			if batch:
+				put(batch)
+			put(done)
+		except BaseException as e:
+			put(e)
+		finally:
+			stream.rows.close()
+
+	thread = threading.Thread(target=produce, name="federation-prefetch", daemon=True)
+	thread.start()
+
+	def rows() -> Iterator[tuple]:
+		try:
+			while True:
+				item = buffer.get()
+				if item is done:
+					return
+				if isinstance(item, BaseException):
+					raise item
+				yield from item
+		finally:
+			stop.set()
+
+	return RowStream(stream.columns, rows())
+
+
+class _SpillFiles:
+	"""哈希连接溢写：构建侧与探测侧按键的哈希分到 N 个临时文件，每批 pickle 一个列表"""
+
+	def __init__(self, partitions: int, directory: Optional[str], batch: int = 1024):
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		self.partitions = partitions
+		self._directory = directory
+		self._batch = batch
+		self._files = {side: [None] * partitions for side in ("build", "probe")}
+		self._buffers = {side: [[] for _ in range(partitions)] for side in ("build", "probe")}
+		self.rows = 0
+
+	def add(self, side: str, key: tuple, row: tuple) -> None:
+		index = hash(key) % self.partitions
+		buffer = self._buffers[side][index]
+		buffer.append((key, row))
+		self.rows += 1
+		if len(buffer) >= self._batch:
+			self._flush(side, index)
+
+	def _flush(self, side: str, index: int) -> None:
+		buffer = self._buffers[side][index]
+		if not buffer:
+			return
+		file = self._files[side][index]
+		if file is None:
+			file = self._files[side][index] = tempfile.TemporaryFile(dir=self._directory, prefix="federation-")
+		pickle.dump(buffer, file, protocol=pickle.HIGHEST_PROTOCOL)
+		self._buffers[side][index] = []
+
+	def read(self, side: str, index: int) -> Iterator[Tuple[tuple, tuple]]:
+		self._flush(side, index)
+		file = self._files[side][index]
+		if file is None:
+			return
+		file.seek(0)
+		while True:
+			try:
+				yield from pickle.load(file)
+			except EOFError:
+				return
+
+	def close(self) -> None:
+		for files in self._files.values():
+			for file in files:
+				if file is not None:
+					file.close()
+
+
+def hash_join(
+	left: RowStream,
+	right: RowStream,
+	on: Sequence[Tuple[str, str]],
+	how: str,
+	memory_rows: int,
+	partitions: int,
+	spill_dir: Optional[str],
+	on_spill: Callable[[int], None]
+) -> RowStream:
+	"""哈希连接：右侧为构建侧，左侧流式探测；构建侧超过 memory_rows 行时改为分区溢写到磁盘（Grace 哈希连接）"""
+	left_index = [resolve_column(left.columns, l) for l, _ in on]
+	right_index = [resolve_column(right.columns, r) for _, r in on]
+	empty_right = (None,) * len(right.columns)
+
+	def key_of(row: tuple, index: List[int]) -> Optional[tuple]:
+		key = tuple(join_key_value(row[i]) for i in index)
+		# NULL 不与任何值相等
+		return None if any(k is None for k in key) else key
+
+	def probe(table: Dict[tuple, List[tuple]], probe_rows: Iterable[Tuple[Optional[tuple], tuple]]) -> Iterator[tuple]:
+		for key, row in probe_rows:
+			matches = table.get(key) if key is not None else None
+			if matches:
+				for match in matches:
+					yield row + match
+			elif how == "left":
+				yield row + empty_right
+
+	def rows() -> Iterator[tuple]:
+		table: Dict[tuple, List[tuple]] = defaultdict(list)
+		count = 0
+		spill: Optional[_SpillFiles] = None
+		try:
+			for row in right.rows:
+				key = key_of(row, right_index)
+				if key is None:
+					continue
+				if spill is not None:
+					spill.add("build", key, row)
+					continue
+				table[key].append(row)
+				count += 1
+				if count > memory_rows:
+					spill = _SpillFiles(partitions, spill_dir)
+					for built_key, built_rows in table.items():
+						for built in built_rows:
+							spill.add("build", built_key, built)
+					table = defaultdict(list)
+
+			if spill is None:
+				yield from probe(table, ((key_of(row, left_index), row) for row in left.rows))
+				return
+
+			for row in left.rows:
+				key = key_of(row, left_index)
+				if key is None:
+					if how == "left":
+						yield row + empty_right
+					continue
+				spill.add("probe", key, row)
+			on_spill(spill.rows)
+			# 逐个分区在内存中构建并探测
+			for index in range(partitions):
+				table = defaultdict(list)
+				for key, row in spill.read("build", index):
+					table[key].append(row)
+				yield from probe(table, spill.read("probe", index))
+		finally:
+			if spill is not None:
+				spill.close()
+
+	return RowStream(left.columns + right.columns, rows())
+
+
+def _comparable(value: Any, expected: Any) -> Tuple[Any, Any]:
+	"""比较大小前统一类型：计划来自 JSON，数字可能写成字符串、日期只能写成字符串；无法转换时抛出 ValueError"""
+	try:
+		if isinstance(value, bool) or isinstance(expected, bool):
+			pass
+		elif isinstance(value, decimal.Decimal):
+			return value, decimal.Decimal(str(expected).strip())
+		elif isinstance(value, (int, float)):
+			return value, float(expected)
+		elif isinstance(value, datetime.datetime):
+			return value, datetime.datetime.fromisoformat(str(expected).strip())
+		elif isinstance(value, datetime.date):
+			return value, datetime.date.fromisoformat(str(expected).strip())
+		elif isinstance(value, datetime.time):
+			return value, datetime.time.fromisoformat(str(expected).strip())
+		elif isinstance(value, str) and isinstance(expected, (int, float, decimal.Decimal)):
+			return float(value), expected
+		elif isinstance(value, str):
+			return value, str(expected)
+	except (ValueError, decimal.InvalidOperation):
+		pass
+	raise ValueError(f"过滤条件的值 {expected!r} 无法与列值 {value!r} 比较大小")
+
+
+def _matches(value: Any, op: str, expected: Any) -> bool:
+	if op == "is null":
+		return value is None
+	if op == "is not null":
+		return value is not None
+	if value is None:
+		return False
+	if op == "=":
+		return join_key_value(value) == join_key_value(expected)
+	if op == "!=":
+		return join_key_value(value) != join_key_value(expected)
+	if op == "in":
+		return join_key_value(value) in {join_key_value(v) for v in expected}
+	if op == "not in":
+		return join_key_value(value) not in {join_key_value(v) for v in expected}
+	if op == "contains":
+		return str(expected).lower() in str(value).lower()
+	try:
+		return _compare(value, op, expected)
+	except TypeError:
+		value, expected = _comparable(value, expected)
+		return _compare(value, op, expected)
+
+
+def _compare(value: Any, op: str, expected: Any) -> bool:
+	if op == ">":
+		return value > expected
+	if op == ">=":
+		return value >= expected
+	if op == "<":
+		return value < expected
+	return value <= expected
+
+
+def filter_rows(stream: RowStream, conditions: Sequence[Tuple[str, str, Any]]) -> RowStream:
+	"""按条件（AND）过滤"""
+	checks = [(resolve_column(stream.columns, column), op, value) for column, op, value in conditions]
+	rows = (row for row in stream.rows if all(_matches(row[i], op, value) for i, op, value in checks))
+	return RowStream(stream.columns, rows)
+
+
+def _add(total: Any, value: Any) -> Any:
+	if total is None:
+		return value
+	try:
+		return total + value
+	except TypeError:
+		# DECIMAL 与 FLOAT 混合
+		return float(total) + float(value)
+
+
+def aggregate(stream: RowStream, group_by: Sequence[str], aggregates: Sequence[Tuple[str, str, str]], max_groups: int) -> RowStream:
+	"""哈希分组聚合：只保留每组的聚合状态，内存与分组数成正比"""
+	group_index = [resolve_column(stream.columns, column) for column in group_by]
+	specs = [(func, None if column == "*" else resolve_column(stream.columns, column)) for func, column, _ in aggregates]
+
+	def initial() -> list:
+		return [set() if func == "count_distinct" else [None, 0] if func == "avg" else 0 if func == "count" else None for func, _ in specs]
+
+	def rows() -> Iterator[tuple]:
+		groups: Dict[tuple, list] = {}
+		for row in stream.rows:
+			key = tuple(row[i] for i in group_index)
+			state = groups.get(key)
+			if state is None:
+				if len(groups) >= max_groups:
+					raise ValueError(f"分组数超过上限 {max_groups}")
+				state = groups[key] = initial()
+			for n, (func, index) in enumerate(specs):
+				value = row[index] if index is not None else 1
+				if value is None:
+					continue
+				if func == "count":
+					state[n] += 1
+				elif func == "count_distinct":
+					state[n].add(join_key_value(value))
+				elif func == "sum":
+					state[n] = _add(state[n], value)
+				elif func == "avg":
+					state[n] = [_add(state[n][0], value), state[n][1] + 1]
+				elif func == "min":
+					state[n] = value if state[n] is None or value < state[n] else state[n]
+				else:
+					state[n] = value if state[n] is None or value > state[n] else state[n]
+		if not groups and not group_index:
+			groups[()] = initial()
+		for key, state in groups.items():
+			values = []
+			for (func, _), value in zip(specs, state):
+				if func == "count_distinct":
+					value = len(value)
+				elif func == "avg":
+					value = value[0] / value[1] if value[1] else None
+				values.append(value)
+			yield key + tuple(values)
+
+	columns = [stream.columns[i] for i in group_index] + [alias.lower() for _, _, alias in aggregates]
+	return RowStream(columns, rows())
+
+
+def project(stream: RowStream, columns: Sequence[str]) -> RowStream:
+	index = [resolve_column(stream.columns, column) for column in columns]
+	return RowStream([stream.columns[i] for i in index], (tuple(row[i] for i in index) for row in stream.rows))
+
+
+class _Descending:
+	__slots__ = ("value",)
+
+	def __init__(self, value: Any):
+		self.value = value
+
+	def __lt__(self, other: "_Descending") -> bool:
+		return other.value < self.value
+
+	def __eq__(self, other: object) -> bool:
+		return isinstance(other, _Descending) and other.value == self.value
+
+
+def top_rows(stream: RowStream, order_by: Sequence[Tuple[str, str]], limit: Optional[int]) -> List[tuple]:
+	"""排序后取前 limit 行（堆，内存与 limit 成正比；limit 为 None 时取全部）；NULL 排在最后"""
+	if not order_by:
+		if limit is None:
+			return list(stream.rows)
+		return [row for _, row in zip(range(limit), stream.rows)]
+	specs = [(resolve_column(stream.columns, column), direction == "desc") for column, direction in order_by]
+
+	def key(row: tuple) -> tuple:
+		return tuple(
+			(1, 0) if row[i] is None else (0, _Descending(row[i]) if desc else row[i])
+			for i, desc in specs
+		)
+
+	try:
+		if limit is None:
+			return sorted(stream.rows, key=key)
+		return heapq.nsmallest(limit, stream.rows, key=key)
+	except TypeError:
+		raise ValueError("排序列的值类型不一致")
+
+
+def _display_columns(columns: Sequence[str]) -> List[str]:
+	"""输出列名：列名唯一时去掉来源别名"""
+	bare = [column.split(".", 1)[-1] for column in columns]
+	return [b if bare.count(b) == 1 else c for b, c in zip(bare, columns)]
+
+
+def execute_plan(
+	plan: FederatedPlan,
+	roles: Dict[str, str],
+	max_rows: int,
+	scan_max_rows: int,
+	batch_size: int,
+	memory_rows: int,
+	partitions: int,
+	spill_dir: Optional[str] = None,
+	max_groups: int = 100000,
+	cancel: Optional[threading.Event] = None
+) -> FederatedResult:
+	"""执行联邦计划：各源查询并发读取，进程内完成连接、过滤、聚合与排序，只返回最终结果（不超过 max_rows 行，0 表示不限制）"""
+	cancel = cancel or threading.Event()
+	finished = threading.Event()
+	scanned: Dict[str, int] = {}
+	truncated_sources: List[str] = []
+	spilled = [0]
+	streams: Dict[str, RowStream] = {}
+	# 所有源查询通过 RBAC 校验后才开始读取
+	for source in plan.sources:
+		allowed, message = check_sql_permission(source.sql, roles[source.database], source.database)
+		if not allowed:
+			raise PermissionError(f"{source.database}: 权限不足：{message}")
+	try:
+		for source in plan.sources:
+			stream = scan(source, scan_max_rows, batch_size, scanned, truncated_sources, cancel)
+			# 各源同时开始读取；首个源（探测侧）在构建侧读完前最多缓冲 8 批
+			streams[source.alias] = prefetch(stream, 8, batch_size, finished)
+
+		stream = streams[plan.sources[0].alias]
+		for join in plan.joins:
+			stream = hash_join(
+				stream, streams[join.right], join.on, join.how, memory_rows, partitions, spill_dir,
+				lambda rows: spilled.__setitem__(0, spilled[0] + rows)
+			)
+		if plan.where:
+			stream = filter_rows(stream, plan.where)
+		if plan.group_by or plan.aggregates:
+			stream = aggregate(stream, plan.group_by, plan.aggregates, max_groups)
+		if plan.select:
+			stream = project(stream, plan.select)
+
+		# max_rows 为 0 表示不限制（与 bounded.fetch_rows 一致），此时只按计划中的 limit 截取
+		cap = max_rows if max_rows > 0 else None
+		limit = plan.limit if cap is None else min(plan.limit, cap) if plan.limit is not None else cap
+		rows = top_rows(stream, plan.order_by, None if limit is None else limit + 1)
+		# 源被截断时连接与聚合结果都不完整，同样标记为截断
+		truncated = bool(truncated_sources) or (
+			cap is not None and len(rows) > limit and (plan.limit is None or plan.limit > cap)
+		)
+		return FederatedResult(
+			FetchResult(_display_columns(stream.columns), rows[:limit], truncated),
+			dict(scanned),
+			spilled[0],
+			sorted(truncated_sources)
+		)
+	finally:
+		finished.set()
+		for stream in streams.values():
+			stream.rows.close()
@@ -1,39 +1,130 @@
-from typing import Generator, Literal
+import threading
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Dict, Generator, Literal, Optional, Tuple
 from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker, Session
-from contextlib import contextmanager
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from contextlib import contextmanager, asynccontextmanager
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import HTTPConnection
 
 from app.config import settings
+from app.cache.result_cache import is_write_sql, result_cache
+from app.db.bounded import FetchResult, afetch_rows, apply_row_cap, fetch_rows, is_query_sql
 
 
 ActiveDB = Literal["hospital", "warehouse"]
+DATABASES: Tuple[str, ...] = ("hospital", "warehouse")
+DATABASE_HEADER = "x-database"
+DATABASE_COOKIE = "active_db"
+
+# 当前请求的目标数据库，由 DatabaseSelectionMiddleware 设置；随上下文传入线程池，请求之间互不影响
+_request_database: ContextVar[Optional[str]] = ContextVar("request_database", default=None)
+
+
+def parse_database(value: Optional[str]) -> Optional[ActiveDB]:
+	value = (value or "").strip().lower()
+	return value if value in DATABASES else None
+
+# 同步驱动 -> 异步驱动
+ASYNC_DRIVERS: Dict[str, str] = {
+	"mysql": "aiomysql",
+	"postgresql": "asyncpg",
+	"sqlite": "aiosqlite",
+}
+
+
+def to_async_url(url: str) -> str:
+	"""把同步连接串转换为对应的异步驱动连接串"""
+	parsed = make_url(url)
+	backend = parsed.get_backend_name()
+	if backend not in ASYNC_DRIVERS:
+		raise ValueError(f"不支持异步模式的数据库类型: {backend}")
+	return parsed.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}").render_as_string(hide_password=False)
 
 
 class DatabaseManager:
 	def __init__(self) -> None:
-		self._engines = {
-			"hospital": create_engine(settings.hospital_db_url, pool_pre_ping=True, future=True),
-			"warehouse": create_engine(settings.warehouse_db_url, pool_pre_ping=True, future=True),
+		# 引擎在首次使用时创建，导入模块不做任何连接相关的初始化
+		self._engines = {}
+		self._sessions = {}
+		self._async_engines = {}
+		self._async_sessions = {}
+		self._init_lock = threading.Lock()
+		self._initialized = False
+		self.default: ActiveDB = parse_database(settings.default_database) or "hospital"
+		# 各库的 SQL 方言（mysql / postgresql / sqlite ...），按连接串判断，不需要创建引擎
+		self._dialects = {
+			"hospital": make_url(settings.hospital_db_url).get_backend_name(),
+			"warehouse": make_url(settings.warehouse_db_url).get_backend_name(),
 		}
-		self._sessions = {
-			"hospital": sessionmaker(bind=self._engines["hospital"], autoflush=False, autocommit=False, future=True),
-			"warehouse": sessionmaker(bind=self._engines["warehouse"], autoflush=False, autocommit=False, future=True),
-		}
-		self._active: ActiveDB = "hospital"
+
+	def _ensure_engines(self) -> None:
+		"""惰性创建同步/异步引擎与会话工厂"""
+		if self._initialized:
+			return
+		with self._init_lock:
+			if self._initialized:
+				return
+			self._engines = {
+				"hospital": create_engine(settings.hospital_db_url, pool_pre_ping=True, future=True),
+				"warehouse": create_engine(settings.warehouse_db_url, pool_pre_ping=True, future=True),
+			}
+			self._sessions = {
+				"hospital": sessionmaker(bind=self._engines["hospital"], autoflush=False, autocommit=False, future=True),
+				"warehouse": sessionmaker(bind=self._engines["warehouse"], autoflush=False, autocommit=False, future=True),
+			}
+			if settings.db_async_mode:
+				self._async_engines = {
+					"hospital": create_async_engine(
+						settings.hospital_async_db_url or to_async_url(settings.hospital_db_url), pool_pre_ping=True
+					),
+					"warehouse": create_async_engine(
+						settings.warehouse_async_db_url or to_async_url(settings.warehouse_db_url), pool_pre_ping=True
+					),
+				}
+				self._async_sessions = {
+					name: async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+					for name, engine in self._async_engines.items()
+				}
+			self._initialized = True
+
+	@property
+	def initialized(self) -> bool:
+		return self._initialized
 
 	@property
 	def active(self) -> ActiveDB:
-		return self._active
+		"""当前请求的目标数据库（未指定时为默认库）"""
+		return _request_database.get() or self.default
+
+	def dialect(self, database: Optional[ActiveDB] = None) -> str:
+		return self._dialects[database or self.active]
 
-	def switch(self, target: ActiveDB) -> ActiveDB:
-		if target not in ("hospital", "warehouse"):
-			raise ValueError("Unsupported target database")
-		self._active = target
-		return self._active
+	@property
+	def async_enabled(self) -> bool:
+		self._ensure_engines()
+		return bool(self._async_engines)
 
 	@contextmanager
-	def session_scope(self) -> Generator[Session, None, None]:
-		SessionLocal = self._sessions[self._active]
+	def use(self, database: Optional[ActiveDB]) -> Generator[ActiveDB, None, None]:
+		"""在当前上下文（请求）内把目标数据库设为 database，为 None 时不改变"""
+		token = _request_database.set(parse_database(database) or _request_database.get())
+		try:
+			yield self.active
+		finally:
+			_request_database.reset(token)
+
+	def engine(self, database: Optional[ActiveDB] = None) -> Any:
+		"""同步引擎（表结构反射等后台任务使用）"""
+		self._ensure_engines()
+		return self._engines[database or self.active]
+
+	@contextmanager
+	def session_scope(self, database: Optional[ActiveDB] = None) -> Generator[Session, None, None]:
+		self._ensure_engines()
+		SessionLocal = self._sessions[database or self.active]
 		session: Session = SessionLocal()
 		try:
 			yield session
@@ -44,8 +135,24 @@ class DatabaseManager:
 		finally:
 			session.close()
 
+	@asynccontextmanager
+	async def async_session_scope(self, database: Optional[ActiveDB] = None) -> AsyncGenerator[AsyncSession, None]:
+		if not self.async_enabled:
+			raise RuntimeError("异步数据库模式未启用，请设置 DB_ASYNC_MODE=true")
+		SessionLocal = self._async_sessions[database or self.active]
+		session: AsyncSession = SessionLocal()
+		try:
+			yield session
+			await session.commit()
+		except Exception:
+			await session.rollback()
+			raise
+		finally:
+			await session.close()
+
 	def test_connections(self) -> dict:
 		"""测试数据库连接"""
+		self._ensure_engines()
 		results = {}
 		for db_name, engine in self._engines.items():
 			try:
@@ -56,10 +163,119 @@ class DatabaseManager:
 				results[db_name] = {"status": "failed", "error": str(e)}
 		return results
 
+	async def atest_connections(self) -> dict:
+		"""测试数据库连接（异步引擎）"""
+		self._ensure_engines()
+		results = {}
+		for db_name, engine in self._async_engines.items():
+			try:
+				async with engine.connect() as conn:
+					await conn.execute(text("SELECT 1"))
+					results[db_name] = {"status": "connected", "error": None}
+			except Exception as e:
+				results[db_name] = {"status": "failed", "error": str(e)}
+		return results
+
+	def _fetch_sync(self, sql: str, database: ActiveDB, max_rows: int) -> FetchResult:
+		with self.session_scope(database) as session:
+			# 服务端游标：按批读取，不在驱动层一次性缓冲整个结果集
+			result = session.execute(text(sql), execution_options={"stream_results": True})
+			try:
+				if not result.returns_rows:
+					return FetchResult([], [])
+				columns = list(result.keys())
+				rows, truncated = fetch_rows(result, max_rows, settings.db_fetch_batch_size)
+				return FetchResult(columns, rows, truncated)
+			finally:
+				result.close()
+
+	async def fetch_all(self, sql: str, database: Optional[ActiveDB] = None, max_rows: Optional[int] = None) -> FetchResult:
+		"""执行查询并返回有界结果；没有 LIMIT 的查询自动注入行数上限，超出部分标记为截断
+		连接只在执行期间借出，返回前即归还连接池"""
+		database = database or self.active
+		max_rows = settings.db_max_rows if max_rows is None else max_rows
+		sql, _ = apply_row_cap(sql, max_rows)
+		if self.async_enabled:
+			async with self.async_session_scope(database) as session:
+				if not is_query_sql(sql):
+					result = await session.execute(text(sql))
+					if not result.returns_rows:
+						return FetchResult([], [])
+					rows, truncated = fetch_rows(result, max_rows, settings.db_fetch_batch_size)
+					return FetchResult(list(result.keys()), rows, truncated)
+				result = await session.stream(text(sql))
+				try:
+					rows, truncated = await afetch_rows(result, max_rows, settings.db_fetch_batch_size)
+					return FetchResult(list(result.keys()), rows, truncated)
+				finally:
+					await result.close()
+		return await run_in_threadpool(self._fetch_sync, sql, database, max_rows)
+
+	async def cached_fetch_all(self, sql: str, database: Optional[ActiveDB] = None) -> FetchResult:
+		"""带结果缓存的有界查询（cache_hit 标记是否命中缓存）；写操作执行后使相关表的缓存失效"""
+		database = database or self.active
+		cached = result_cache.get(database, sql)
+		if cached is not None:
+			columns, rows, truncated = cached
+			return FetchResult(list(columns), list(rows), truncated, True)
+		fetched = await self.fetch_all(sql, database)
+		if is_write_sql(sql):
+			result_cache.on_write(database, sql)
+		else:
+			result_cache.store(database, sql, fetched.columns, fetched.rows, fetched.truncated)
+		return fetched
+
+	def pool_status(self) -> dict:
+		"""获取各引擎连接池占用情况"""
+		self._ensure_engines()
+		engines = dict(self._engines)
+		engines.update({f"{name}_async": engine.sync_engine for name, engine in self._async_engines.items()})
+		results = {}
+		for name, engine in engines.items():
+			pool = engine.pool
+			results[name] = {
+				"pool": type(pool).__name__,
+				"size": pool.size() if hasattr(pool, "size") else None,
+				"checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+				"checked_in": pool.checkedin() if hasattr(pool, "checkedin") else None,
+				"overflow": pool.overflow() if hasattr(pool, "overflow") else None,
+			}
+		return results
+
+	async def adispose(self) -> None:
+		"""释放异步引擎连接池"""
+		for engine in self._async_engines.values():
+			await engine.dispose()
+
 
 manager = DatabaseManager()
 
 
+class DatabaseSelectionMiddleware:
+	"""按请求选择目标数据库（X-Database 请求头优先，其次会话 cookie），请求处理期间 manager.active 返回该库
+
+	纯 ASGI 中间件：上下文变量对流式响应与线程池中的同步代码同样生效。
+	"""
+
+	def __init__(self, app: Any):
+		self.app = app
+
+	async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+		if scope["type"] != "http":
+			await self.app(scope, receive, send)
+			return
+		conn = HTTPConnection(scope)
+		database = parse_database(conn.headers.get(DATABASE_HEADER)) or parse_database(conn.cookies.get(DATABASE_COOKIE))
+		with manager.use(database):
+			await self.app(scope, receive, send)
+
+
 def get_db_session() -> Generator[Session, None, None]:
-	with manager.session_scope() as session:
+	"""当前请求目标数据库的会话（FastAPI 依赖）"""
+	with manager.session_scope(manager.active) as session:
+		yield session
+
+
+async def get_async_db_session() -> AsyncGenerator[AsyncSession, None]:
+	async with manager.async_session_scope(manager.active) as session:
 		yield session
@@ -0,0 +1,339 @@
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import inspect, text
+
+from app.cache.result_cache import result_cache
+from app.cache.sql_cache import schema_hash
+from app.config import settings
+from app.db.manager import ActiveDB, manager
+
+
+# 手写的表结构说明：数据库不可达时作为提示词使用；反射到真实表结构后只用于补充中文说明
+STATIC_SCHEMAS: Dict[str, str] = {
+	# 医疗数据库表结构
+	"hospital": """
+医疗数据库 (hospital_db) 表结构：
+
+1. doctors (医生信息表)
+   - doctor_id: VARCHAR(10) - 医生ID (主键)
+   - doctor_name: VARCHAR(50) - 医生姓名
+   - department: VARCHAR(50) - 所属科室
+   - title: VARCHAR(50) - 职称/角色
+
+2. patients (病人信息表)
+   - patient_id: VARCHAR(10) - 病人ID (主键)
+   - patient_name: VARCHAR(50) - 病人姓名
+   - gender: VARCHAR(10) - 性别
+   - birth_date: DATE - 出生日期
+   - contact_number: VARCHAR(20) - 联系电话
+   - primary_doctor_id: VARCHAR(10) - 主治医生ID (外键关联doctors.doctor_id)
+
+3. medical_records (诊疗记录表)
+   - record_id: INT - 记录ID (主键，自增)
+   - patient_id: VARCHAR(10) - 病人ID (外键关联patients.patient_id)
+   - doctor_id: VARCHAR(10) - 看诊医生ID (外键关联doctors.doctor_id)
+   - visit_date: DATETIME - 就诊日期
+   - diagnosis: TEXT - 诊断结果
+   - prescription: TEXT - 处方
+""",
+	# 仓储数据库表结构
+	"warehouse": """
+仓储数据库 (warehouse_db) 表结构：
+
+1. warehouse_staff (仓库员工表)
+   - staff_id: VARCHAR(10) - 员工ID (主键)
+   - staff_name: VARCHAR(50) - 员工姓名
+   - role: VARCHAR(50) - 角色/岗位 (Manager/Operator)
+
+2. products (商品信息表)
+   - product_id: VARCHAR(10) - 商品ID (主键)
+   - product_name: VARCHAR(100) - 商品名称
+   - description: TEXT - 商品描述
+   - price: DECIMAL(10,2) - 单价
+   - supplier: VARCHAR(100) - 供应商
+
+3. inventory (库存表)
+   - inventory_id: INT - 库存记录ID (主键，自增)
+   - product_id: VARCHAR(10) - 商品ID (外键关联products.product_id)
+   - warehouse_location: VARCHAR(20) - 仓库位置
+   - quantity: INT - 库存数量
+   - last_updated: TIMESTAMP - 最后更新时间
+
+4. shipments (出入库记录表)
+   - shipment_id: INT - 记录ID (主键，自增)
+   - product_id: VARCHAR(10) - 商品ID (外键关联products.product_id)
+   - staff_id: VARCHAR(10) - 操作员工ID (外键关联warehouse_staff.staff_id)
+   - quantity_change: INT - 数量变化 (正数入库, 负数出库)
+   - record_time: DATETIME - 记录时间
+   - type: VARCHAR(20) - 类型 (INBOUND/OUTBOUND)
+"""
+}
+
+DATABASE_LABELS: Dict[str, str] = {"hospital": "医疗数据库", "warehouse": "仓储数据库"}
+
+# 表结构提示词的格式：“1. doctors (医生信息表)” 与 “   - doctor_id: VARCHAR(10) - 医生ID (主键)”
+SCHEMA_TABLE = re.compile(r"^\s*\d+\.\s*(\w+)\s*(?:\((.*)\))?\s*$")
+SCHEMA_COLUMN = re.compile(r"^\s*-\s*(\w+)\s*:\s*(.*)$")
+FOREIGN_KEY = re.compile(r"\s*\(外键关联\s*(\w+)\.\w+\)")
+# 列说明中的主键/外键标注（反射时按真实约束重新生成）
+KEY_NOTE = re.compile(r"\s*\((?:主键|外键)[^)]*\)")
+
+# 各数据库的行数估计（来自统计信息，不做全表 COUNT）
+ROW_ESTIMATE_SQL: Dict[str, str] = {
+	"mysql": "SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()",
+	"postgresql": (
+		"SELECT c.relname, c.reltuples::bigint FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+		"WHERE n.nspname = current_schema() AND c.relkind = 'r'"
+	),
+}
+
+
+class SchemaColumn(NamedTuple):
+	name: str
+	definition: str
+	references: Optional[str]
+
+
+class SchemaTable(NamedTuple):
+	name: str
+	comment: str
+	columns: Tuple[SchemaColumn, ...]
+
+
+class DatabaseSchema(NamedTuple):
+	title: str
+	tables: Tuple[SchemaTable, ...]
+
+
+class SchemaSnapshot(NamedTuple):
+	"""某一版本的表结构：version 为提示词文本的内容哈希；source 为 live（反射）或 static（手写说明）"""
+	database: str
+	version: str
+	text: str
+	schema: DatabaseSchema
+	row_estimates: Dict[str, Optional[int]]
+	source: str
+	refreshed_at: float
+
+
+def parse_schema(text: str) -> DatabaseSchema:
+	"""把表结构提示词解析为表与列（保留每列原始的类型与说明文字）"""
+	title = ""
+	tables: List[SchemaTable] = []
+	for line in text.strip().splitlines():
+		table = SCHEMA_TABLE.match(line)
+		column = SCHEMA_COLUMN.match(line)
+		if table:
+			tables.append(SchemaTable(table.group(1).lower(), (table.group(2) or "").strip(), ()))
+		elif column and tables:
+			definition = column.group(2).strip()
+			fk = FOREIGN_KEY.search(definition)
+			last = tables[-1]
+			tables[-1] = last._replace(columns=last.columns + (
+				SchemaColumn(column.group(1).lower(), definition, fk.group(1).lower() if fk else None),
+			))
+		elif line.strip() and not tables and not title:
+			title = line.strip()
+	return DatabaseSchema(title, tuple(tables))
+
+
+def render_schema(schema: DatabaseSchema, tables: Optional[Sequence[str]] = None, hidden_columns: frozenset = frozenset()) -> str:
+	"""按提示词格式输出指定的表（默认全部，重新编号），去掉隐藏的列与指向未输出表的外键说明"""
+	visible = set(tables) if tables is not None else {table.name for table in schema.tables}
+	parts = [schema.title, ""]
+	index = 0
+	for table in schema.tables:
+		if table.name not in visible:
+			continue
+		index += 1
+		parts.append(f"{index}. {table.name} ({table.comment})" if table.comment else f"{index}. {table.name}")
+		for column in table.columns:
+			if column.name in hidden_columns:
+				continue
+			definition = column.definition
+			if column.references and column.references not in visible:
+				definition = FOREIGN_KEY.sub("", definition)
+			parts.append(f"   - {column.name}: {definition}")
+		parts.append("")
+	return "\n" + "\n".join(parts)
+
+
+def _column_comments(schema: DatabaseSchema) -> Dict[Tuple[str, str], str]:
+	"""手写说明中的列说明（去掉主外键标注），键为 (表, 列)"""
+	comments = {}
+	for table in schema.tables:
+		for column in table.columns:
+			if " - " in column.definition:
+				comments[(table.name, column.name)] = KEY_NOTE.sub("", column.definition.split(" - ", 1)[1]).strip()
+	return comments
+
+
+def _type_text(column_type: Any) -> str:
+	try:
+		return str(column_type)
+	except Exception:
+		return type(column_type).__name__.upper()
+
+
+def reflect_schema(database: str, annotations: Optional[DatabaseSchema] = None) -> Tuple[DatabaseSchema, Dict[str, Optional[int]]]:
+	"""反射数据库的表、列、主外键与行数估计；表与列的中文说明优先取数据库注释，其次取手写说明"""
+	engine = manager.engine(database)
+	inspector = inspect(engine)
+	names = inspector.get_table_names()
+	columns = inspector.get_multi_columns()
+	primary_keys = inspector.get_multi_pk_constraint()
+	foreign_keys = inspector.get_multi_foreign_keys()
+	try:
+		table_comments = inspector.get_multi_table_comment()
+	except NotImplementedError:
+		table_comments = {}
+
+	annotated_tables = {table.name: table for table in annotations.tables} if annotations else {}
+	column_comments = _column_comments(annotations) if annotations else {}
+	# 手写说明中的表按原顺序在前，其余按名称排序
+	order = {name: i for i, name in enumerate(annotated_tables)}
+	names = sorted(names, key=lambda name: (order.get(name.lower(), len(order)), name))
+
+	tables = []
+	for name in names:
+		key = (None, name)
+		pk = set((primary_keys.get(key) or {}).get("constrained_columns") or [])
+		references = {}
+		for fk in foreign_keys.get(key, []):
+			if len(fk["constrained_columns"]) == 1 and fk.get("referred_columns"):
+				references[fk["constrained_columns"][0]] = (fk["referred_table"], fk["referred_columns"][0])
+		table_name = name.lower()
+		schema_columns = []
+		for column in columns.get(key, []):
+			column_name = column["name"]
+			comment = column.get("comment") or column_comments.get((table_name, column_name.lower()), "")
+			definition = _type_text(column["type"]) + (f" - {comment}" if comment else "")
+			if column_name in pk:
+				definition += " (主键)"
+			referred = references.get(column_name)
+			if referred:
+				definition += f" (外键关联{referred[0]}.{referred[1]})"
+			schema_columns.append(SchemaColumn(column_name.lower(), definition, referred[0].lower() if referred else None))
+		annotated = annotated_tables.get(table_name)
+		comment = (table_comments.get(key) or {}).get("text") or (annotated.comment if annotated else "")
+		tables.append(SchemaTable(table_name, comment, tuple(schema_columns)))
+
+	database_name = os.path.basename(engine.url.database or "") or database
+	title = f"{DATABASE_LABELS.get(database, database)} ({database_name}) 表结构："
+	return DatabaseSchema(title, tuple(tables)), _row_estimates(engine)
+
+
+def _row_estimates(engine: Any) -> Dict[str, Optional[int]]:
+	sql = ROW_ESTIMATE_SQL.get(engine.dialect.name)
+	if not sql:
+		return {}
+	try:
+		with engine.connect() as conn:
+			return {str(name).lower(): (int(rows) if rows is not None and rows >= 0 else None) for name, rows in conn.execute(text(sql))}
+	except Exception as e:
+		print(f"警告: 表行数估计读取失败: {e}")
+		return {}
+
+
+class SchemaRegistry:
+	"""表结构注册表：从各数据库反射真实表结构，以提示词文本的内容哈希作为版本，后台定时刷新
+
+	反射成功前（或数据库不可达时）使用手写的表结构说明。版本变化时使该库的查询结果缓存失效；
+	SQL 生成缓存、表结构裁剪与 KV 前缀快照都以提示词内容为键，随版本自动更新；KV 前缀快照只为未裁剪的完整表结构保存。
+	"""
+
+	def __init__(self, static_schemas: Dict[str, str], enabled: bool = True, refresh_interval: float = 300.0):
+		self.enabled = enabled
+		self.refresh_interval = refresh_interval
+		self._annotations = {database: parse_schema(text) for database, text in static_schemas.items()}
+		self._static = {
+			database: SchemaSnapshot(database, schema_hash(text), text, self._annotations[database], {}, "static", 0.0)
+			for database, text in static_schemas.items()
+		}
+		self._live: Dict[str, SchemaSnapshot] = {}
+		self._errors: Dict[str, str] = {}
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self._thread: Optional[threading.Thread] = None
+
+	def snapshot(self, database: ActiveDB) -> SchemaSnapshot:
+		"""当前版本的表结构（反射结果优先）"""
+		snapshot = self._live.get(database) or self._static.get(database)
+		if snapshot is None:
+			raise KeyError(f"未知数据库: {database}")
+		return snapshot
+
+	def prompt(self, database: ActiveDB) -> str:
+		return self.snapshot(database).text
+
+	def is_full_prompt(self, text: str) -> bool:
+		"""text 是否为某个库当前版本的完整表结构（未按角色与问题裁剪）"""
+		return any(self.snapshot(database).text == text for database in self._static)
+
+	def version(self, database: ActiveDB) -> str:
+		return self.snapshot(database).version
+
+	def refresh(self, database: Optional[ActiveDB] = None) -> Dict[str, str]:
+		"""立即反射指定数据库（默认全部），返回 {数据库: 版本}；失败的数据库保留上一版本"""
+		databases = [database] if database else list(self._static)
+		versions = {}
+		with self._lock:
+			for name in databases:
+				try:
+					schema, row_estimates = reflect_schema(name, self._annotations.get(name))
+				except Exception as e:
+					self._errors[name] = str(e)
+					print(f"警告: {name} 表结构反射失败，继续使用{'上一版本' if name in self._live else '手写说明'}: {e}")
+					versions[name] = self.version(name)
+					continue
+				self._errors.pop(name, None)
+				text = render_schema(schema)
+				snapshot = SchemaSnapshot(name, schema_hash(text), text, schema, row_estimates, "live", time.time())
+				previous = self._live.get(name)
+				self._live[name] = snapshot
+				if previous and previous.version != snapshot.version:
+					tables = {table.name for table in previous.schema.tables} | {table.name for table in schema.tables}
+					result_cache.invalidate_tables(name, tables)
+					print(f"{name} 表结构已变化: {previous.version} -> {snapshot.version}")
+				versions[name] = snapshot.version
+		return versions
+
+	def _run(self) -> None:
+		self.refresh()
+		while self.refresh_interval > 0 and not self._stop.wait(self.refresh_interval):
+			self.refresh()
+
+	def start(self) -> None:
+		"""在后台线程中首次反射，之后按 SCHEMA_REFRESH_INTERVAL 定时刷新（0 表示只在启动时反射一次）"""
+		if not self.enabled or (self._thread and self._thread.is_alive()):
+			return
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._run, name="schema-registry", daemon=True)
+		self._thread.start()
+
+	def stop(self) -> None:
+		self._stop.set()
+
+	def stats(self) -> Dict[str, Any]:
+		result = {}
+		for database in self._static:
+			snapshot = self.snapshot(database)
+			result[database] = {
+				"version": snapshot.version,
+				"source": snapshot.source,
+				"refreshed_at": snapshot.refreshed_at or None,
+				"tables": {
+					table.name: {"columns": len(table.columns), "row_estimate": snapshot.row_estimates.get(table.name)}
+					for table in snapshot.schema.tables
+				},
+				"error": self._errors.get(database)
+			}
+		return result
+
+
+# 全局实例
+schema_registry = SchemaRegistry(STATIC_SCHEMAS, settings.schema_introspection, settings.schema_refresh_interval)
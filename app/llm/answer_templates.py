@@ -0,0 +1,60 @@
+import re
+from typing import Any, Optional, Sequence
+
+from app.llm.result_encoder import format_cell
+
+
+# 问题开头的礼貌用语与查询动词
+LEADING = re.compile(
+	r"^(请问|请|麻烦|帮我|帮忙|我想|我要|能否|可以)*"
+	r"(查询|查一下|查找|查看|查查|查|看看|看一下|列出|显示|告诉我|统计|给出|获取|找出)?(一下)?"
+)
+# 问题结尾的疑问词与标点
+TRAILING = re.compile(
+	r"(是多少|有多少|一共多少|总共多少|是什么|是谁|有哪些|有谁|是哪些|多少|吗|呢|呀|啊)?[\s?？。.!！]*$"
+)
+# 问题要求分析、总结等叙述性回答时交给模型
+NARRATIVE_HINTS = re.compile(r"分析|总结|解释|为什么|原因|比较|对比|趋势|建议|评价|描述|说明")
+
+
+def question_subject(question: str) -> str:
+	"""去掉问题开头的查询动词与结尾的疑问词，得到问题主语（如“查询医生总数是多少？”->“医生总数”）"""
+	subject = TRAILING.sub("", LEADING.sub("", question.strip(), count=1), count=1)
+	return subject.strip(" ，,：:")
+
+
+def wants_narrative(question: str) -> bool:
+	return bool(NARRATIVE_HINTS.search(question))
+
+
+def template_answer(
+	question: str,
+	columns: Sequence[str],
+	rows: Sequence[Sequence[Any]],
+	truncated: bool = False,
+	max_rows: int = 5,
+	max_columns: int = 6
+) -> Optional[str]:
+	"""空结果、单值、单行与小表按模板生成中文答案；结构复杂（行列超限、结果截断）或问题要求叙述时返回 None"""
+	if truncated or len(columns) > max_columns or len(rows) > max_rows or wants_narrative(question):
+		return None
+
+	subject = question_subject(question)
+	if not rows:
+		return f"没有找到与“{subject}”相关的数据。" if subject else "没有找到相关数据。"
+
+	if len(columns) == 1 and len(rows) == 1:
+		return f"{subject or columns[0]}：{format_cell(rows[0][0])}"
+
+	if len(rows) == 1:
+		lines = [f"{column}：{format_cell(value)}" for column, value in zip(columns, rows[0])]
+		return f"{subject or '查询结果'}：\n" + "\n".join(lines)
+
+	lines = []
+	for i, row in enumerate(rows, 1):
+		if len(columns) == 1:
+			lines.append(f"{i}. {format_cell(row[0])}")
+		else:
+			lines.append(f"{i}. " + "，".join(f"{column}：{format_cell(value)}" for column, value in zip(columns, row)))
+	head = f"{subject}共 {len(rows)} 条记录" if subject else f"共 {len(rows)} 条记录"
+	return head + "：\n" + "\n".join(lines)
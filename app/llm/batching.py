@@ -0,0 +1,268 @@
+import codecs
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+try:
+	import llama_cpp
+	from llama_cpp import _internals as llama_internals
+	from llama_cpp import llama_chat_format
+	LLAMA_AVAILABLE = True
+except ImportError:
+	LLAMA_AVAILABLE = False
+
+
+class _Sequence:
+	"""批中的一个生成序列：待评估的提示词 token、已采样的 token 与输出通道"""
+
+	_END = object()
+
+	def __init__(self, prompt_tokens: List[int], max_tokens: int):
+		self.prompt_tokens = prompt_tokens
+		self.max_tokens = max_tokens
+		self.seq_id = -1
+		self.pending: List[int] = []
+		self.n_past = 0
+		self.last_token: Optional[int] = None
+		self.generated = 0
+		self.cancelled = False
+		self.submitted_at = time.monotonic()
+		self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+		self.output: "queue.Queue[Any]" = queue.Queue()
+
+	def emit(self, text: str) -> None:
+		if text:
+			self.output.put(text)
+
+	def close(self, error: Optional[Exception] = None) -> None:
+		self.emit(self.decoder.decode(b"", final=True))
+		self.output.put(error if error is not None else self._END)
+
+	def chunks(self) -> Iterator[str]:
+		"""逐段读取生成的文本，直到序列结束"""
+		try:
+			while True:
+				item = self.output.get()
+				if item is self._END:
+					return
+				if isinstance(item, Exception):
+					raise item
+				yield item
+		finally:
+			# 调用方提前停止读取时，调度器在下一步释放该序列
+			self.cancelled = True
+
+
+class BatchScheduler:
+	"""连续批处理调度器：并发请求作为并行序列在同一上下文中解码
+
+	空闲时收集一个时间窗口内到达的请求（或凑满批大小）后开始解码；
+	解码过程中每一步都会接纳新请求、释放已结束的序列，新请求的提示词按
+	n_batch 预算分块预填充，与其他序列的解码 token 同批评估。采用贪心解码。
+	"""
+
+	def __init__(
+		self,
+		llm: Any,
+		max_batch: int = 4,
+		window: float = 0.01,
+		seq_ctx: int = 2048,
+		n_batch: int = 512,
+		n_threads: int = 4,
+		max_tokens: int = 512
+	):
+		self.llm = llm
+		self.max_batch = max(1, max_batch)
+		self.window = window
+		self.seq_ctx = seq_ctx
+		self.n_batch = max(n_batch, self.max_batch)
+		self.max_tokens = max_tokens
+		params = llama_cpp.llama_context_default_params()
+		params.n_ctx = seq_ctx * self.max_batch
+		params.n_batch = self.n_batch
+		params.n_ubatch = self.n_batch
+		params.n_seq_max = self.max_batch
+		params.n_threads = n_threads
+		params.n_threads_batch = n_threads
+		# 与 Llama 实例共用已加载的模型权重，只额外分配多序列的 KV 缓存
+		self._ctx = llama_internals.LlamaContext(model=llm._model, params=params, verbose=False)
+		self._batch = llama_internals.LlamaBatch(n_tokens=self.n_batch, embd=0, n_seq_max=1, verbose=False)
+		self._n_vocab = llm.n_vocab()
+		self._vocab = llm._model.vocab
+		self._formatter = self._build_formatter()
+		self._incoming: "queue.Queue[_Sequence]" = queue.Queue()
+		self._active: List[_Sequence] = []
+		self._free_ids = list(range(self.max_batch))
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="local-llm-batch", daemon=True)
+		self._steps = 0
+		self._batched_sequences = 0
+		self._tokens_generated = 0
+		self._decode_seconds = 0.0
+		self._peak_batch = 0
+		self._thread.start()
+
+	def _build_formatter(self) -> Any:
+		"""按模型元数据中的对话模板格式化消息，缺省使用 ChatML（Qwen 系列）"""
+		template = self.llm.metadata.get("tokenizer.chat_template")
+		if not template:
+			return llama_chat_format.format_chatml
+		eos_id, bos_id = self.llm.token_eos(), self.llm.token_bos()
+		return llama_chat_format.Jinja2ChatFormatter(
+			template=template,
+			eos_token=self.llm._model.token_get_text(eos_id) if eos_id != -1 else "",
+			bos_token=self.llm._model.token_get_text(bos_id) if bos_id != -1 else ""
+		)
+
+	def submit(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> _Sequence:
+		"""提交一个对话请求，返回可逐段读取输出的序列"""
+		if self._stopped.is_set():
+			raise RuntimeError("批处理调度器已停止")
+		prompt = self._formatter(messages=messages).prompt
+		tokens = self.llm.tokenize(prompt.encode("utf-8"), add_bos=False, special=True)
+		seq = _Sequence(tokens, max_tokens or self.max_tokens)
+		self._incoming.put(seq)
+		return seq
+
+	def generate(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> str:
+		"""阻塞直到生成结束，返回完整文本"""
+		return "".join(self.submit(messages, max_tokens).chunks())
+
+	def stream(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> Iterator[str]:
+		"""流式生成，逐段产出文本"""
+		yield from self.submit(messages, max_tokens).chunks()
+
+	def _start(self, seq: _Sequence) -> None:
+		if len(seq.prompt_tokens) >= self.seq_ctx:
+			seq.close(RuntimeError(f"提示词过长（{len(seq.prompt_tokens)} tokens，单序列上限 {self.seq_ctx}）"))
+			return
+		seq.seq_id = self._free_ids.pop()
+		seq.pending = list(seq.prompt_tokens)
+		self._active.append(seq)
+
+	def _admit(self) -> None:
+		"""接纳新请求：空闲时等待一个批处理窗口收集请求，解码中则只填补空出的序列位"""
+		if not self._active:
+			try:
+				self._start(self._incoming.get(timeout=0.5))
+			except queue.Empty:
+				return
+			deadline = time.monotonic() + self.window
+			while self._free_ids:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				try:
+					self._start(self._incoming.get(timeout=remaining))
+				except queue.Empty:
+					break
+		while self._free_ids:
+			try:
+				self._start(self._incoming.get_nowait())
+			except queue.Empty:
+				break
+
+	def _finish(self, seq: _Sequence, error: Optional[Exception] = None) -> None:
+		self._ctx.kv_cache_seq_rm(seq.seq_id, -1, -1)
+		self._active.remove(seq)
+		self._free_ids.append(seq.seq_id)
+		seq.close(error)
+
+	def _add(self, token: int, pos: int, seq_id: int, logits: bool) -> int:
+		batch = self._batch.batch
+		i = batch.n_tokens
+		batch.token[i] = token
+		batch.pos[i] = pos
+		batch.seq_id[i][0] = seq_id
+		batch.n_seq_id[i] = 1
+		batch.logits[i] = logits
+		batch.n_tokens = i + 1
+		return i
+
+	def _step(self) -> None:
+		"""评估一批 token：每个解码中的序列一个 token，剩余预算分给预填充"""
+		for seq in [s for s in self._active if s.cancelled]:
+			self._finish(seq)
+		if not self._active:
+			return
+		self._batch.reset()
+		budget = self.n_batch
+		sampled = []
+		for seq in self._active:
+			if seq.last_token is not None:
+				sampled.append((self._add(seq.last_token, seq.n_past, seq.seq_id, True), seq))
+				seq.n_past += 1
+				budget -= 1
+		for seq in self._active:
+			if not seq.pending or budget <= 0:
+				continue
+			chunk, seq.pending = seq.pending[:budget], seq.pending[budget:]
+			for j, token in enumerate(chunk):
+				last = not seq.pending and j == len(chunk) - 1
+				index = self._add(token, seq.n_past, seq.seq_id, last)
+				seq.n_past += 1
+				if last:
+					sampled.append((index, seq))
+			budget -= len(chunk)
+		start = time.monotonic()
+		self._ctx.decode(self._batch)
+		self._decode_seconds += time.monotonic() - start
+		self._steps += 1
+		self._batched_sequences += len(self._active)
+		self._peak_batch = max(self._peak_batch, len(self._active))
+		for index, seq in sampled:
+			logits = np.ctypeslib.as_array(self._ctx.get_logits_ith(index), shape=(self._n_vocab,))
+			self._accept(seq, int(np.argmax(logits)))
+
+	def _accept(self, seq: _Sequence, token: int) -> None:
+		if llama_cpp.llama_vocab_is_eog(self._vocab, token):
+			self._finish(seq)
+			return
+		seq.generated += 1
+		self._tokens_generated += 1
+		seq.emit(seq.decoder.decode(self.llm.detokenize([token])))
+		if seq.generated >= seq.max_tokens or seq.n_past + 1 >= self.seq_ctx:
+			self._finish(seq)
+		else:
+			seq.last_token = token
+
+	def _run(self) -> None:
+		while not self._stopped.is_set():
+			self._admit()
+			try:
+				self._step()
+			except Exception as e:
+				print(f"警告: 批处理解码失败: {e}")
+				for seq in list(self._active):
+					self._finish(seq, RuntimeError(f"批处理解码失败: {e}"))
+		for seq in list(self._active):
+			self._finish(seq, RuntimeError("批处理调度器已停止"))
+		while True:
+			try:
+				self._incoming.get_nowait().close(RuntimeError("批处理调度器已停止"))
+			except queue.Empty:
+				break
+
+	def stats(self) -> Dict[str, Any]:
+		"""获取批处理统计：平均批大小、生成速度"""
+		return {
+			"max_batch": self.max_batch,
+			"window_ms": round(self.window * 1000, 1),
+			"active": len(self._active),
+			"waiting": self._incoming.qsize(),
+			"steps": self._steps,
+			"peak_batch": self._peak_batch,
+			"avg_batch": round(self._batched_sequences / self._steps, 2) if self._steps else 0.0,
+			"tokens_generated": self._tokens_generated,
+			"tokens_per_second": round(self._tokens_generated / self._decode_seconds, 1) if self._decode_seconds else 0.0
+		}
+
+	def stop(self) -> None:
+		"""停止调度线程并释放上下文"""
+		self._stopped.set()
+		self._thread.join(timeout=5)
+		self._batch.close()
+		self._ctx.close()
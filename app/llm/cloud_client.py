@@ -1,16 +1,59 @@
-from typing import List, Dict, Any
-from openai import OpenAI
+import asyncio
+import time
+from typing import Any, AsyncIterator, Dict, List
+import httpx
+from openai import OpenAI, AsyncOpenAI, APITimeoutError
 from app.config import settings
+from app.llm.health import model_health
+
+try:
+	import h2  # noqa: F401
+	HTTP2_AVAILABLE = True
+except ImportError:
+	HTTP2_AVAILABLE = False
 
 
 class APICloudClient:
 	def __init__(self):
-		self.client = OpenAI(
-			api_key=settings.openai_api_key,
-			base_url=settings.openai_base_url
-		)
+		# 客户端在首次调用时创建，避免在导入阶段构建连接池
+		self._client: OpenAI = None
+		self._http_client: httpx.AsyncClient = None
+		self._async_client: AsyncOpenAI = None
 		self.model = settings.openai_model
 		self.available_models = settings.available_api_models
+		# 每个模型一个信号量，限制单进程内的并发请求数
+		self._semaphores: Dict[str, asyncio.Semaphore] = {}
+		self._in_flight: Dict[str, int] = {}
+	
+	@property
+	def client(self) -> OpenAI:
+		"""同步客户端（惰性创建）"""
+		if self._client is None:
+			self._client = OpenAI(
+				api_key=settings.openai_api_key,
+				base_url=settings.openai_base_url
+			)
+		return self._client
+	
+	@property
+	def async_client(self) -> AsyncOpenAI:
+		"""异步客户端（惰性创建）：共享连接池（keep-alive + HTTP/2），供 async 路由使用"""
+		if self._async_client is None:
+			self._http_client = httpx.AsyncClient(
+				http2=settings.cloud_http2 and HTTP2_AVAILABLE,
+				limits=httpx.Limits(
+					max_connections=settings.cloud_max_connections,
+					max_keepalive_connections=settings.cloud_max_keepalive,
+					keepalive_expiry=settings.cloud_keepalive_expiry
+				),
+				timeout=httpx.Timeout(settings.cloud_timeout, connect=10.0)
+			)
+			self._async_client = AsyncOpenAI(
+				api_key=settings.openai_api_key,
+				base_url=settings.openai_base_url,
+				http_client=self._http_client
+			)
+		return self._async_client
 	
 	def set_model(self, model_name: str) -> bool:
 		"""设置要使用的模型"""
@@ -27,12 +70,27 @@ class APICloudClient:
 		"""获取当前使用的模型"""
 		return self.model
 	
+	def resolve_model(self, model: str = None) -> str:
+		"""如果指定了模型，使用指定模型；否则使用默认模型"""
+		return model if model and model in self.available_models else self.model
+	
+	@staticmethod
+	def health_name(model: str) -> str:
+		"""健康跟踪中的模型名"""
+		return f"cloud:{model}"
+	
+	def _get_semaphore(self, model: str) -> asyncio.Semaphore:
+		"""获取指定模型的并发信号量"""
+		semaphore = self._semaphores.get(model)
+		if semaphore is None:
+			semaphore = asyncio.Semaphore(settings.cloud_max_concurrency_per_model)
+			self._semaphores[model] = semaphore
+		return semaphore
+	
 	def chat_completion(self, messages: List[Dict[str, str]], model: str = None) -> str:
 		"""调用 API易 进行对话"""
+		use_model = self.resolve_model(model)
 		try:
-			# 如果指定了模型，使用指定模型；否则使用默认模型
-			use_model = model if model and model in self.available_models else self.model
-			
 			response = self.client.chat.completions.create(
 				model=use_model,
 				messages=messages,
@@ -43,16 +101,103 @@ class APICloudClient:
 		except Exception as e:
 			raise RuntimeError(f"API易调用失败 (模型: {use_model}): {e}")
 	
-	def general_qa(self, question: str, model: str = None) -> str:
-		"""通用知识问答"""
-		messages = [
+	async def achat_completion(self, messages: List[Dict[str, str]], model: str = None) -> str:
+		"""异步调用 API易 进行对话（共享连接池，按模型限制并发）"""
+		use_model = self.resolve_model(model)
+		try:
+			async with self._get_semaphore(use_model):
+				self._in_flight[use_model] = self._in_flight.get(use_model, 0) + 1
+				start = time.monotonic()
+				try:
+					response = await self.async_client.chat.completions.create(
+						model=use_model,
+						messages=messages,
+						max_tokens=1000,
+						temperature=0.7
+					)
+				except Exception as e:
+					model_health.record_failure(self.health_name(use_model), str(e), timeout=isinstance(e, APITimeoutError))
+					raise
+				finally:
+					self._in_flight[use_model] -= 1
+				model_health.record_success(self.health_name(use_model), time.monotonic() - start)
+			return response.choices[0].message.content.strip()
+		except Exception as e:
+			raise RuntimeError(f"API易调用失败 (模型: {use_model}): {e}")
+	
+	async def aprobe(self, name: str) -> None:
+		"""健康探测：请求一个 token，name 为健康跟踪中的模型名"""
+		await self.async_client.chat.completions.create(
+			model=name.split(":", 1)[1],
+			messages=[{"role": "user", "content": "测试"}],
+			max_tokens=1
+		)
+	
+	async def astream_chat_completion(self, messages: List[Dict[str, str]], model: str = None) -> AsyncIterator[str]:
+		"""异步流式调用 API易，逐段产出文本（完整读完记为成功，建立连接或读取中途出错记为失败；调用方提前停止不计入）"""
+		use_model = self.resolve_model(model)
+		try:
+			async with self._get_semaphore(use_model):
+				self._in_flight[use_model] = self._in_flight.get(use_model, 0) + 1
+				start = time.monotonic()
+				try:
+					stream = await self.async_client.chat.completions.create(
+						model=use_model,
+						messages=messages,
+						max_tokens=1000,
+						temperature=0.7,
+						stream=True
+					)
+					async for chunk in stream:
+						if chunk.choices and chunk.choices[0].delta.content:
+							yield chunk.choices[0].delta.content
+				except Exception as e:
+					model_health.record_failure(self.health_name(use_model), str(e), timeout=isinstance(e, APITimeoutError))
+					raise
+				finally:
+					self._in_flight[use_model] -= 1
+				model_health.record_success(self.health_name(use_model), time.monotonic() - start)
+		except Exception as e:
+			raise RuntimeError(f"API易调用失败 (模型: {use_model}): {e}")
+	
+	def get_pool_stats(self) -> Dict[str, Any]:
+		"""获取异步连接池与并发配置"""
+		return {
+			"http2": settings.cloud_http2 and HTTP2_AVAILABLE,
+			"max_connections": settings.cloud_max_connections,
+			"max_keepalive_connections": settings.cloud_max_keepalive,
+			"max_concurrency_per_model": settings.cloud_max_concurrency_per_model,
+			"in_flight": dict(self._in_flight)
+		}
+	
+	async def aclose(self) -> None:
+		"""关闭异步连接池"""
+		if self._http_client is not None:
+			await self._http_client.aclose()
+			self._http_client = None
+			self._async_client = None
+	
+	def _general_qa_messages(self, question: str) -> List[Dict[str, str]]:
+		"""构造通用问答的对话消息"""
+		return [
 			{"role": "system", "content": "你是一个专业、友好的AI助手，请用中文回答用户的问题。"},
 			{"role": "user", "content": question}
 		]
-		return self.chat_completion(messages, model)
 	
-	def weather_analysis(self, weather_data: Dict[str, Any], user_question: str, model: str = None) -> str:
-		"""分析天气数据并生成答案"""
+	def general_qa(self, question: str, model: str = None) -> str:
+		"""通用知识问答"""
+		return self.chat_completion(self._general_qa_messages(question), model)
+	
+	async def ageneral_qa(self, question: str, model: str = None) -> str:
+		"""通用知识问答（异步）"""
+		return await self.achat_completion(self._general_qa_messages(question), model)
+	
+	def astream_general_qa(self, question: str, model: str = None) -> AsyncIterator[str]:
+		"""通用知识问答（流式）"""
+		return self.astream_chat_completion(self._general_qa_messages(question), model)
+	
+	def _weather_messages(self, weather_data: Dict[str, Any], user_question: str) -> List[Dict[str, str]]:
+		"""构造天气分析的对话消息"""
 		weather_info = f"""
 当前天气数据：
 - 温度: {weather_data.get('current', {}).get('temperature_2m', 'N/A')}°C
@@ -60,11 +205,22 @@ class APICloudClient:
 - 降水: {weather_data.get('current', {}).get('precipitation', 'N/A')}mm
 """
 		
-		messages = [
+		return [
 			{"role": "system", "content": "你是一个专业的天气分析师，请根据天气数据回答用户的问题。"},
 			{"role": "user", "content": f"{user_question}\n\n{weather_info}"}
 		]
-		return self.chat_completion(messages, model)
+	
+	def weather_analysis(self, weather_data: Dict[str, Any], user_question: str, model: str = None) -> str:
+		"""分析天气数据并生成答案"""
+		return self.chat_completion(self._weather_messages(weather_data, user_question), model)
+	
+	async def aweather_analysis(self, weather_data: Dict[str, Any], user_question: str, model: str = None) -> str:
+		"""分析天气数据并生成答案（异步）"""
+		return await self.achat_completion(self._weather_messages(weather_data, user_question), model)
+	
+	def astream_weather_analysis(self, weather_data: Dict[str, Any], user_question: str, model: str = None) -> AsyncIterator[str]:
+		"""分析天气数据并生成答案（流式）"""
+		return self.astream_chat_completion(self._weather_messages(weather_data, user_question), model)
 	
 	def test_connection(self) -> Dict[str, Any]:
 		"""测试API连接"""
@@ -0,0 +1,100 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Generator, List, Optional
+
+
+class LlamaSlot:
+	"""一个推理槽位：独立的 llama.cpp 上下文（KV 缓存、线程数），权重与其他槽位共享 mmap"""
+
+	def __init__(self, index: int, llm: Any, n_threads: int, n_ctx: int):
+		self.index = index
+		self.llm = llm
+		self.n_threads = n_threads
+		self.n_ctx = n_ctx
+		# 当前上下文开头已缓存的表结构前缀
+		self.ctx_prefix: Optional[str] = None
+		self.busy = False
+		self.served = 0
+		self.busy_seconds = 0.0
+
+
+class ContextPool:
+	"""llama.cpp 上下文池：请求被调度到空闲槽位，槽位之间可并行推理"""
+
+	def __init__(self, slots: List[LlamaSlot]):
+		self.slots = slots
+		self._free: "queue.Queue[LlamaSlot]" = queue.Queue()
+		for slot in slots:
+			self._free.put(slot)
+		self._lock = threading.Lock()
+		self._waits = 0
+		self._created_at = time.monotonic()
+
+	@classmethod
+	def build(cls, factory: Callable[[], Any], size: int, n_threads: int, n_ctx: int) -> "ContextPool":
+		"""创建 size 个槽位；第一个之后的槽位创建失败时按已创建的数量运行"""
+		slots = [LlamaSlot(0, factory(), n_threads, n_ctx)]
+		for index in range(1, max(1, size)):
+			try:
+				slots.append(LlamaSlot(index, factory(), n_threads, n_ctx))
+			except Exception as e:
+				print(f"警告: 创建第 {index + 1} 个推理槽位失败，上下文池大小降为 {index}: {e}")
+				break
+		return cls(slots)
+
+	@property
+	def size(self) -> int:
+		return len(self.slots)
+
+	@contextmanager
+	def acquire(self) -> Generator[LlamaSlot, None, None]:
+		"""借出一个空闲槽位，全部占用时阻塞等待"""
+		try:
+			slot = self._free.get_nowait()
+		except queue.Empty:
+			with self._lock:
+				self._waits += 1
+			slot = self._free.get()
+		slot.busy = True
+		start = time.monotonic()
+		try:
+			yield slot
+		finally:
+			slot.busy = False
+			slot.served += 1
+			slot.busy_seconds += time.monotonic() - start
+			self._free.put(slot)
+
+	@contextmanager
+	def exclusive(self) -> Generator[List[LlamaSlot], None, None]:
+		"""借出全部槽位（等待进行中的推理结束），用于重载模型或清理状态"""
+		taken = [self._free.get() for _ in self.slots]
+		try:
+			yield taken
+		finally:
+			for slot in taken:
+				self._free.put(slot)
+
+	def stats(self) -> Dict[str, Any]:
+		"""获取池大小与各槽位利用率"""
+		uptime = max(time.monotonic() - self._created_at, 1e-9)
+		busy = sum(1 for slot in self.slots if slot.busy)
+		return {
+			"size": self.size,
+			"busy": busy,
+			"idle": self.size - busy,
+			"waits": self._waits,
+			"slots": [
+				{
+					"index": slot.index,
+					"busy": slot.busy,
+					"n_threads": slot.n_threads,
+					"n_ctx": slot.n_ctx,
+					"served": slot.served,
+					"utilization": round(slot.busy_seconds / uptime, 4)
+				}
+				for slot in self.slots
+			]
+		}
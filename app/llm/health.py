@@ -0,0 +1,198 @@
+import asyncio
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from app.config import settings
+
+
+CircuitState = str  # closed / open / half_open
+
+
+class ModelHealth:
+	"""单个模型的健康状态：EWMA 延迟、错误率、超时计数与熔断状态"""
+
+	def __init__(self, name: str, alpha: float):
+		self.name = name
+		self.alpha = alpha
+		self.ewma_latency: Optional[float] = None
+		self.ewma_error_rate = 0.0
+		self.successes = 0
+		self.failures = 0
+		self.timeouts = 0
+		self.invalid_outputs = 0
+		self.slow_calls = 0
+		self.consecutive_failures = 0
+		self.state: CircuitState = "closed"
+		self.opened_at: Optional[float] = None
+		self.last_error = ""
+
+	def _update_error_rate(self, failed: bool) -> None:
+		self.ewma_error_rate = self.alpha * (1.0 if failed else 0.0) + (1 - self.alpha) * self.ewma_error_rate
+
+	def snapshot(self) -> Dict[str, Any]:
+		return {
+			"state": self.state,
+			"ewma_latency": round(self.ewma_latency, 3) if self.ewma_latency is not None else None,
+			"error_rate": round(self.ewma_error_rate, 4),
+			"successes": self.successes,
+			"failures": self.failures,
+			"timeouts": self.timeouts,
+			"invalid_outputs": self.invalid_outputs,
+			"slow_calls": self.slow_calls,
+			"consecutive_failures": self.consecutive_failures,
+			"opened_at": self.opened_at,
+			"last_error": self.last_error
+		}
+
+
+class ModelHealthTracker:
+	"""模型健康跟踪与熔断：连续失败 N 次后断开，冷却后由后台探测半开恢复"""
+
+	def __init__(
+		self,
+		alpha: float = 0.3,
+		failure_threshold: int = 3,
+		cooldown: float = 30.0,
+		probe_interval: float = 10.0,
+		latency_budget: Optional[float] = None
+	):
+		self.alpha = alpha
+		self.failure_threshold = max(1, failure_threshold)
+		self.cooldown = cooldown
+		self.probe_interval = probe_interval
+		self.latency_budget = latency_budget
+		self._models: Dict[str, ModelHealth] = {}
+		self._probes: Dict[str, Callable[[str], Awaitable[Any]]] = {}
+		self._lock = threading.Lock()
+		self._probe_task: Optional[asyncio.Task] = None
+
+	def _get(self, name: str) -> ModelHealth:
+		health = self._models.get(name)
+		if health is None:
+			health = ModelHealth(name, self.alpha)
+			self._models[name] = health
+		return health
+
+	def register_probe(self, prefix: str, probe: Callable[[str], Awaitable[Any]]) -> None:
+		"""注册探测函数；模型名以 prefix 开头时使用，探测函数接收模型名"""
+		self._probes[prefix] = probe
+
+	def _probe_for(self, name: str) -> Optional[Callable[[str], Awaitable[Any]]]:
+		for prefix, probe in self._probes.items():
+			if name.startswith(prefix):
+				return probe
+		return None
+
+	def record_success(self, name: str, latency: float, probe: bool = False) -> None:
+		"""记录一次成功调用；超出延迟预算的调用按慢调用计入连续失败"""
+		if not probe and self.latency_budget is not None and latency > self.latency_budget:
+			self.record_failure(name, f"响应过慢: {latency:.1f}s", latency=latency)
+			return
+		with self._lock:
+			health = self._get(name)
+			health.successes += 1
+			health.consecutive_failures = 0
+			health._update_error_rate(False)
+			if probe:
+				# 探测请求的延迟不代表真实负载，恢复后重新统计
+				health.ewma_latency = None
+			else:
+				health.ewma_latency = self._ewma(health.ewma_latency, latency)
+			if health.state != "closed":
+				print(f"模型 {name} 恢复正常，熔断关闭")
+			health.state = "closed"
+			health.opened_at = None
+
+	def record_failure(
+		self,
+		name: str,
+		error: str = "",
+		timeout: bool = False,
+		invalid_output: bool = False,
+		latency: Optional[float] = None
+	) -> None:
+		"""记录一次失败调用（异常、超时、无法解析的输出或慢调用）"""
+		with self._lock:
+			health = self._get(name)
+			health.failures += 1
+			health.consecutive_failures += 1
+			health.timeouts += int(timeout)
+			health.invalid_outputs += int(invalid_output)
+			if latency is not None:
+				health.slow_calls += 1
+				health.ewma_latency = self._ewma(health.ewma_latency, latency)
+			health.last_error = error
+			health._update_error_rate(True)
+			if health.state == "half_open" or (
+				health.state == "closed" and health.consecutive_failures >= self.failure_threshold
+			):
+				print(f"模型 {name} 连续失败 {health.consecutive_failures} 次，熔断打开")
+				health.state = "open"
+				health.opened_at = time.monotonic()
+
+	def _ewma(self, current: Optional[float], value: float) -> float:
+		return value if current is None else self.alpha * value + (1 - self.alpha) * current
+
+	def allow_request(self, name: str) -> bool:
+		"""熔断器是否放行；冷却结束后进入半开，由后台探测决定是否恢复（无探测时放行一次试探请求）"""
+		with self._lock:
+			health = self._get(name)
+			if health.state == "closed":
+				return True
+			if health.state == "open" and time.monotonic() - health.opened_at >= self.cooldown:
+				health.state = "half_open"
+				return self._probe_for(name) is None
+			return False
+
+	def state(self, name: str) -> CircuitState:
+		"""熔断状态（只读，不推进状态也不消耗试探请求，供状态接口使用）"""
+		with self._lock:
+			health = self._models.get(name)
+			return health.state if health is not None else "closed"
+
+	async def _probe(self, name: str) -> None:
+		probe = self._probe_for(name)
+		if probe is None:
+			return
+		start = time.monotonic()
+		try:
+			await asyncio.wait_for(probe(name), timeout=self.cooldown)
+		except Exception as e:
+			self.record_failure(name, f"探测失败: {e}", timeout=isinstance(e, asyncio.TimeoutError))
+		else:
+			self.record_success(name, time.monotonic() - start, probe=True)
+
+	async def _probe_loop(self) -> None:
+		while True:
+			await asyncio.sleep(self.probe_interval)
+			for name in list(self._models):
+				health = self._models[name]
+				if health.state == "open":
+					self.allow_request(name)
+				if health.state == "half_open":
+					await self._probe(name)
+
+	def start(self) -> None:
+		"""启动后台半开探测"""
+		if self._probe_task is None or self._probe_task.done():
+			self._probe_task = asyncio.get_running_loop().create_task(self._probe_loop())
+
+	def stop(self) -> None:
+		if self._probe_task is not None:
+			self._probe_task.cancel()
+			self._probe_task = None
+
+	def snapshot(self) -> Dict[str, Any]:
+		with self._lock:
+			return {name: health.snapshot() for name, health in self._models.items()}
+
+
+# 全局实例
+model_health = ModelHealthTracker(
+	alpha=settings.health_ewma_alpha,
+	failure_threshold=settings.circuit_failure_threshold,
+	cooldown=settings.circuit_cooldown,
+	probe_interval=settings.health_probe_interval,
+	latency_budget=settings.health_latency_budget
+)
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+
+class InferenceQueueFull(RuntimeError):
+	"""本地推理队列已满，调用方应返回 503 或降级到云端模型"""
+
+
+class InferenceQueue:
+	"""有界推理队列：阻塞的本地推理在专用线程中执行，事件循环只负责排队与等待"""
+
+	def __init__(self, max_size: int = 8, workers: int = 1, name: str = "local-llm"):
+		self.max_size = max(1, max_size)
+		self.workers = max(1, workers)
+		self.name = name
+		self._loop: Optional[asyncio.AbstractEventLoop] = None
+		self._queue: Optional[asyncio.Queue] = None
+		self._tasks: List[asyncio.Task] = []
+		self._executor: Optional[ThreadPoolExecutor] = None
+		self._running = 0
+		self._rejected = 0
+
+	def _ensure_started(self) -> None:
+		"""在当前事件循环上启动工作协程（首次调用时惰性创建）"""
+		loop = asyncio.get_running_loop()
+		if self._loop is loop:
+			return
+		self._loop = loop
+		self._queue = asyncio.Queue(maxsize=self.max_size)
+		if self._executor is None:
+			self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+		self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+	async def _worker(self) -> None:
+		while True:
+			func, args, kwargs, future = await self._queue.get()
+			if future.cancelled():
+				# 请求方已断开，直接丢弃
+				self._queue.task_done()
+				continue
+			self._running += 1
+			try:
+				result = await self._loop.run_in_executor(self._executor, lambda: func(*args, **kwargs))
+			except Exception as e:
+				if not future.done():
+					future.set_exception(e)
+			else:
+				if not future.done():
+					future.set_result(result)
+			finally:
+				self._running -= 1
+				self._queue.task_done()
+
+	def _enqueue(self, func: Callable[..., Any], args: tuple, kwargs: dict) -> asyncio.Future:
+		self._ensure_started()
+		future = self._loop.create_future()
+		try:
+			self._queue.put_nowait((func, args, kwargs, future))
+		except asyncio.QueueFull:
+			self._rejected += 1
+			raise InferenceQueueFull(f"本地推理队列已满（上限 {self.max_size}），请稍后重试")
+		return future
+
+	async def submit(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+		"""提交一次推理任务并等待结果；队列已满时立即抛出 InferenceQueueFull"""
+		return await self._enqueue(func, args, kwargs)
+
+	async def stream(self, func: Callable[..., Iterator[Any]], *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+		"""提交流式推理任务：func 在工作线程中返回同步迭代器，其产出逐项传回事件循环"""
+		loop = asyncio.get_running_loop()
+		chunks: asyncio.Queue = asyncio.Queue()
+		stopped = threading.Event()
+		end = object()
+
+		def run() -> None:
+			try:
+				for item in func(*args, **kwargs):
+					if stopped.is_set():
+						# 请求方已断开，提前结束生成
+						break
+					loop.call_soon_threadsafe(chunks.put_nowait, (item, None))
+			except Exception as e:
+				loop.call_soon_threadsafe(chunks.put_nowait, (end, e))
+				return
+			loop.call_soon_threadsafe(chunks.put_nowait, (end, None))
+
+		future = self._enqueue(run, (), {})
+		try:
+			while True:
+				item, error = await chunks.get()
+				if item is end:
+					if error is not None:
+						raise error
+					break
+				yield item
+			await future
+		finally:
+			stopped.set()
+			if not future.done():
+				future.cancel()
+
+	def stats(self) -> Dict[str, Any]:
+		"""获取队列状态"""
+		return {
+			"pending": self._queue.qsize() if self._queue else 0,
+			"running": self._running,
+			"max_size": self.max_size,
+			"workers": self.workers,
+			"rejected": self._rejected
+		}
+
+	def shutdown(self) -> None:
+		"""停止工作协程并释放线程池"""
+		for task in self._tasks:
+			task.cancel()
+		self._tasks = []
+		self._loop = None
+		self._queue = None
+		if self._executor is not None:
+			self._executor.shutdown(wait=False, cancel_futures=True)
+			self._executor = None
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from app.cache.lru import TTLCache
+
+try:
+	from llama_cpp import Llama
+	LLAMA_AVAILABLE = True
+except ImportError:
+	LLAMA_AVAILABLE = False
+
+
+# 嵌入函数：一批文本 -> (n, dim) 矩阵
+Embedder = Callable[[List[str]], np.ndarray]
+
+# 各分类组的示例问题，每个标签的质心由示例嵌入取平均得到
+INTENT_EXAMPLES: Dict[str, Dict[str, List[str]]] = {
+	"path": {
+		"text_to_sql": [
+			"查询所有医生的信息",
+			"统计每个科室有多少医生",
+			"张三上个月看过哪些病",
+			"列出价格最高的五个商品",
+			"仓库里还剩多少货",
+			"最近一周有哪些出库记录",
+			"哪位员工处理的入库最多",
+			"帮我看看这个病人的主治医生是谁",
+		],
+		"tool_weather": [
+			"今天天气怎么样",
+			"明天会下雨吗",
+			"北京现在多少度",
+			"这周末适合出门吗，会不会刮风",
+			"现在外面湿度高不高",
+		],
+		"general_qa": [
+			"你好，你是谁",
+			"介绍一下你自己",
+			"什么是机器学习",
+			"帮我写一首关于春天的诗",
+			"如何提高工作效率",
+			"解释一下量子计算的基本原理",
+		],
+	},
+	"database": {
+		"hospital": [
+			"查询所有医生的信息",
+			"哪个科室的病人最多",
+			"这个患者的诊断结果是什么",
+			"王医生开过哪些处方",
+			"列出最近的就诊记录",
+		],
+		"warehouse": [
+			"仓库里还有多少库存",
+			"价格最高的商品是什么",
+			"最近一周的出入库记录",
+			"哪个供应商的产品最多",
+			"列出所有仓库员工",
+		],
+	},
+}
+
+
+class IntentResult(NamedTuple):
+	"""分类结果：标签低于置信阈值时为 None，由关键词路由兜底"""
+	path: Optional[str]
+	database: Optional[str]
+	scores: Dict[str, Dict[str, float]]
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+	norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+	return matrix / np.maximum(norms, 1e-12)
+
+
+def load_gguf_embedder(model_path: str, n_threads: int = 2) -> Embedder:
+	"""用 GGUF 模型（embedding 模式，mmap 共享权重）构建嵌入函数；无池化的模型对 token 向量取平均"""
+	if not LLAMA_AVAILABLE:
+		raise RuntimeError("llama-cpp-python 未安装，无法计算问题嵌入")
+	if not os.path.exists(model_path):
+		raise RuntimeError(f"嵌入模型文件不存在: {model_path}")
+	llm = Llama(model_path=model_path, embedding=True, n_ctx=512, n_threads=n_threads, use_mmap=True, verbose=False)
+	lock = threading.Lock()
+
+	def embed(texts: List[str]) -> np.ndarray:
+		with lock:
+			vectors = llm.embed(texts)
+		rows = []
+		for vector in vectors:
+			array = np.asarray(vector, dtype=np.float32)
+			rows.append(array.mean(axis=0) if array.ndim == 2 else array)
+		return np.vstack(rows)
+
+	return embed
+
+
+class IntentClassifier:
+	"""嵌入意图分类器：问题只嵌入一次，与所有分类组的质心矩阵一次矩阵乘法算出余弦相似度"""
+
+	def __init__(
+		self,
+		embedder: Embedder,
+		model_id: str,
+		threshold: float = 0.5,
+		margin: float = 0.05,
+		cache_dir: Optional[str] = ".cache/intent",
+		embed_cache_size: int = 2048,
+		examples: Dict[str, Dict[str, List[str]]] = None
+	):
+		self._embedder = embedder
+		self.model_id = model_id
+		self.threshold = threshold
+		self.margin = margin
+		self.cache_dir = cache_dir
+		self.examples = examples or INTENT_EXAMPLES
+		# 问题嵌入的 LRU（不过期）
+		self._embeddings = TTLCache(max_entries=embed_cache_size, ttl=float("inf"))
+		# 所有分类组的质心按行拼成一个矩阵，_groups 记录每组在矩阵中的行范围与标签
+		self._groups: List[tuple] = []
+		self._centroids: np.ndarray = None
+		self._load_centroids()
+
+	def _cache_path(self) -> Optional[str]:
+		if not self.cache_dir:
+			return None
+		digest = hashlib.sha256(
+			json.dumps([self.model_id, self.examples], ensure_ascii=False, sort_keys=True).encode("utf-8")
+		).hexdigest()[:16]
+		return os.path.join(self.cache_dir, f"centroids_{digest}.npz")
+
+	def _load_centroids(self) -> None:
+		"""从磁盘读取质心矩阵；不存在（或模型、示例变化）时重新计算并写入缓存"""
+		groups, start = [], 0
+		for group, labels in self.examples.items():
+			groups.append((group, start, start + len(labels), list(labels)))
+			start += len(labels)
+		self._groups = groups
+
+		path = self._cache_path()
+		if path and os.path.exists(path):
+			try:
+				with np.load(path) as data:
+					centroids = data["centroids"]
+				if centroids.shape[0] == start:
+					self._centroids = centroids
+					return
+			except Exception as e:
+				print(f"警告: 意图质心缓存读取失败，将重新计算: {e}")
+
+		rows = []
+		for group, labels in self.examples.items():
+			for label, texts in labels.items():
+				rows.append(_normalize(self._embedder(list(texts))).mean(axis=0))
+		self._centroids = _normalize(np.vstack(rows).astype(np.float32))
+		if path:
+			try:
+				os.makedirs(self.cache_dir, exist_ok=True)
+				np.savez(path, centroids=self._centroids)
+			except OSError as e:
+				print(f"警告: 意图质心缓存写入失败: {e}")
+
+	def embed(self, question: str) -> np.ndarray:
+		"""问题嵌入（归一化），命中 LRU 时不再调用模型"""
+		key = question.strip().lower()
+		vector = self._embeddings.get(key)
+		if vector is None:
+			vector = _normalize(self._embedder([question.strip()])[0].astype(np.float32))
+			self._embeddings.set(key, vector)
+		return vector
+
+	def _pick(self, labels: Sequence[str], scores: np.ndarray) -> Optional[str]:
+		order = np.argsort(scores)[::-1]
+		best = scores[order[0]]
+		runner_up = scores[order[1]] if len(order) > 1 else -1.0
+		if best < self.threshold or best - runner_up < self.margin:
+			return None
+		return labels[order[0]]
+
+	def classify(self, question: str) -> IntentResult:
+		"""一次矩阵乘法得到所有标签的相似度，各组分别取最高且超过阈值与差距要求的标签"""
+		similarities = self._centroids @ self.embed(question)
+		picked, scores = {}, {}
+		for group, start, end, labels in self._groups:
+			group_scores = similarities[start:end]
+			scores[group] = {label: round(float(s), 4) for label, s in zip(labels, group_scores)}
+			picked[group] = self._pick(labels, group_scores)
+		return IntentResult(picked.get("path"), picked.get("database"), scores)
+
+	def stats(self) -> Dict[str, object]:
+		return {
+			"model": self.model_id,
+			"threshold": self.threshold,
+			"margin": self.margin,
+			"labels": {group: labels for group, _, _, labels in self._groups},
+			"embedding_cache": self._embeddings.stats()
+		}
@@ -0,0 +1,70 @@
+from collections import deque
+from typing import Dict, Iterable, List, Set, Tuple
+
+
+class KeywordMatcher:
+	"""Aho-Corasick 自动机：一次扫描文本即可找出所有关键词集合中的命中
+
+	构建完成后只读，可在多线程中共享；更新关键词时构建新实例再整体替换。
+	"""
+
+	def __init__(self, keyword_sets: Dict[str, Iterable[str]]):
+		self._goto: List[Dict[str, int]] = [{}]
+		self._fail: List[int] = [0]
+		self._output: List[List[Tuple[str, str]]] = [[]]
+		self.keyword_count = 0
+		for label, keywords in keyword_sets.items():
+			for keyword in keywords:
+				keyword = keyword.lower().strip()
+				if keyword:
+					self._add(label, keyword)
+		self._build()
+
+	def _add(self, label: str, keyword: str) -> None:
+		state = 0
+		for char in keyword:
+			nxt = self._goto[state].get(char)
+			if nxt is None:
+				nxt = len(self._goto)
+				self._goto[state][char] = nxt
+				self._goto.append({})
+				self._fail.append(0)
+				self._output.append([])
+			state = nxt
+		if (label, keyword) not in self._output[state]:
+			self._output[state].append((label, keyword))
+			self.keyword_count += 1
+
+	def _build(self) -> None:
+		"""按广度优先计算失败指针，并把失败链上的输出合并到每个状态"""
+		# 根节点的子节点失败指针指向根
+		queue = deque(self._goto[0].values())
+		while queue:
+			state = queue.popleft()
+			for char, nxt in self._goto[state].items():
+				queue.append(nxt)
+				fail = self._fail[state]
+				while fail and char not in self._goto[fail]:
+					fail = self._fail[fail]
+				self._fail[nxt] = self._goto[fail].get(char, 0) if state else 0
+				self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+
+	@property
+	def state_count(self) -> int:
+		return len(self._goto)
+
+	def find(self, text: str) -> Dict[str, List[str]]:
+		"""扫描文本（不区分大小写），返回 {集合名: [命中的关键词, ...]}"""
+		goto, fail, output = self._goto, self._fail, self._output
+		matches: Dict[str, List[str]] = {}
+		seen: Set[Tuple[str, str]] = set()
+		state = 0
+		for char in text.lower():
+			while state and char not in goto[state]:
+				state = fail[state]
+			state = goto[state].get(char, 0)
+			for item in output[state]:
+				if item not in seen:
+					seen.add(item)
+					matches.setdefault(item[0], []).append(item[1])
+		return matches
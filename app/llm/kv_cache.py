@@ -0,0 +1,83 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+def prefix_key(model_path: str, n_ctx: int, prefix_text: str) -> str:
+	"""KV 快照键：模型文件、上下文长度与前缀文本共同决定，表结构变化时键随之变化"""
+	digest = hashlib.sha256(f"{model_path}|{n_ctx}|{prefix_text}".encode("utf-8"))
+	return digest.hexdigest()[:24]
+
+
+class PrefixStateCache:
+	"""llama.cpp 前缀 KV 状态快照缓存：内存 LRU，可选持久化到磁盘"""
+
+	def __init__(self, mode: str = "ram", max_entries: int = 4, cache_dir: Optional[str] = None):
+		self.mode = mode
+		self.max_entries = max(1, max_entries)
+		self.cache_dir = cache_dir
+		self._states: "OrderedDict[str, Any]" = OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	@property
+	def enabled(self) -> bool:
+		return self.mode in ("ram", "disk")
+
+	def _disk_path(self, key: str) -> str:
+		return os.path.join(self.cache_dir, f"{key}.state")
+
+	def get(self, key: str) -> Optional[Any]:
+		with self._lock:
+			state = self._states.get(key)
+			if state is not None:
+				self._states.move_to_end(key)
+				self.hits += 1
+				return state
+		if self.mode == "disk" and self.cache_dir and os.path.exists(self._disk_path(key)):
+			try:
+				with open(self._disk_path(key), "rb") as f:
+					state = pickle.load(f)
+				self._put_memory(key, state)
+				self.hits += 1
+				return state
+			except Exception as e:
+				print(f"警告: 读取 KV 快照失败，将重新计算: {e}")
+		self.misses += 1
+		return None
+
+	def _put_memory(self, key: str, state: Any) -> None:
+		with self._lock:
+			self._states[key] = state
+			self._states.move_to_end(key)
+			while len(self._states) > self.max_entries:
+				self._states.popitem(last=False)
+
+	def put(self, key: str, state: Any) -> None:
+		self._put_memory(key, state)
+		if self.mode == "disk" and self.cache_dir:
+			try:
+				os.makedirs(self.cache_dir, exist_ok=True)
+				tmp_path = self._disk_path(key) + ".tmp"
+				with open(tmp_path, "wb") as f:
+					pickle.dump(state, f)
+				os.replace(tmp_path, self._disk_path(key))
+			except Exception as e:
+				print(f"警告: 写入 KV 快照失败: {e}")
+
+	def clear(self) -> None:
+		with self._lock:
+			self._states.clear()
+
+	def stats(self) -> Dict[str, Any]:
+		return {
+			"mode": self.mode,
+			"entries": len(self._states),
+			"max_entries": self.max_entries,
+			"hits": self.hits,
+			"misses": self.misses
+		}
@@ -1,6 +1,17 @@
+import asyncio
 import os
-from typing import List, Dict, Any
+import re
+import threading
+import time
+from typing import Any, Dict, Iterator, List, AsyncIterator
 from app.config import settings
+from app.db.schema_registry import schema_registry
+from app.llm.inference_queue import InferenceQueue, InferenceQueueFull
+from app.llm.health import model_health
+from app.llm.kv_cache import PrefixStateCache, prefix_key
+from app.llm.context_pool import ContextPool, LlamaSlot
+from app.llm.batching import BatchScheduler
+from app.llm.result_encoder import approx_token_count
 
 try:
 	from llama_cpp import Llama
@@ -9,13 +20,86 @@ except ImportError:
 	LLAMA_AVAILABLE = False
 
 
+# 健康跟踪中的模型名：SQL 生成与答案格式化分别统计，避免互相掩盖
+HEALTH_NAME = "local_gguf"
+HEALTH_NAME_SQL = f"{HEALTH_NAME}:sql"
+HEALTH_NAME_ANSWER = f"{HEALTH_NAME}:answer"
+
+
+def looks_like_query(sql: str) -> bool:
+	"""模型输出是否为可解析的查询语句"""
+	return bool(sql) and bool(re.match(r"^\s*(SELECT|WITH)\b", sql, re.IGNORECASE))
+
+
 class LocalGGUFClient:
 	def __init__(self):
 		self.model_path = settings.gguf_model_path
-		self.llm = None
+		# 推理槽位池；Llama 对象非线程安全，每个槽位同一时间只服务一个请求
+		self._pool: ContextPool = None
+		# 连续批处理调度器（LOCAL_BATCHING 启用时接管生成请求）
+		self._batcher: BatchScheduler = None
 		self._model_loaded = False
-		self._error_message = ""
-		self._init_model()
+		self._error_message = "本地模型尚未开始加载"
+		# 加载状态：pending / loading / warming / ready / failed；模型在后台线程中加载并预热
+		self._state = "pending"
+		self._loader: threading.Thread = None
+		self._ready_event = threading.Event()
+		self._load_seconds: float = None
+		# 重载模型时与借出槽位互斥
+		self._reload_lock = threading.Lock()
+		self._queue = InferenceQueue(
+			max_size=settings.local_queue_size,
+			workers=max(
+				settings.local_queue_workers,
+				settings.local_pool_size,
+				settings.local_batch_max if settings.local_batching else 1
+			)
+		)
+		# 表结构前缀的 KV 状态快照（各槽位共享，同一模型与上下文长度下可互相载入）
+		self._prefix_states = PrefixStateCache(
+			mode=settings.local_kv_cache,
+			max_entries=settings.local_kv_cache_entries,
+			cache_dir=settings.local_kv_cache_dir
+		)
+	
+	def start_loading(self) -> None:
+		"""在后台线程中加载并预热模型（重复调用无副作用）"""
+		with self._reload_lock:
+			if self._state != "pending":
+				return
+			self._state = "loading"
+			self._error_message = "本地模型加载中"
+			self._loader = threading.Thread(target=self._load_and_warm, name="local-llm-loader", daemon=True)
+			self._loader.start()
+	
+	def wait_ready(self, timeout: float = None) -> bool:
+		"""等待后台加载结束（未启动时先启动加载），返回模型是否可用"""
+		self.start_loading()
+		self._ready_event.wait(timeout)
+		return self.is_available()
+	
+	def _load_and_warm(self) -> None:
+		start = time.monotonic()
+		try:
+			self._init_model()
+			if self._model_loaded:
+				self._state = "warming"
+				self._warm_up()
+		finally:
+			self._state = "ready" if self._model_loaded else "failed"
+			self._load_seconds = time.monotonic() - start
+			self._ready_event.set()
+		if self._model_loaded:
+			print(f"本地模型就绪，加载与预热耗时 {self._load_seconds:.1f}s")
+	
+	def _warm_up(self) -> None:
+		"""预热推理：让权重页面进入内存并完成首次计算图分配"""
+		try:
+			self.probe()
+			if self._batcher:
+				self._batcher.generate([{"role": "user", "content": "SELECT 1"}], max_tokens=1)
+		except Exception as e:
+			print(f"警告: 本地模型预热失败: {e}")
 	
 	def _init_model(self):
 		"""初始化本地 GGUF 模型"""
@@ -39,35 +123,46 @@ class LocalGGUFClient:
 		print(f"模型文件大小: {file_size / (1024*1024):.1f}MB")
 		
 		try:
-			# 使用更稳定的参数配置
-			self.llm = Llama(
-				model_path=self.model_path,
-				n_ctx=2048,  # 减少上下文长度，提高稳定性
-				n_threads=2,  # 减少线程数，避免资源冲突
-				n_batch=512,  # 添加批处理大小
-				verbose=False,
-				use_mmap=True,  # 启用内存映射
-				use_mlock=False,  # 禁用内存锁定
-				seed=-1  # 随机种子
+			# 每个槽位一个 Llama 上下文；启用 mmap 后权重由操作系统页缓存共享，只有 KV 缓存按槽位分配
+			self._pool = ContextPool.build(
+				lambda: Llama(
+					model_path=self.model_path,
+					n_ctx=settings.local_n_ctx,
+					n_threads=settings.local_threads_per_slot,
+					n_batch=settings.local_n_batch,
+					verbose=False,
+					use_mmap=True,  # 启用内存映射
+					use_mlock=False,  # 禁用内存锁定
+					seed=-1  # 随机种子
+				),
+				size=settings.local_pool_size,
+				n_threads=settings.local_threads_per_slot,
+				n_ctx=settings.local_n_ctx
 			)
 			self._model_loaded = True
 			self._error_message = ""
-			print(f"成功加载本地模型: {self.model_path}")
+			print(f"成功加载本地模型: {self.model_path}（推理槽位 {self._pool.size} 个）")
+			self._init_batcher()
 		except Exception as e:
 			print(f"第一次尝试加载失败: {e}")
 			print("尝试使用更保守的参数重新加载...")
 			
 			try:
-				# 使用更保守的参数重试
-				self.llm = Llama(
-					model_path=self.model_path,
-					n_ctx=1024,  # 进一步减少上下文长度
-					n_threads=1,  # 单线程
-					n_batch=256,  # 减少批处理大小
-					verbose=False,
-					use_mmap=False,  # 禁用内存映射
-					use_mlock=False,
-					seed=-1
+				# 使用更保守的参数重试；未启用 mmap 时权重无法共享，只保留一个槽位
+				self._pool = ContextPool.build(
+					lambda: Llama(
+						model_path=self.model_path,
+						n_ctx=1024,  # 进一步减少上下文长度
+						n_threads=1,  # 单线程
+						n_batch=256,  # 减少批处理大小
+						verbose=False,
+						use_mmap=False,  # 禁用内存映射
+						use_mlock=False,
+						seed=-1
+					),
+					size=1,
+					n_threads=1,
+					n_ctx=1024
 				)
 				self._model_loaded = True
 				self._error_message = ""
@@ -78,49 +173,146 @@ class LocalGGUFClient:
 				print("本地模型功能不可用，将使用云端模型作为备选")
 				self._model_loaded = False
 	
+	def _init_batcher(self) -> None:
+		"""启用连续批处理时，在已加载的模型上创建多序列上下文"""
+		if not settings.local_batching:
+			return
+		try:
+			self._batcher = BatchScheduler(
+				self._pool.slots[0].llm,
+				max_batch=settings.local_batch_max,
+				window=settings.local_batch_window_ms / 1000,
+				seq_ctx=settings.local_batch_seq_ctx,
+				n_batch=settings.local_n_batch,
+				n_threads=settings.local_batch_threads,
+				max_tokens=settings.local_max_tokens
+			)
+			print(f"已启用连续批处理，最大批大小 {settings.local_batch_max}")
+		except Exception as e:
+			self._batcher = None
+			print(f"警告: 连续批处理不可用，使用上下文池逐个推理: {e}")
+	
 	def get_model_info(self) -> Dict[str, Any]:
 		"""获取模型信息"""
 		return {
 			"name": "qwen2-1.5b-instruct (GGUF)",
 			"path": self.model_path,
-			"status": "loaded" if self._model_loaded else "failed",
+			"status": "loaded" if self._model_loaded else ("failed" if self._state == "failed" else "loading"),
+			"state": self._state,
+			"load_seconds": round(self._load_seconds, 2) if self._load_seconds is not None else None,
 			"available": self._model_loaded,
 			"error": self._error_message if not self._model_loaded else "",
-			"llama_available": LLAMA_AVAILABLE
+			"llama_available": LLAMA_AVAILABLE,
+			"queue": self._queue.stats(),
+			"context_pool": self._pool.stats() if self._pool else None,
+			"batching": self._batcher.stats() if self._batcher else None,
+			"kv_prefix_cache": self._prefix_states.stats()
 		}
 	
 	def reload_model(self) -> bool:
 		"""重新加载模型"""
+		if self._state in ("loading", "warming"):
+			# 后台加载尚未结束
+			return False
 		try:
-			if self.llm:
-				del self.llm
-			self._init_model()
+			with self._reload_lock:
+				if self._batcher:
+					self._batcher.stop()
+					self._batcher = None
+				if self._pool:
+					# 等待进行中的推理结束后再释放所有上下文
+					with self._pool.exclusive():
+						pass
+					self._pool = None
+					self._model_loaded = False
+				self._prefix_states.clear()
+				self._state = "loading"
+				self._init_model()
+				if self._model_loaded:
+					self._state = "warming"
+					self._warm_up()
+				self._state = "ready" if self._model_loaded else "failed"
+				self._ready_event.set()
 			return self._model_loaded
 		except Exception as e:
 			self._error_message = f"重新加载模型失败: {e}"
 			return False
 	
+	def _sql_system_message(self, table_schema: str) -> Dict[str, str]:
+		"""SQL 生成的固定前缀（指令 + 表结构），不含问题，保证跨请求可复用 KV 缓存"""
+		return {"role": "system", "content": f"""你是一个专业的 SQL 生成助手。根据用户的问题和数据库表结构，生成准确的 SQL 查询语句。
+
+数据库表结构：
+{table_schema}
+
+重要：请只返回 SQL 语句，不要包含任何解释、注释或其他文字。如果问题与数据库表结构不符，请返回一个语法正确但返回空结果的查询。"""}
+	
+	def _acquire_slot(self):
+		"""借出一个空闲推理槽位（全部占用时阻塞）"""
+		with self._reload_lock:
+			pool = self._pool
+		if pool is None:
+			raise RuntimeError(f"本地模型未加载: {self._error_message}")
+		return pool.acquire()
+	
+	def _ensure_schema_prefix(self, slot: LlamaSlot, system_message: Dict[str, str]) -> None:
+		"""确保槽位上下文开头是该表结构前缀的 KV 状态（需已借出该槽位）"""
+		if not self._prefix_states.enabled:
+			return
+		key = prefix_key(self.model_path, slot.llm.n_ctx(), system_message["content"])
+		if slot.ctx_prefix == key:
+			return
+		try:
+			state = self._prefix_states.get(key)
+			if state is not None:
+				slot.llm.load_state(state)
+			else:
+				# 首次遇到该表结构：只评估前缀并保存快照
+				slot.llm.reset()
+				slot.llm.create_chat_completion(
+					[system_message, {"role": "user", "content": ""}],
+					max_tokens=1
+				)
+				self._prefix_states.put(key, slot.llm.save_state())
+			slot.ctx_prefix = key
+		except Exception as e:
+			slot.ctx_prefix = None
+			print(f"警告: 表结构前缀 KV 缓存不可用，将完整评估提示词: {e}")
+	
+	def invalidate_prefix_cache(self) -> None:
+		"""清除所有表结构前缀快照"""
+		self._prefix_states.clear()
+		if self._pool:
+			with self._pool.exclusive() as slots:
+				for slot in slots:
+					slot.ctx_prefix = None
+	
 	def generate_sql(self, question: str, table_schema: str) -> str:
 		"""生成 SQL 查询"""
 		if not self._model_loaded:
 			raise RuntimeError(f"本地模型未加载: {self._error_message}")
 		
-		prompt = f"""你是一个专业的 SQL 生成助手。根据用户的问题和数据库表结构，生成准确的 SQL 查询语句。
-
-数据库表结构：
-{table_schema}
-
-用户问题：{question}
-
-重要：请只返回 SQL 语句，不要包含任何解释、注释或其他文字。如果问题与数据库表结构不符，请返回一个语法正确但返回空结果的查询。
+		system_message = self._sql_system_message(table_schema)
+		prompt = f"""用户问题：{question}
 
 SQL:"""
 		
+		messages = [system_message, {"role": "user", "content": prompt}]
+		
 		try:
-			response = self.llm.create_chat_completion([
-				{"role": "user", "content": prompt}
-			])
-			sql = response['choices'][0]['message']['content'].strip()
+			if self._batcher:
+				# 与其他并发请求合批解码
+				sql = self._batcher.generate(messages).strip()
+			else:
+				with self._acquire_slot() as slot:
+					if schema_registry.is_full_prompt(table_schema):
+						# 载入表结构前缀快照后，llama.cpp 只需评估问题部分
+						self._ensure_schema_prefix(slot, system_message)
+					else:
+						# 裁剪后的表结构随角色与问题变化，不保存快照，以免挤掉完整表结构的快照
+						slot.ctx_prefix = None
+					response = slot.llm.create_chat_completion(messages)
+				sql = response['choices'][0]['message']['content'].strip()
 			# 清理可能的 markdown 标记
 			if sql.startswith('```sql'):
 				sql = sql[7:]
@@ -130,12 +322,15 @@ SQL:"""
 		except Exception as e:
 			raise RuntimeError(f"生成 SQL 失败: {e}")
 	
-	def format_answer(self, question: str, sql_result: str) -> str:
-		"""格式化查询结果为自然语言答案"""
-		if not self._model_loaded:
-			raise RuntimeError(f"本地模型未加载: {self._error_message}")
-		
-		prompt = f"""你是一个专业的数据分析师。请根据用户的原始问题和 SQL 查询结果，生成一个清晰、易懂的自然语言答案。
+	def count_tokens(self, text: str) -> int:
+		"""用本地模型的分词器计算 token 数（模型未加载时粗略估计）"""
+		pool = self._pool
+		if not self._model_loaded or pool is None:
+			return approx_token_count(text)
+		return len(pool.slots[0].llm.tokenize(text.encode("utf-8"), add_bos=False))
+	
+	def _answer_prompt(self, question: str, sql_result: str) -> str:
+		return f"""你是一个专业的数据分析师。请根据用户的原始问题和 SQL 查询结果，生成一个清晰、易懂的自然语言答案。
 
 用户问题：{question}
 
@@ -144,19 +339,108 @@ SQL:"""
 请生成一个简洁、专业的答案，直接回答用户的问题。如果结果为空，请说明没有找到相关数据。
 
 答案："""
+	
+	def format_answer(self, question: str, sql_result: str) -> str:
+		"""格式化查询结果为自然语言答案"""
+		if not self._model_loaded:
+			raise RuntimeError(f"本地模型未加载: {self._error_message}")
+		
+		prompt = self._answer_prompt(question, sql_result)
 		
 		try:
-			response = self.llm.create_chat_completion([
-				{"role": "user", "content": prompt}
-			])
+			if self._batcher:
+				return self._batcher.generate([{"role": "user", "content": prompt}]).strip()
+			with self._acquire_slot() as slot:
+				# 该提示词会覆盖上下文中的表结构前缀
+				slot.ctx_prefix = None
+				response = slot.llm.create_chat_completion([
+					{"role": "user", "content": prompt}
+				])
 			return response['choices'][0]['message']['content'].strip()
 		except Exception as e:
 			# 如果格式化失败，返回原始结果
 			return f"查询结果：{sql_result}"
 	
+	def stream_answer(self, question: str, sql_result: str) -> Iterator[str]:
+		"""流式格式化答案，逐段产出文本"""
+		if not self._model_loaded:
+			raise RuntimeError(f"本地模型未加载: {self._error_message}")
+		
+		messages = [{"role": "user", "content": self._answer_prompt(question, sql_result)}]
+		if self._batcher:
+			yield from self._batcher.stream(messages)
+			return
+		with self._acquire_slot() as slot:
+			slot.ctx_prefix = None
+			for chunk in slot.llm.create_chat_completion(
+				messages,
+				stream=True
+			):
+				delta = chunk['choices'][0].get('delta', {}).get('content')
+				if delta:
+					yield delta
+	
+	async def _submit_tracked(self, health_name: str, func, *args, validate=None) -> Any:
+		"""经推理队列执行并记录健康状态（延迟、错误、超时、无法解析的输出）"""
+		start = time.monotonic()
+		try:
+			result = await asyncio.wait_for(self._queue.submit(func, *args), timeout=settings.local_timeout)
+		except InferenceQueueFull:
+			# 排队背压不计为模型故障
+			raise
+		except asyncio.TimeoutError:
+			model_health.record_failure(health_name, f"推理超时 ({settings.local_timeout}s)", timeout=True)
+			raise RuntimeError(f"本地模型推理超时 ({settings.local_timeout}s)")
+		except Exception as e:
+			model_health.record_failure(health_name, str(e))
+			raise
+		if validate is not None and not validate(result):
+			model_health.record_failure(health_name, f"无法解析的输出: {str(result)[:80]}", invalid_output=True)
+		else:
+			model_health.record_success(health_name, time.monotonic() - start)
+		return result
+	
+	async def agenerate_sql(self, question: str, table_schema: str) -> str:
+		"""异步生成 SQL：经推理队列在工作线程中执行，不阻塞事件循环"""
+		if not self._model_loaded:
+			raise RuntimeError(f"本地模型未加载: {self._error_message}")
+		return await self._submit_tracked(HEALTH_NAME_SQL, self.generate_sql, question, table_schema, validate=looks_like_query)
+	
+	async def aformat_answer(self, question: str, sql_result: str) -> str:
+		"""异步格式化答案：经推理队列在工作线程中执行，不阻塞事件循环"""
+		if not self._model_loaded:
+			raise RuntimeError(f"本地模型未加载: {self._error_message}")
+		return await self._submit_tracked(HEALTH_NAME_ANSWER, self.format_answer, question, sql_result)
+	
+	def probe(self) -> None:
+		"""健康探测：生成一个 token"""
+		with self._acquire_slot() as slot:
+			slot.ctx_prefix = None
+			slot.llm.create_chat_completion([{"role": "user", "content": "SELECT 1"}], max_tokens=1)
+	
+	async def aprobe(self, name: str = None) -> None:
+		"""健康探测（异步，经推理队列）"""
+		if not self._model_loaded:
+			raise RuntimeError(f"本地模型未加载: {self._error_message}")
+		await self._queue.submit(self.probe)
+	
+	async def astream_answer(self, question: str, sql_result: str) -> AsyncIterator[str]:
+		"""异步流式格式化答案：生成在推理队列的工作线程中进行，文本片段逐段返回"""
+		if not self._model_loaded:
+			raise RuntimeError(f"本地模型未加载: {self._error_message}")
+		async for chunk in self._queue.stream(self.stream_answer, question, sql_result):
+			yield chunk
+	
+	def shutdown(self) -> None:
+		"""关闭推理队列与批处理调度器"""
+		self._queue.shutdown()
+		if self._batcher:
+			self._batcher.stop()
+			self._batcher = None
+	
 	def is_available(self) -> bool:
-		"""检查本地模型是否可用"""
-		return self._model_loaded
+		"""检查本地模型是否已加载并完成预热"""
+		return self._model_loaded and self._state == "ready"
 	
 	def get_error_message(self) -> str:
 		"""获取错误信息"""
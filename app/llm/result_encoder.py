@@ -0,0 +1,138 @@
+import datetime
+import decimal
+import re
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+try:
+	import tiktoken
+	TIKTOKEN_AVAILABLE = True
+except ImportError:
+	TIKTOKEN_AVAILABLE = False
+
+
+# 文本 -> token 数
+TokenCounter = Callable[[str], int]
+
+# 单元格最长字符数，超出部分截断
+MAX_CELL_CHARS = 80
+
+CJK = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]")
+
+
+def approx_token_count(text: str) -> int:
+	"""无分词器时的粗略估计：中日韩字符按 1 token，其余按约 4 字符 1 token"""
+	cjk = len(CJK.findall(text))
+	return cjk + (len(text) - cjk + 3) // 4
+
+
+_encodings: Dict[str, Any] = {}
+
+
+def tiktoken_counter(model: Optional[str] = None) -> TokenCounter:
+	"""云端模型的 token 计数：安装了 tiktoken 时按模型选择编码（未知模型使用 cl100k_base），否则粗略估计"""
+	if not TIKTOKEN_AVAILABLE:
+		return approx_token_count
+	key = model or ""
+	encoding = _encodings.get(key)
+	if encoding is None:
+		try:
+			encoding = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding("cl100k_base")
+		except KeyError:
+			encoding = tiktoken.get_encoding("cl100k_base")
+		_encodings[key] = encoding
+	return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def format_cell(value: Any) -> str:
+	"""单元格文本：去掉换行与分隔符，过长截断"""
+	if value is None:
+		return "NULL"
+	if isinstance(value, float):
+		text = f"{value:.6g}"
+	elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+		text = value.isoformat(sep=" ") if isinstance(value, datetime.datetime) else value.isoformat()
+	elif isinstance(value, bytes):
+		text = f"<{len(value)} bytes>"
+	else:
+		text = str(value)
+	text = text.replace("\r", " ").replace("\n", " ").replace("|", "/")
+	return text if len(text) <= MAX_CELL_CHARS else text[:MAX_CELL_CHARS - 1] + "…"
+
+
+def _is_number(value: Any) -> bool:
+	return isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool)
+
+
+def numeric_summary(columns: Sequence[str], rows: Sequence[Sequence[Any]]) -> List[str]:
+	"""数值列的 count/min/max/sum 统计（忽略 NULL）"""
+	lines = []
+	for i, column in enumerate(columns):
+		values = [row[i] for row in rows if row[i] is not None]
+		if not values or not all(_is_number(v) for v in values):
+			continue
+		try:
+			total = sum(values)
+		except TypeError:
+			# 同一列混合 float 与 Decimal
+			total = sum(float(v) for v in values)
+		lines.append(
+			f"{column}: count={len(values)} min={format_cell(min(values))} max={format_cell(max(values))} sum={format_cell(total)}"
+		)
+	return lines
+
+
+def _sample_indices(total: int, k: int) -> List[int]:
+	"""均匀抽样 k 行（包含首行与末行）"""
+	if k >= total:
+		return list(range(total))
+	if k <= 0:
+		return []
+	if k == 1:
+		return [0]
+	return sorted({round(i * (total - 1) / (k - 1)) for i in range(k)})
+
+
+def encode_result(
+	columns: Sequence[str],
+	rows: Sequence[Sequence[Any]],
+	truncated: bool = False,
+	token_budget: int = 1000,
+	count_tokens: TokenCounter = approx_token_count
+) -> str:
+	"""把查询结果编码为紧凑的列式文本：表头一次、每行一条以 | 分隔；
+	超出 token 预算时附带数值列统计，并均匀抽样尽可能多的行"""
+	if not rows:
+		return "查询结果为空"
+
+	total = len(rows)
+	scope = f"前 {total} 条" if truncated else f"全部 {total} 条"
+	head = f"共 {total} 条记录" + ("（结果超过行数上限，已截断）" if truncated else "")
+	header = "列: " + " | ".join(str(c) for c in columns)
+	lines = [" | ".join(format_cell(v) for v in row) for row in rows]
+
+	def render(indices: List[int], summary: List[str]) -> str:
+		parts = [head, header]
+		parts.extend(lines[i] for i in indices)
+		if len(indices) < total:
+			parts.append(f"（以上为均匀抽样的 {len(indices)} 条，其余 {total - len(indices)} 条已省略）")
+		if summary:
+			parts.append(f"数值列统计（{scope}）:")
+			parts.extend(summary)
+		return "\n".join(parts)
+
+	full = render(list(range(total)), [])
+	if count_tokens(full) <= token_budget:
+		return full
+
+	summary = numeric_summary(columns, rows)
+	# 二分查找预算内可容纳的最多抽样行数
+	lo, hi = 0, total - 1
+	best = render([], summary)
+	while lo <= hi:
+		mid = (lo + hi) // 2
+		text = render(_sample_indices(total, mid), summary)
+		if count_tokens(text) <= token_budget:
+			best, lo = text, mid + 1
+		else:
+			hi = mid - 1
+	return best
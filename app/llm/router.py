@@ -1,146 +1,221 @@
-from typing import Literal, Dict, Any
+import json
+import os
+import threading
+import time
+from typing import Literal, Dict, Any, List, NamedTuple, Optional
+from starlette.concurrency import run_in_threadpool
 from app.config import settings
 from app.db.manager import manager
+from app.db.schema_registry import schema_registry
+from app.llm.keyword_matcher import KeywordMatcher
+from app.llm.intent_classifier import IntentClassifier, load_gguf_embedder
 
 
 QueryPath = Literal["text_to_sql", "general_qa", "tool_weather"]
 
+# 默认关键词集合（可通过 ROUTER_KEYWORDS_FILE 覆盖）
+DEFAULT_KEYWORDS: Dict[str, List[str]] = {
+	# 仓储数据库关键词
+	"warehouse": [
+		"库存", "商品", "产品", "仓库", "员工", "出入库", "供应商", "价格",
+		"products", "inventory", "warehouse_staff", "shipments", "supplier", "price"
+	],
+	# 医疗数据库关键词
+	"hospital": [
+		"医生", "病人", "患者", "诊疗", "诊断", "处方", "科室", "职称",
+		"doctors", "patients", "medical_records", "department", "title"
+	],
+	# 通用数据库查询关键词
+	"db_query": ["查询", "select", "记录", "信息"],
+	# 天气查询关键词
+	"weather": ["天气", "weather", "温度", "湿度", "降水"]
+}
 
-class ModelRouter:
-	def __init__(self):
-		self._table_schemas = {}
-		self._init_table_schemas()
-	
-	def _init_table_schemas(self):
-		"""初始化数据库表结构信息"""
-		# 医疗数据库表结构
-		hospital_schema = """
-医疗数据库 (hospital_db) 表结构：
+# 关键词集合 -> 查询路径，按优先级排列
+PATH_PRIORITY = (
+	("warehouse", "text_to_sql"),
+	("hospital", "text_to_sql"),
+	("db_query", "text_to_sql"),
+	("weather", "tool_weather"),
+)
 
-1. doctors (医生信息表)
-   - doctor_id: VARCHAR(10) - 医生ID (主键)
-   - doctor_name: VARCHAR(50) - 医生姓名
-   - department: VARCHAR(50) - 所属科室
-   - title: VARCHAR(50) - 职称/角色
 
-2. patients (病人信息表)
-   - patient_id: VARCHAR(10) - 病人ID (主键)
-   - patient_name: VARCHAR(50) - 病人姓名
-   - gender: VARCHAR(10) - 性别
-   - birth_date: DATE - 出生日期
-   - contact_number: VARCHAR(20) - 联系电话
-   - primary_doctor_id: VARCHAR(10) - 主治医生ID (外键关联doctors.doctor_id)
+class RouteDecision(NamedTuple):
+	"""路由结果：查询路径、建议数据库（warehouse / hospital / unknown）与各集合命中的关键词
 
-3. medical_records (诊疗记录表)
-   - record_id: INT - 记录ID (主键，自增)
-   - patient_id: VARCHAR(10) - 病人ID (外键关联patients.patient_id)
-   - doctor_id: VARCHAR(10) - 看诊医生ID (外键关联doctors.doctor_id)
-   - visit_date: DATETIME - 就诊日期
-   - diagnosis: TEXT - 诊断结果
-   - prescription: TEXT - 处方
-"""
-		
-		# 仓储数据库表结构
-		warehouse_schema = """
-仓储数据库 (warehouse_db) 表结构：
+	source 为 intent 表示路径由嵌入分类器给出，keyword 表示由关键词给出（含分类器置信度不足时的兜底）
+	"""
+	path: QueryPath
+	database: str
+	keywords: Dict[str, List[str]]
+	source: str = "keyword"
 
-1. warehouse_staff (仓库员工表)
-   - staff_id: VARCHAR(10) - 员工ID (主键)
-   - staff_name: VARCHAR(50) - 员工姓名
-   - role: VARCHAR(50) - 角色/岗位 (Manager/Operator)
 
-2. products (商品信息表)
-   - product_id: VARCHAR(10) - 商品ID (主键)
-   - product_name: VARCHAR(100) - 商品名称
-   - description: TEXT - 商品描述
-   - price: DECIMAL(10,2) - 单价
-   - supplier: VARCHAR(100) - 供应商
-
-3. inventory (库存表)
-   - inventory_id: INT - 库存记录ID (主键，自增)
-   - product_id: VARCHAR(10) - 商品ID (外键关联products.product_id)
-   - warehouse_location: VARCHAR(20) - 仓库位置
-   - quantity: INT - 库存数量
-   - last_updated: TIMESTAMP - 最后更新时间
-
-4. shipments (出入库记录表)
-   - shipment_id: INT - 记录ID (主键，自增)
-   - product_id: VARCHAR(10) - 商品ID (外键关联products.product_id)
-   - staff_id: VARCHAR(10) - 操作员工ID (外键关联warehouse_staff.staff_id)
-   - quantity_change: INT - 数量变化 (正数入库, 负数出库)
-   - record_time: DATETIME - 记录时间
-   - type: VARCHAR(20) - 类型 (INBOUND/OUTBOUND)
-"""
-		
-		self._table_schemas = {
-			"hospital": hospital_schema,
-			"warehouse": warehouse_schema
+class ModelRouter:
+	def __init__(self):
+		self._next_check = 0.0
+		self._keywords_mtime = None
+		# 嵌入意图分类器（ROUTER_MODE=intent 时在后台构建，就绪前使用关键词路由）
+		self._intent: Optional[IntentClassifier] = None
+		self._intent_state = "disabled"
+		self._intent_error = ""
+		try:
+			self.reload_keywords()
+		except Exception as e:
+			print(f"警告: 路由关键词加载失败，使用默认关键词: {e}")
+			self._keyword_sets = {label: list(keywords) for label, keywords in DEFAULT_KEYWORDS.items()}
+			self._matcher = KeywordMatcher(self._keyword_sets)
+	
+	def _load_keyword_sets(self) -> Dict[str, List[str]]:
+		"""默认关键词集合，配置了 ROUTER_KEYWORDS_FILE 时用文件中的同名集合覆盖"""
+		keyword_sets = {label: list(keywords) for label, keywords in DEFAULT_KEYWORDS.items()}
+		path = settings.router_keywords_file
+		if path:
+			with open(path, "r", encoding="utf-8") as f:
+				overrides = json.load(f)
+			for label, keywords in overrides.items():
+				if not isinstance(keywords, list):
+					raise ValueError(f"关键词集合 {label} 必须是列表")
+				keyword_sets[label] = [str(k) for k in keywords]
+		return keyword_sets
+	
+	def reload_keywords(self) -> Dict[str, Any]:
+		"""重新加载关键词并重建自动机；新自动机构建完成后整体替换，加载失败时保留原自动机"""
+		keyword_sets = self._load_keyword_sets()
+		self._matcher = KeywordMatcher(keyword_sets)
+		self._keyword_sets = keyword_sets
+		self._keywords_mtime = self._file_mtime()
+		return self.keyword_stats()
+	
+	def _file_mtime(self) -> Optional[float]:
+		path = settings.router_keywords_file
+		if not path:
+			return None
+		try:
+			return os.path.getmtime(path)
+		except OSError:
+			return None
+	
+	def _maybe_reload(self) -> None:
+		"""按间隔检查关键词文件是否更新，更新则热加载"""
+		if not settings.router_keywords_file:
+			return
+		now = time.monotonic()
+		if now < self._next_check:
+			return
+		self._next_check = now + settings.router_reload_interval
+		mtime = self._file_mtime()
+		if mtime is None or mtime == self._keywords_mtime:
+			return
+		try:
+			self.reload_keywords()
+			print(f"路由关键词已重新加载: {settings.router_keywords_file}")
+		except Exception as e:
+			# 避免对同一个损坏的文件反复报错
+			self._keywords_mtime = mtime
+			print(f"警告: 路由关键词加载失败，继续使用原关键词: {e}")
+	
+	def keyword_stats(self) -> Dict[str, Any]:
+		"""获取关键词集合与自动机规模"""
+		return {
+			"source": settings.router_keywords_file or "default",
+			"sets": {label: len(keywords) for label, keywords in self._keyword_sets.items()},
+			"keywords": self._matcher.keyword_count,
+			"states": self._matcher.state_count,
+			"mode": settings.router_mode,
+			"intent": {
+				"state": self._intent_state,
+				"error": self._intent_error,
+				**(self._intent.stats() if self._intent else {})
+			}
 		}
 	
-	def decide(self, question: str) -> QueryPath:
-		"""决定查询路径"""
-		q = question.lower().strip()
-		
-		# 医疗数据库关键词
-		hospital_keywords = [
-			"医生", "病人", "患者", "诊疗", "诊断", "处方", "科室", "职称",
-			"doctors", "patients", "medical_records", "department", "title"
-		]
-		
-		# 仓储数据库关键词
-		warehouse_keywords = [
-			"库存", "商品", "产品", "仓库", "员工", "出入库", "供应商", "价格",
-			"products", "inventory", "warehouse_staff", "shipments", "supplier", "price"
-		]
+	def start_intent_classifier(self) -> None:
+		"""ROUTER_MODE=intent 时在后台线程中加载嵌入模型并计算（或读取缓存的）质心"""
+		if settings.router_mode != "intent" or self._intent_state != "disabled":
+			return
+		self._intent_state = "loading"
+		threading.Thread(target=self._init_intent, name="intent-classifier", daemon=True).start()
+	
+	def _init_intent(self) -> None:
+		model_path = settings.intent_embedding_model or settings.gguf_model_path
+		try:
+			embedder = load_gguf_embedder(model_path, n_threads=settings.local_threads_per_slot)
+			stat = os.stat(model_path)
+			self._intent = IntentClassifier(
+				embedder,
+				model_id=f"{os.path.abspath(model_path)}:{stat.st_size}:{int(stat.st_mtime)}",
+				threshold=settings.intent_threshold,
+				margin=settings.intent_margin,
+				cache_dir=settings.intent_cache_dir,
+				embed_cache_size=settings.intent_embed_cache_size
+			)
+			self._intent_state = "ready"
+			print("意图分类器已就绪")
+		except Exception as e:
+			self._intent_state = "failed"
+			self._intent_error = str(e)
+			print(f"警告: 意图分类器不可用，使用关键词路由: {e}")
+	
+	def route(self, question: str) -> RouteDecision:
+		"""得出查询路径、建议数据库与命中的关键词；分类器就绪时优先采用其高置信度结果"""
+		decision = self._keyword_route(question)
+		if self._intent is None:
+			return decision
+		try:
+			intent = self._intent.classify(question)
+		except Exception as e:
+			print(f"警告: 意图分类失败，使用关键词路由: {e}")
+			return decision
+		if intent.path is None:
+			return decision
+		return RouteDecision(
+			intent.path,
+			intent.database or decision.database,
+			decision.keywords,
+			"intent"
+		)
+	
+	async def aroute(self, question: str) -> RouteDecision:
+		"""异步路由：启用分类器时在线程池中计算嵌入，避免阻塞事件循环"""
+		if self._intent is None:
+			return self.route(question)
+		return await run_in_threadpool(self.route, question)
+	
+	def _keyword_route(self, question: str) -> RouteDecision:
+		"""一次扫描问题文本，得出查询路径、建议数据库与命中的关键词"""
+		self._maybe_reload()
+		matches = self._matcher.find(question.strip())
 		
-		# 通用数据库查询关键词
-		db_keywords = ["查询", "select", "记录", "信息"]
+		# 优先级：仓储 > 医疗 > 通用查询 > 天气 > 通用问答
+		path: QueryPath = "general_qa"
+		for label, label_path in PATH_PRIORITY:
+			if label in matches:
+				path = label_path
+				break
 		
-		# 天气查询关键词
-		weather_keywords = ["天气", "weather", "温度", "湿度", "降水"]
+		database = "unknown"  # 无法确定，使用当前数据库
+		for label in ("warehouse", "hospital"):
+			if label in matches:
+				database = label
+				break
 		
-		# 检查是否需要切换数据库
-		if any(k in q for k in warehouse_keywords):
-			# 仓储相关查询，建议切换到仓储数据库
-			return "text_to_sql"
-		elif any(k in q for k in hospital_keywords):
-			# 医疗相关查询，建议切换到医疗数据库
-			return "text_to_sql"
-		elif any(k in q for k in db_keywords):
-			# 通用查询，使用当前数据库
-			return "text_to_sql"
-		elif any(k in q for k in weather_keywords):
-			return "tool_weather"
-		else:
-			return "general_qa"
+		return RouteDecision(path, database, matches)
+	
+	def decide(self, question: str) -> QueryPath:
+		"""决定查询路径"""
+		return self.route(question).path
 	
 	def suggest_database(self, question: str) -> str:
 		"""根据问题内容建议合适的数据库"""
-		q = question.lower().strip()
-		
-		# 医疗数据库关键词
-		hospital_keywords = [
-			"医生", "病人", "患者", "诊疗", "诊断", "处方", "科室", "职称",
-			"doctors", "patients", "medical_records", "department", "title"
-		]
-		
-		# 仓储数据库关键词
-		warehouse_keywords = [
-			"库存", "商品", "产品", "仓库", "员工", "出入库", "供应商", "价格",
-			"products", "inventory", "warehouse_staff", "shipments", "supplier", "price"
-		]
-		
-		if any(k in q for k in warehouse_keywords):
-			return "warehouse"
-		elif any(k in q for k in hospital_keywords):
-			return "hospital"
-		else:
-			return "unknown"  # 无法确定，使用当前数据库
+		return self.route(question).database
 	
-	def get_table_schema(self) -> str:
-		"""获取当前激活数据库的表结构"""
-		active_db = manager.active
-		return self._table_schemas.get(active_db, "未知数据库")
+	def get_table_schema(self, database: Optional[str] = None) -> str:
+		"""获取数据库（默认当前请求的目标数据库）当前版本的表结构提示词"""
+		try:
+			return schema_registry.prompt(database or manager.active)
+		except KeyError:
+			return "未知数据库"
 	
 	def local_model_name(self) -> str:
 		return "qwen2-1.5b-instruct (GGUF)"
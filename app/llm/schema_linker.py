@@ -0,0 +1,122 @@
+import re
+from typing import Dict, FrozenSet, NamedTuple, Optional, Set, Tuple
+
+from app.cache.lru import TTLCache
+from app.config import settings
+from app.db.schema_registry import DatabaseSchema, SchemaSnapshot, SchemaTable, render_schema
+from app.security.rbac import policy_engine
+
+
+# 说明文字中不参与匹配的部分：括号内容与 ID
+COMMENT_NOISE = re.compile(r"\(.*?\)|（.*?）|ID", re.IGNORECASE)
+CJK_RUN = re.compile(r"[\u4e00-\u9fff]+")
+TABLE_SUFFIXES = ("信息表", "记录表", "表")
+# 过于常见、不能说明问题涉及哪张表的词
+STOP_TERMS = frozenset(("记录", "信息", "数据", "时间", "日期", "名称", "姓名", "编号", "结果", "类型", "仓库"))
+
+
+class LinkedSchema(NamedTuple):
+	"""裁剪后的表结构提示词及其包含的表（未启用裁剪或无法解析时为 None）；pruned 为 False 表示与完整表结构相同"""
+	text: str
+	tables: Optional[Tuple[str, ...]]
+	pruned: bool
+
+
+def _bigrams(text: str) -> Set[str]:
+	terms = set()
+	for run in CJK_RUN.findall(COMMENT_NOISE.sub("", text)):
+		terms.update(run[i:i + 2] for i in range(len(run) - 1))
+	return terms - STOP_TERMS
+
+
+def table_terms(table: SchemaTable) -> FrozenSet[str]:
+	"""表的匹配词：表名（含单数形式）、表说明与非外键列说明中的中文二元词、较长的列名"""
+	terms = {table.name}
+	if table.name.endswith("s") and len(table.name) > 4:
+		terms.add(table.name[:-1])
+	comment = table.comment
+	for suffix in TABLE_SUFFIXES:
+		if comment.endswith(suffix) and len(comment) > len(suffix):
+			comment = comment[:-len(suffix)]
+			break
+	terms |= _bigrams(comment)
+	for column in table.columns:
+		# 外键列的说明描述的是被关联的表
+		if column.references:
+			continue
+		terms |= _bigrams(column.definition.split(" - ", 1)[-1])
+		if len(column.name) >= 5:
+			terms.add(column.name)
+	return frozenset(terms)
+
+
+class SchemaLinker:
+	"""按角色与问题裁剪生成 SQL 时的表结构
+
+	只保留角色可访问的表与列，再与问题相关的表（匹配词命中 + 外键扩展）取交集；
+	结果按 (数据库, 表结构版本, 角色, 表集合) 缓存，表结构版本变化后旧条目不再命中。
+	"""
+
+	def __init__(self, enabled: bool = True, cache_size: int = 256):
+		self.enabled = enabled
+		# 表结构版本 -> 各表匹配词
+		self._terms = TTLCache(max_entries=16, ttl=float("inf"))
+		self._rendered = TTLCache(max_entries=cache_size, ttl=float("inf"))
+
+	def _table_terms(self, snapshot: SchemaSnapshot) -> Dict[str, FrozenSet[str]]:
+		terms = self._terms.get(snapshot.version, record_stats=False)
+		if terms is None:
+			terms = {table.name: table_terms(table) for table in snapshot.schema.tables}
+			self._terms.set(snapshot.version, terms)
+		return terms
+
+	@staticmethod
+	def relevant_tables(schema: DatabaseSchema, terms: Dict[str, FrozenSet[str]], question: str) -> Set[str]:
+		"""问题命中的表，加上它们外键关联的表，必要时加上连接命中表的中间表；都未命中时返回全部表"""
+		q = question.lower()
+		matched = {table.name for table in schema.tables if any(term in q for term in terms[table.name])}
+		if not matched:
+			return {table.name for table in schema.tables}
+		references = {
+			table.name: {column.references for column in table.columns if column.references} for table in schema.tables
+		}
+		relevant = set(matched)
+		for name in matched:
+			relevant |= references[name]
+		# 命中的表之间没有直接外键时，补充同时关联其中两张表的中间表
+		if not any(references[name] & matched for name in matched):
+			relevant.update(name for name, refs in references.items() if len(refs & matched) >= 2)
+		return relevant
+
+	def link(self, snapshot: SchemaSnapshot, role: str, question: str) -> LinkedSchema:
+		"""按角色与问题裁剪注册表中当前版本的表结构"""
+		schema = snapshot.schema
+		if not self.enabled or not schema.tables:
+			return LinkedSchema(snapshot.text, None, False)
+		terms = self._table_terms(snapshot)
+
+		policy = policy_engine.resolve(role)
+		allow = policy.allow_tables if policy else frozenset()
+		hidden = policy.deny_columns if policy else frozenset()
+		visible = [table.name for table in schema.tables if allow is None or table.name in allow]
+
+		relevant = self.relevant_tables(schema, terms, question)
+		# 问题只涉及无权访问的表时保留全部可访问的表，由模型给出空结果查询
+		tables = tuple(name for name in visible if name in relevant) or tuple(visible)
+		all_columns = {column.name for table in schema.tables if table.name in tables for column in table.columns}
+		if len(tables) == len(schema.tables) and hidden.isdisjoint(all_columns):
+			return LinkedSchema(snapshot.text, tables, False)
+
+		key = (snapshot.database, snapshot.version, role.strip().lower(), tables)
+		text = self._rendered.get(key)
+		if text is None:
+			text = render_schema(schema, tables, hidden)
+			self._rendered.set(key, text)
+		return LinkedSchema(text, tables, True)
+
+	def stats(self) -> Dict[str, object]:
+		return {"enabled": self.enabled, "rendered": self._rendered.stats()}
+
+
+# 全局实例
+schema_linker = SchemaLinker(settings.schema_pruning, settings.schema_cache_size)
@@ -1,17 +1,35 @@
-from fastapi import FastAPI, Depends, HTTPException
-from fastapi.responses import ORJSONResponse
+import asyncio
+import json
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+import orjson
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
-from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
 
 from app.api.routes import router as api_router
-from app.db.manager import get_db_session, manager
-from app.schemas.chat import ChatRequest, ChatResponse
+from app.config import settings
+from app.db.manager import DatabaseSelectionMiddleware, manager
+from app.db.schema_registry import schema_registry
+from app.schemas.chat import ChatRequest, ChatResponse, CrossDBRequest, CrossDBResponse, ExpertToolResult
 from app.llm.router import router as model_router
-from app.llm.local_client import local_client
+from app.cache.sql_cache import schema_hash, sql_cache
+from app.llm.local_client import HEALTH_NAME, HEALTH_NAME_SQL, HEALTH_NAME_ANSWER, local_client, looks_like_query
+from app.llm.health import model_health
+from app.llm.inference_queue import InferenceQueueFull
+from app.llm.answer_templates import template_answer
+from app.llm.schema_linker import schema_linker
+from app.llm.result_encoder import encode_result, tiktoken_counter
+from app.db.bounded import FetchResult
+from app.db.federation import FederatedPlan, execute_plan, parse_plan
 from app.llm.cloud_client import cloud_client
 from app.security.rbac import check_sql_permission, get_user_role_by_id
+from app.tools.cross_db_experts import BaseExpertTool, expert_tools
+from app.tools.query_planner import query_planner
 from app.tools.weather import fetch_weather
 
 
@@ -21,6 +39,30 @@ app = FastAPI(title="MCP 智能化问答应用", default_response_class=ORJSONRe
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 app.include_router(api_router, prefix="/api")
+# 每个请求单独选择目标数据库（请求头 / 会话 cookie），不再使用进程内全局切换
+app.add_middleware(DatabaseSelectionMiddleware)
+
+
+@app.on_event("startup")
+async def startup_event():
+	"""在后台加载本地模型、反射表结构，注册模型健康探测并启动后台半开探测"""
+	# 模型加载不阻塞启动：加载与预热完成前 auto 模式使用云端模型
+	local_client.start_loading()
+	model_router.start_intent_classifier()
+	schema_registry.start()
+	model_health.register_probe(HEALTH_NAME, local_client.aprobe)
+	model_health.register_probe("cloud:", cloud_client.aprobe)
+	model_health.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+	"""关闭本地推理队列与云端连接池"""
+	model_health.stop()
+	schema_registry.stop()
+	local_client.shutdown()
+	await cloud_client.aclose()
+	await manager.adispose()
 
 
 @app.get("/")
@@ -37,8 +79,29 @@ async def get_models_status():
 		"cloud_model": {
 			"current": cloud_client.get_current_model(),
 			"available": cloud_client.get_available_models(),
-			"status": "available"  # API易模型通常总是可用的
-		}
+			# API易模型通常总是可用的，熔断打开时标记为 degraded
+			"status": "available" if model_health.state(
+				cloud_client.health_name(cloud_client.get_current_model())
+			) == "closed" else "degraded",
+			"pool": cloud_client.get_pool_stats()
+		},
+		"health": model_health.snapshot()
+	}
+
+
+@app.get("/api/ready")
+async def readiness():
+	"""就绪检查：serving 表示已可处理请求（本地模型未就绪时使用云端），warm 表示本地模型已加载并预热"""
+	local_info = local_client.get_model_info()
+	return {
+		"status": "warm" if local_client.is_available() else "serving",
+		"local_model": {
+			"state": local_info["state"],
+			"warm": local_client.is_available(),
+			"load_seconds": local_info["load_seconds"],
+			"error": local_info["error"]
+		},
+		"database_initialized": manager.initialized
 	}
 
 
@@ -55,8 +118,8 @@ async def get_model_compatibility():
 async def switch_model(model_type: str = None, model_name: str = None):
     """切换模型类型或具体的云端模型"""
     if model_type == "local":
-        # 尝试重新加载本地模型
-        success = local_client.reload_model()
+        # 尝试重新加载本地模型（加载与预热在线程池中进行，不阻塞事件循环）
+        success = await run_in_threadpool(local_client.reload_model)
         return {
             "success": success,
             "model_type": "local",
@@ -78,143 +141,505 @@ async def switch_model(model_type: str = None, model_name: str = None):
 
 
 @app.post("/api/chat", response_model=ChatResponse)
-async def chat(payload: ChatRequest, db: Session = Depends(get_db_session)) -> ChatResponse:
+async def chat(payload: ChatRequest) -> ChatResponse:
 	"""智能问答主接口"""
 	try:
 		# 1. 获取用户角色
-		active_db = manager.active
+		active_db = payload.database or manager.active
 		user_role = payload.role or get_user_role_by_id(payload.user_id, active_db)
 		
-		# 2. 意图识别和路由
-		query_path = model_router.decide(payload.question)
+		# 2. 意图识别和路由（一次扫描得出路径与建议数据库）
+		decision = await model_router.aroute(payload.question)
 		
 		# 3. 根据路径处理
-		if query_path == "text_to_sql":
-			return await _handle_database_query(payload, user_role, active_db, db)
-		elif query_path == "tool_weather":
+		if decision.path == "text_to_sql":
+			return await _handle_database_query(payload, user_role, active_db, decision.database)
+		elif decision.path == "tool_weather":
 			return await _handle_weather_query(payload)
 		else:  # general_qa
 			return await _handle_general_qa(payload)
 			
+	except InferenceQueueFull as e:
+		raise HTTPException(status_code=503, detail=str(e))
 	except Exception as e:
 		raise HTTPException(status_code=500, detail=f"处理请求失败: {str(e)}")
 
 
+@app.post("/api/cross_db", response_model=CrossDBResponse)
+async def cross_db(payload: CrossDBRequest) -> CrossDBResponse:
+	"""跨库查询：各专家工具并发执行（各自借出本库的数据库连接），超时或失败的工具不影响其余结果，最后综合成一个答案
+
+	multi_step=true 时先尝试多步查询（子查询依赖图，上游结果作为参数传给下游），federated=true 时先尝试联邦执行
+	（跨库连接与聚合在进程内完成），失败时再按上述方式分别查询各库。
+	"""
+	started = time.perf_counter()
+	fallback = ""
+	if payload.multi_step or payload.federated:
+		mode = "多步查询" if payload.multi_step else "联邦执行"
+		try:
+			if payload.multi_step:
+				return await _multi_step_cross_db(payload, started)
+			return await _federated_cross_db(payload, started)
+		except InferenceQueueFull as e:
+			raise HTTPException(status_code=503, detail=str(e))
+		except Exception as e:
+			print(f"{mode}失败，改为分别查询各库: {e}")
+			fallback = f"{mode}失败（{e}），改为分别查询各库。"
+	runs = await asyncio.gather(*(_run_expert(tool, payload) for tool in expert_tools))
+	results = [result for result, _ in runs]
+	try:
+		answer, answer_model = await _synthesize_cross_db(payload, results)
+	except InferenceQueueFull as e:
+		raise HTTPException(status_code=503, detail=str(e))
+	except Exception as e:
+		# 综合失败时直接返回各库的结果
+		print(f"跨库答案综合失败: {e}")
+		answer, answer_model = _combine_expert_results(results) or "跨库查询失败", "none"
+	
+	reasoning = "；".join(
+		f"{result.tool_name} {'成功' if result.success else '失败：' + (result.error_message or '')}（{elapsed:.2f} 秒）"
+		for result, elapsed in runs
+	)
+	succeeded = sum(result.success for result in results)
+	return CrossDBResponse(
+		answer=answer,
+		reasoning=f"{fallback}并发查询 {len(results)} 个数据库：{reasoning}",
+		tool_results=results,
+		meta={
+			"elapsed": round(time.perf_counter() - started, 3),
+			"tool_elapsed": {result.tool_name: round(elapsed, 3) for result, elapsed in runs},
+			"succeeded": succeeded,
+			"partial": 0 < succeeded < len(results),
+			"answer_model": answer_model
+		}
+	)
+
+
+_FEDERATED_PLAN_PROMPT = """你是跨库查询规划助手。两个数据库不在同一服务器上，无法在一条 SQL 中连接；请把问题拆成每个库各一条只读 SELECT（源查询），再由执行引擎在内存中连接、过滤、聚合。
+
+{schemas}
+
+用户问题：{question}
+
+只返回一个 JSON 对象，不要任何解释或 markdown，格式如下：
+{{
+  "sources": [{{"alias": "h", "database": "hospital", "sql": "SELECT ..."}}, {{"alias": "w", "database": "warehouse", "sql": "SELECT ..."}}],
+  "joins": [{{"right": "w", "on": [["h.列名", "w.列名"]], "how": "inner"}}],
+  "where": [["w.列名", ">", 10]],
+  "group_by": ["h.列名"],
+  "aggregates": [["count", "*", "结果列名"], ["sum", "w.列名", "结果列名"]],
+  "select": [],
+  "order_by": [["结果列名", "desc"]],
+  "limit": 10
+}}
+
+规则：
+1. database 只能是 hospital 或 warehouse，sql 只能使用该库的表，尽量在源查询中完成本库内的过滤与连接，只选出需要的列；
+2. 除第一个源外每个源在 joins 中连接一次，right 应为行数较少的一侧，how 为 inner 或 left；
+3. 列引用写作 别名.列名；where 的运算符为 = != > >= < <= in "not in" contains "is null" "is not null"，多个条件为 AND；
+4. 聚合函数为 count count_distinct sum avg min max，order_by 可引用聚合结果列名；不需要的字段给空数组或省略。"""
+
+
+def _federated_roles(payload: CrossDBRequest) -> Dict[str, str]:
+	return {tool.database_key: payload.role or get_user_role_by_id(payload.user_id, tool.database_key) for tool in expert_tools}
+
+
+async def _plan_federated(payload: CrossDBRequest, roles: Dict[str, str]) -> FederatedPlan:
+	"""由云端模型根据两个库（按角色与问题裁剪后）的表结构生成联邦执行计划"""
+	schemas = "\n\n".join(
+		schema_linker.link(schema_registry.snapshot(database), role, payload.question).text
+		for database, role in roles.items()
+	)
+	messages = [
+		{"role": "system", "content": "你是跨库查询规划助手，只输出符合要求的 JSON。"},
+		{"role": "user", "content": _FEDERATED_PLAN_PROMPT.format(schemas=schemas, question=payload.question)}
+	]
+	response = await cloud_client.achat_completion(messages, payload.cloud_model)
+	start, end = response.find("{"), response.rfind("}")
+	if start < 0 or end < start:
+		raise ValueError("模型没有返回执行计划")
+	return parse_plan(json.loads(response[start:end + 1]))
+
+
+async def _federated_cross_db(payload: CrossDBRequest, started: float) -> CrossDBResponse:
+	"""联邦执行：生成计划后在线程池中执行（超过 FEDERATION_TIMEOUT 取消），最终的小结果再生成答案"""
+	roles = _federated_roles(payload)
+	plan = await _plan_federated(payload, roles)
+	planned = time.perf_counter()
+	cancel = threading.Event()
+	try:
+		federated = await asyncio.wait_for(
+			run_in_threadpool(
+				execute_plan, plan, roles,
+				max_rows=settings.db_max_rows,
+				scan_max_rows=settings.federation_scan_max_rows,
+				batch_size=settings.db_fetch_batch_size,
+				memory_rows=settings.federation_memory_rows,
+				partitions=settings.federation_partitions,
+				spill_dir=settings.federation_spill_dir,
+				max_groups=settings.federation_max_groups,
+				cancel=cancel
+			),
+			timeout=settings.federation_timeout
+		)
+	except asyncio.TimeoutError:
+		cancel.set()
+		raise RuntimeError(f"执行超时（{settings.federation_timeout:g} 秒）")
+	executed = time.perf_counter()
+
+	answer, answer_model = await _format_answer(payload, federated.result)
+	tool_results = [
+		ExpertToolResult(
+			tool_name=f"federated:{source.alias}",
+			database=source.database,
+			query=source.sql,
+			result=f"读取 {federated.scanned.get(source.alias, 0)} 行",
+			success=True,
+			truncated=source.alias in federated.truncated_sources
+		)
+		for source in plan.sources
+	]
+	steps = [f"{source.alias}@{source.database}" for source in plan.sources]
+	return CrossDBResponse(
+		answer=answer,
+		reasoning=(
+			f"联邦执行：{len(plan.sources)} 个源查询（{', '.join(steps)}）并发读取，"
+			f"进程内连接 {len(plan.joins)} 次后得到 {len(federated.result.rows)} 行结果"
+			+ (
+				f"；源 {', '.join(federated.truncated_sources)} 超过读取上限"
+				f"（{settings.federation_scan_max_rows} 行）被截断，结果不完整"
+				if federated.truncated_sources else ""
+			)
+		),
+		tool_results=tool_results,
+		meta={
+			"mode": "federated",
+			"elapsed": round(time.perf_counter() - started, 3),
+			"plan_elapsed": round(planned - started, 3),
+			"execute_elapsed": round(executed - planned, 3),
+			"plan": plan._asdict(),
+			"scanned": federated.scanned,
+			"spilled_rows": federated.spilled_rows,
+			"row_count": len(federated.result.rows),
+			"truncated": federated.result.truncated,
+			"truncated_sources": federated.truncated_sources,
+			"answer_model": answer_model
+		}
+	)
+
+
+async def _multi_step_cross_db(payload: CrossDBRequest, started: float) -> CrossDBResponse:
+	"""多步查询：计划（命中缓存时不调用规划模型）按依赖关系执行，最后一步（或多个终点步骤）的结果生成答案"""
+	roles = _federated_roles(payload)
+	plan, steps, cached = await query_planner.run(
+		payload.question, roles, payload.cloud_model, settings.cross_db_tool_timeout
+	)
+	executed = time.perf_counter()
+	tool_results = [
+		ExpertToolResult(
+			tool_name=f"step:{result.step.id}",
+			database=result.step.database,
+			query=result.step.sql,
+			result=_cloud_result_text(result.fetched, payload.cloud_model) if result.fetched else "",
+			success=result.error is None,
+			truncated=bool(result.fetched and result.fetched.truncated),
+			error_message=result.error
+		)
+		for result in (steps[step.id] for step in plan.steps)
+	]
+	sinks = [steps[step.id] for step in plan.sinks()]
+	if all(result.error is not None for result in sinks):
+		raise RuntimeError("；".join(f"{result.step.id}: {result.error}" for result in sinks))
+	if len(sinks) == 1:
+		answer, answer_model = await _format_answer(payload, sinks[0].fetched)
+	else:
+		sink_names = {f"step:{result.step.id}" for result in sinks}
+		answer, answer_model = await _synthesize_cross_db(
+			payload, [result for result in tool_results if result.tool_name in sink_names]
+		)
+
+	reasoning = "；".join(
+		f"{result.step.id}@{result.step.database}"
+		+ (f" 依赖 {','.join(result.step.depends_on)}" if result.step.depends_on else "")
+		+ (f" {len(result.fetched.rows)} 行" if result.fetched else f" 失败：{result.error}")
+		+ f"（{result.elapsed:.2f} 秒）"
+		for result in (steps[step.id] for step in plan.steps)
+	)
+	return CrossDBResponse(
+		answer=answer,
+		reasoning=f"多步查询{'（复用缓存的计划）' if cached else ''}：{reasoning}",
+		tool_results=tool_results,
+		meta={
+			"mode": "multi_step",
+			"elapsed": round(time.perf_counter() - started, 3),
+			"plan_cached": cached,
+			"step_elapsed": {step_id: round(result.elapsed, 3) for step_id, result in steps.items()},
+			"execute_elapsed": round(executed - started, 3),
+			"answer_model": answer_model
+		}
+	)
+
+
+async def _run_expert(tool: BaseExpertTool, payload: CrossDBRequest) -> Tuple[ExpertToolResult, float]:
+	"""执行一个专家工具（使用该库的调用者角色做权限校验），超过 CROSS_DB_TOOL_TIMEOUT 按失败处理"""
+	role = payload.role or get_user_role_by_id(payload.user_id, tool.database_key)
+	started = time.perf_counter()
+	try:
+		result = await asyncio.wait_for(
+			tool.run(payload.question, payload.model_type, payload.cloud_model, role),
+			timeout=settings.cross_db_tool_timeout
+		)
+	except asyncio.TimeoutError:
+		# 超时取消模型调用；执行中的查询线程无法取消，完成后自行归还连接
+		result = ExpertToolResult(
+			tool_name=tool.tool_name,
+			database=tool.database_name,
+			query="",
+			result="",
+			success=False,
+			error_message=f"执行超时（{settings.cross_db_tool_timeout:g} 秒）"
+		)
+	except Exception as e:
+		result = ExpertToolResult(
+			tool_name=tool.tool_name,
+			database=tool.database_name,
+			query="",
+			result="",
+			success=False,
+			error_message=str(e)
+		)
+	return result, time.perf_counter() - started
+
+
+def _combine_expert_results(results: List[ExpertToolResult]) -> str:
+	"""把各库的结果拼成一段文本，失败的库注明原因"""
+	parts = []
+	for result in results:
+		if result.success:
+			parts.append(f"【{result.database}】\n{result.result}")
+		else:
+			parts.append(f"【{result.database}】查询失败：{result.error_message}")
+	return "\n\n".join(parts)
+
+
+async def _synthesize_cross_db(payload: CrossDBRequest, results: List[ExpertToolResult]) -> Tuple[str, str]:
+	"""综合各库结果：只有一个库成功时直接使用其答案，多个库成功时再由模型合成，返回 (答案, 使用的模型)"""
+	succeeded = [result for result in results if result.success]
+	if not succeeded:
+		return "跨库查询失败：" + "；".join(f"{r.database}: {r.error_message}" for r in results), "none"
+	if len(succeeded) == 1:
+		answer = succeeded[0].result
+		failed = [result for result in results if not result.success]
+		if failed:
+			answer += "\n\n（" + "；".join(f"{r.database} 查询失败：{r.error_message}" for r in failed) + "）"
+		return answer, "expert"
+	
+	combined = _combine_expert_results(results)
+	if payload.model_type == "local" or (payload.model_type == "auto" and _local_healthy(HEALTH_NAME_ANSWER)):
+		try:
+			return await local_client.aformat_answer(payload.question, combined), "local_gguf"
+		except Exception as e:
+			if payload.model_type == "local":
+				raise
+			print(f"本地模型综合失败，降级到云端模型: {e}")
+	return await _format_answer_with_cloud(payload.question, combined, payload.cloud_model), "cloud_api"
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(payload: ChatRequest) -> StreamingResponse:
+	"""智能问答流式接口（SSE）：逐阶段推送路由、SQL、权限、行数与答案片段"""
+	return StreamingResponse(
+		_chat_events(payload),
+		media_type="text/event-stream",
+		headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+	)
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+	"""编码一条 SSE 事件"""
+	return f"event: {event}\ndata: {orjson.dumps(data, default=str).decode()}\n\n"
+
+
+async def _chat_events(payload: ChatRequest) -> AsyncIterator[str]:
+	"""生成 /api/chat/stream 的事件流"""
+	try:
+		active_db = payload.database or manager.active
+		user_role = payload.role or get_user_role_by_id(payload.user_id, active_db)
+		decision = await model_router.aroute(payload.question)
+		query_path = decision.path
+		yield _sse("route", {
+			"path": query_path,
+			"database": active_db,
+			"role": user_role,
+			"keywords": decision.keywords,
+			"source": decision.source
+		})
+		
+		if query_path == "text_to_sql":
+			meta: Dict[str, Any] = {"role": user_role, "database": active_db}
+			fetched = None
+			async for stage, data in _database_query_stages(payload, user_role, active_db, decision.database):
+				if stage == "suggestion":
+					yield _sse("token", {"text": data["answer"]})
+					yield _sse("done", data["meta"])
+					return
+				if stage == "sql":
+					meta.update({"sql": data["sql"], "sql_model": data["model"], "sql_cache": data["sql_cache"], "sql_policy": data["sql_policy"]})
+					yield _sse("sql", data)
+				elif stage == "rbac":
+					meta["permission"] = data["permission"]
+					yield _sse("rbac", data)
+					if not data["permission"]:
+						yield _sse("token", {"text": f"权限不足：{data['message']}"})
+						yield _sse("done", meta)
+						return
+				elif stage == "rows":
+					meta.update({"result_count": data["count"], "truncated": data["truncated"], "result_cache": data["result_cache"]})
+					fetched = data["result"]
+					yield _sse("rows", {"count": data["count"], "truncated": data["truncated"], "result_cache": data["result_cache"]})
+			chunks = _stream_answer(payload, fetched)
+		elif query_path == "tool_weather":
+			weather_data = await fetch_weather("北京")
+			meta = {"tool": "weather", "data_source": "open-meteo", "model": payload.cloud_model or "default"}
+			chunks = (
+				("cloud_api", chunk)
+				async for chunk in cloud_client.astream_weather_analysis(weather_data, payload.question, payload.cloud_model)
+			)
+		else:  # general_qa
+			meta = {"model": "api易", "type": "general_qa", "specific_model": payload.cloud_model or "default"}
+			chunks = (
+				("cloud_api", chunk)
+				async for chunk in cloud_client.astream_general_qa(payload.question, payload.cloud_model)
+			)
+		
+		async for model_name, chunk in chunks:
+			meta["answer_model"] = model_name
+			yield _sse("token", {"text": chunk})
+		yield _sse("done", meta)
+		
+	except InferenceQueueFull as e:
+		yield _sse("error", {"status": 503, "detail": str(e)})
+	except Exception as e:
+		yield _sse("error", {"status": 500, "detail": f"处理请求失败: {str(e)}"})
+
+
+async def _database_query_stages(
+	payload: ChatRequest,
+	user_role: str,
+	db_type: str,
+	suggested_db: str
+) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+	"""数据库查询的各个阶段，逐阶段产出 (阶段名, 数据)，供普通接口与流式接口共用"""
+	# 1. 检查是否需要切换数据库（suggested_db 来自路由结果）
+	if suggested_db != "unknown" and suggested_db != db_type:
+		# 建议切换到其他数据库
+		yield "suggestion", {
+			"answer": f"您的问题与当前数据库不匹配。建议切换到{suggested_db == 'warehouse' and '仓储' or '医疗'}数据库来查询相关信息。\n\n当前数据库：{db_type == 'warehouse' and '仓储' or '医疗'}数据库\n建议数据库：{suggested_db == 'warehouse' and '仓储' or '医疗'}数据库\n\n请在左侧面板切换数据库后重新提问。",
+			"meta": {
+				"suggestion": f"switch_to_{suggested_db}",
+				"current_db": db_type,
+				"suggested_db": suggested_db,
+				"role": user_role
+			}
+		}
+		return
+	
+	# 2. 获取当前版本的表结构，只保留角色可访问且与问题相关的表与列
+	sql_policy = _sql_policy(payload) if payload.model_type not in ("local", "cloud") else payload.model_type
+	snapshot = schema_registry.snapshot(db_type)
+	linked = schema_linker.link(snapshot, user_role, payload.question)
+	table_schema = linked.text
+	if linked.tables == ():
+		# 角色在当前数据库中没有可访问的表，不再调用模型生成必然被拒绝的 SQL
+		yield "sql", {"sql": "", "model": "none", "sql_cache": "skip", "sql_policy": sql_policy, "schema_tables": []}
+		yield "rbac", {"permission": False, "message": f"角色 '{user_role}' 无权访问当前数据库中的任何表"}
+		return
+	
+	# 3. 生成 SQL（优先命中生成缓存；RBAC 仍对每个调用者执行）
+	schema_version = schema_hash(table_schema)
+	cached = sql_cache.lookup(payload.question, db_type, schema_version, _sql_cache_models(payload))
+	if cached:
+		sql_query, cache_model = cached
+		model_used = cache_model.split(":")[0]
+		sql_cache_status = "hit"
+	else:
+		sql_query, model_used = await _generate_sql(payload, table_schema, user_role, db_type)
+		cache_model = "local_gguf" if model_used == "local_gguf" else _cloud_cache_model(payload)
+		sql_cache.store(payload.question, db_type, schema_version, cache_model, sql_query)
+		sql_cache_status = "miss"
+	yield "sql", {
+		"sql": sql_query,
+		"model": model_used,
+		"sql_cache": sql_cache_status,
+		"sql_policy": sql_policy,
+		"schema_version": snapshot.version,
+		"schema_tables": list(linked.tables) if linked.tables is not None else None
+	}
+	
+	# 4. 权限校验
+	has_permission, permission_msg = check_sql_permission(sql_query, user_role, db_type)
+	yield "rbac", {"permission": has_permission, "message": permission_msg}
+	if not has_permission:
+		return
+	
+	# 5. 执行查询（优先命中结果缓存；仅在此处借出数据库连接，格式化答案前已归还）
+	fetched = await manager.cached_fetch_all(sql_query, db_type)
+	
+	# 6. 结果按答案模型的 token 预算编码，见 _local_result_text / _cloud_result_text
+	yield "rows", {
+		"count": len(fetched.rows),
+		"truncated": fetched.truncated,
+		"result_cache": "hit" if fetched.cache_hit else "miss",
+		"result": fetched
+	}
+
+
 async def _handle_database_query(
 	payload: ChatRequest, 
 	user_role: str, 
-	db_type: str, 
-	db: Session
+	db_type: str,
+	suggested_db: str
 ) -> ChatResponse:
 	"""处理数据库查询"""
 	try:
-		# 1. 检查是否需要切换数据库
-		suggested_db = model_router.suggest_database(payload.question)
-		if suggested_db != "unknown" and suggested_db != db_type:
-			# 建议切换到其他数据库
-			return ChatResponse(
-				answer=f"您的问题与当前数据库不匹配。建议切换到{suggested_db == 'warehouse' and '仓储' or '医疗'}数据库来查询相关信息。\n\n当前数据库：{db_type == 'warehouse' and '仓储' or '医疗'}数据库\n建议数据库：{suggested_db == 'warehouse' and '仓储' or '医疗'}数据库\n\n请在左侧面板切换数据库后重新提问。",
-				meta={
-					"suggestion": f"switch_to_{suggested_db}",
-					"current_db": db_type,
-					"suggested_db": suggested_db,
-					"role": user_role
-				}
-			)
+		stages: Dict[str, Dict[str, Any]] = {}
+		async for stage, data in _database_query_stages(payload, user_role, db_type, suggested_db):
+			stages[stage] = data
 		
-		# 2. 获取表结构
-		table_schema = model_router.get_table_schema()
+		if "suggestion" in stages:
+			return ChatResponse(**stages["suggestion"])
 		
-		# 3. 生成 SQL（根据用户选择或自动选择模型）
-		sql_query = None
-		model_used = "unknown"
-		
-		# 根据用户选择决定使用哪个模型
-		if payload.model_type == "local":
-			# 强制使用本地模型
-			if local_client.is_available():
-				sql_query = local_client.generate_sql(payload.question, table_schema)
-				model_used = "local_gguf"
-			else:
-				raise RuntimeError(f"本地模型不可用: {local_client.get_error_message()}")
-		elif payload.model_type == "cloud":
-			# 强制使用云端模型
-			sql_query = await _generate_sql_with_cloud(payload.question, table_schema, payload.cloud_model)
-			model_used = "cloud_api"
-		else:
-			# 自动选择：优先使用本地模型，失败时降级到云端模型
-			try:
-				if local_client.is_available():
-					sql_query = local_client.generate_sql(payload.question, table_schema)
-					model_used = "local_gguf"
-				else:
-					raise RuntimeError(f"本地模型不可用: {local_client.get_error_message()}")
-			except Exception as e:
-				# 本地模型失败，使用云端模型
-				print(f"本地模型失败，降级到云端模型: {e}")
-				sql_query = await _generate_sql_with_cloud(payload.question, table_schema, payload.cloud_model)
-				model_used = "cloud_api"
-		
-		# 3. 权限校验
-		has_permission, permission_msg = check_sql_permission(sql_query, user_role)
-		if not has_permission:
+		sql_stage = stages["sql"]
+		if not stages["rbac"]["permission"]:
 			return ChatResponse(
-				answer=f"权限不足：{permission_msg}",
-				meta={"sql": sql_query, "role": user_role, "permission": False, "model": model_used}
+				answer=f"权限不足：{stages['rbac']['message']}",
+				meta={"sql": sql_stage["sql"], "role": user_role, "permission": False, "model": sql_stage["model"], "sql_cache": sql_stage["sql_cache"]}
 			)
 		
-		# 4. 执行查询
-		result = db.execute(text(sql_query))
-		rows = result.fetchall()
-		
-		# 5. 格式化结果
-		if rows:
-			# 转换为字典列表
-			columns = result.keys()
-			data = [dict(zip(columns, row)) for row in rows]
-			formatted_result = f"查询到 {len(rows)} 条记录：{data}"
-		else:
-			formatted_result = "查询结果为空"
-		
-		# 6. 生成自然语言答案（根据用户选择或自动选择模型）
-		if payload.model_type == "local":
-			# 强制使用本地模型
-			if local_client.is_available():
-				answer = local_client.format_answer(payload.question, formatted_result)
-				answer_model = "local_gguf"
-			else:
-				raise RuntimeError(f"本地模型不可用: {local_client.get_error_message()}")
-		elif payload.model_type == "cloud":
-			# 强制使用云端模型
-			answer = await _format_answer_with_cloud(payload.question, formatted_result, payload.cloud_model)
-			answer_model = "cloud_api"
-		else:
-			# 自动选择：优先使用本地模型，失败时降级到云端模型
-			try:
-				if local_client.is_available():
-					answer = local_client.format_answer(payload.question, formatted_result)
-					answer_model = "local_gguf"
-				else:
-					raise RuntimeError(f"本地模型不可用: {local_client.get_error_message()}")
-			except Exception as e:
-				# 本地模型失败，使用云端模型
-				print(f"本地模型格式化失败，降级到云端模型: {e}")
-				answer = await _format_answer_with_cloud(payload.question, formatted_result, payload.cloud_model)
-				answer_model = "cloud_api"
+		# 7. 生成自然语言答案（简单结果按模板直接生成，否则根据用户选择或自动选择模型）
+		rows_stage = stages["rows"]
+		answer, answer_model = await _format_answer(payload, rows_stage["result"])
 		
 		return ChatResponse(
 			answer=answer,
 			meta={
-				"sql": sql_query,
+				"sql": sql_stage["sql"],
 				"role": user_role,
 				"permission": True,
-				"result_count": len(rows),
+				"result_count": rows_stage["count"],
+				"truncated": rows_stage["truncated"],
 				"database": db_type,
-				"sql_model": model_used,
-				"answer_model": answer_model
+				"sql_model": sql_stage["model"],
+				"sql_policy": sql_stage["sql_policy"],
+				"answer_model": answer_model,
+				"sql_cache": sql_stage["sql_cache"],
+				"result_cache": rows_stage["result_cache"]
 			}
 		)
 		
+	except InferenceQueueFull:
+		# 强制本地模型时队列已满，交由上层返回 503
+		raise
 	except Exception as e:
 		return ChatResponse(
 			answer=f"数据库查询失败: {str(e)}",
@@ -222,6 +647,203 @@ async def _handle_database_query(
 		)
 
 
+def _local_result_text(fetched: FetchResult) -> str:
+	"""按本地模型分词器与 token 预算编码查询结果"""
+	return encode_result(
+		fetched.columns, fetched.rows, fetched.truncated,
+		token_budget=settings.result_token_budget_local,
+		count_tokens=local_client.count_tokens
+	)
+
+
+def _cloud_result_text(fetched: FetchResult, model: str = None) -> str:
+	"""按云端模型的 token 计数与预算编码查询结果"""
+	return encode_result(
+		fetched.columns, fetched.rows, fetched.truncated,
+		token_budget=settings.result_token_budget_cloud,
+		count_tokens=tiktoken_counter(cloud_client.resolve_model(model))
+	)
+
+
+def _template_answer(payload: ChatRequest, fetched: FetchResult) -> Optional[str]:
+	"""简单结果（空、单值、单行、小表）按模板生成答案，需要模型时返回 None"""
+	if not settings.fast_answer or payload.answer_style == "narrative":
+		return None
+	return template_answer(
+		payload.question, fetched.columns, fetched.rows, fetched.truncated,
+		settings.fast_answer_max_rows, settings.fast_answer_max_columns
+	)
+
+
+async def _format_answer(payload: ChatRequest, fetched: FetchResult) -> Tuple[str, str]:
+	"""根据用户选择或自动选择模型生成自然语言答案，返回 (答案, 使用的模型)；简单结果直接使用模板"""
+	answer = _template_answer(payload, fetched)
+	if answer is not None:
+		return answer, "template"
+	
+	if payload.model_type == "local":
+		# 强制使用本地模型
+		if local_client.is_available():
+			return await local_client.aformat_answer(payload.question, _local_result_text(fetched)), "local_gguf"
+		raise RuntimeError(f"本地模型不可用: {local_client.get_error_message()}")
+	elif payload.model_type == "cloud":
+		# 强制使用云端模型
+		return await _format_answer_with_cloud(
+			payload.question, _cloud_result_text(fetched, payload.cloud_model), payload.cloud_model
+		), "cloud_api"
+	
+	# 自动选择：本地模型健康时优先使用，失败时降级到云端模型
+	try:
+		_ensure_local_healthy(HEALTH_NAME_ANSWER)
+		return await local_client.aformat_answer(payload.question, _local_result_text(fetched)), "local_gguf"
+	except Exception as e:
+		# 本地模型失败，使用云端模型
+		print(f"本地模型格式化失败，降级到云端模型: {e}")
+		return await _format_answer_with_cloud(
+			payload.question, _cloud_result_text(fetched, payload.cloud_model), payload.cloud_model
+		), "cloud_api"
+
+
+async def _stream_answer(payload: ChatRequest, fetched: FetchResult) -> AsyncIterator[Tuple[str, str]]:
+	"""流式生成自然语言答案，逐段产出 (使用的模型, 文本片段)；简单结果直接使用模板"""
+	answer = _template_answer(payload, fetched)
+	if answer is not None:
+		yield "template", answer
+		return
+	
+	if payload.model_type == "local" and not local_client.is_available():
+		raise RuntimeError(f"本地模型不可用: {local_client.get_error_message()}")
+	
+	if payload.model_type == "local" or (payload.model_type == "auto" and _local_healthy(HEALTH_NAME_ANSWER)):
+		started = False
+		try:
+			async for chunk in local_client.astream_answer(payload.question, _local_result_text(fetched)):
+				started = True
+				yield "local_gguf", chunk
+			return
+		except Exception as e:
+			# 已经输出部分内容或强制本地模型时不再降级
+			if started or payload.model_type == "local":
+				raise
+			print(f"本地模型格式化失败，降级到云端模型: {e}")
+	
+	messages = _answer_messages(payload.question, _cloud_result_text(fetched, payload.cloud_model))
+	async for chunk in cloud_client.astream_chat_completion(messages, payload.cloud_model):
+		yield "cloud_api", chunk
+
+
+def _cloud_cache_model(payload: ChatRequest) -> str:
+	"""云端模型在 SQL 缓存中的模型键"""
+	return f"cloud_api:{cloud_client.resolve_model(payload.cloud_model)}"
+
+
+def _sql_cache_models(payload: ChatRequest) -> List[str]:
+	"""当前请求可接受的 SQL 缓存模型键（按优先级）"""
+	if payload.model_type == "local":
+		return ["local_gguf"]
+	if payload.model_type == "cloud":
+		return [_cloud_cache_model(payload)]
+	return ["local_gguf", _cloud_cache_model(payload)]
+
+
+def _sql_policy(payload: ChatRequest) -> str:
+	"""auto 模式下的 SQL 生成策略：请求参数优先，其次使用全局配置"""
+	policy = payload.sql_policy or settings.sql_generation_policy
+	return policy if policy in ("fallback", "race") else "fallback"
+
+
+def _local_healthy(health_name: str) -> bool:
+	"""本地模型已加载且对应任务的熔断器放行"""
+	return local_client.is_available() and model_health.allow_request(health_name)
+
+
+def _ensure_local_healthy(health_name: str) -> None:
+	"""auto 模式使用本地模型前的检查，不可用时抛出异常以触发降级"""
+	if not local_client.is_available():
+		raise RuntimeError(f"本地模型不可用: {local_client.get_error_message()}")
+	if not model_health.allow_request(health_name):
+		raise RuntimeError("本地模型熔断中，暂时使用云端模型")
+
+
+async def _generate_sql_local_checked(payload: ChatRequest, table_schema: str) -> str:
+	"""auto 模式下的本地 SQL 生成：无法解析的输出视为失败（已计入健康统计）"""
+	sql = await local_client.agenerate_sql(payload.question, table_schema)
+	if not looks_like_query(sql):
+		raise RuntimeError(f"本地模型输出无法解析为 SQL: {sql[:80]}")
+	return sql
+
+
+def _is_usable_sql(sql: str, user_role: str, db_type: str) -> bool:
+	"""竞速结果是否可用：能提取出查询语句且通过当前角色的权限校验"""
+	return looks_like_query(sql) and check_sql_permission(sql, user_role, db_type)[0]
+
+
+async def _race_generate_sql(payload: ChatRequest, table_schema: str, user_role: str, db_type: str) -> Tuple[str, str]:
+	"""本地与云端同时生成 SQL，取第一个可用的结果，取消落后的一方"""
+	tasks = {}
+	if _local_healthy(HEALTH_NAME_SQL):
+		tasks[asyncio.ensure_future(_generate_sql_local_checked(payload, table_schema))] = "local_gguf"
+	# 云端熔断时只要本地可用就不再消耗云端额度
+	cloud_name = cloud_client.health_name(cloud_client.resolve_model(payload.cloud_model))
+	if not tasks or model_health.allow_request(cloud_name):
+		tasks[asyncio.ensure_future(_generate_sql_with_cloud(payload.question, table_schema, payload.cloud_model))] = "cloud_api"
+	
+	fallback: Optional[Tuple[str, str]] = None
+	errors: List[str] = []
+	pending = set(tasks)
+	try:
+		while pending:
+			done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				try:
+					sql = task.result()
+				except Exception as e:
+					errors.append(f"{tasks[task]}: {e}")
+					continue
+				if _is_usable_sql(sql, user_role, db_type):
+					return sql, tasks[task]
+				# 不可用的结果先保留，若另一方也不可用则返回它，交由后续权限校验给出原因
+				fallback = fallback or (sql, tasks[task])
+	finally:
+		for task in pending:
+			task.cancel()
+	
+	if fallback:
+		return fallback
+	raise RuntimeError(f"SQL 生成失败: {'; '.join(errors)}")
+
+
+async def _generate_sql(payload: ChatRequest, table_schema: str, user_role: str, db_type: str) -> Tuple[str, str]:
+	"""根据用户选择或自动选择模型生成 SQL，返回 (sql, 使用的模型)"""
+	if payload.model_type == "local":
+		# 强制使用本地模型
+		if local_client.is_available():
+			sql_query = await local_client.agenerate_sql(payload.question, table_schema)
+			model_used = "local_gguf"
+		else:
+			raise RuntimeError(f"本地模型不可用: {local_client.get_error_message()}")
+	elif payload.model_type == "cloud":
+		# 强制使用云端模型
+		sql_query = await _generate_sql_with_cloud(payload.question, table_schema, payload.cloud_model)
+		model_used = "cloud_api"
+	elif _sql_policy(payload) == "race":
+		# 自动选择（竞速）：本地与云端并发生成，取先完成的可用结果
+		sql_query, model_used = await _race_generate_sql(payload, table_schema, user_role, db_type)
+	else:
+		# 自动选择：本地模型健康时优先使用，失败或输出无法解析时降级到云端模型
+		try:
+			_ensure_local_healthy(HEALTH_NAME_SQL)
+			sql_query = await _generate_sql_local_checked(payload, table_schema)
+			model_used = "local_gguf"
+		except Exception as e:
+			# 本地模型失败，使用云端模型
+			print(f"本地模型失败，降级到云端模型: {e}")
+			sql_query = await _generate_sql_with_cloud(payload.question, table_schema, payload.cloud_model)
+			model_used = "cloud_api"
+	
+	return sql_query, model_used
+
+
 async def _generate_sql_with_cloud(question: str, table_schema: str, model: str = None) -> str:
 	"""使用云端模型生成 SQL"""
 	prompt = f"""你是一个专业的 SQL 生成助手。根据用户的问题和数据库表结构，生成准确的 SQL 查询语句。
@@ -240,7 +862,7 @@ SQL:"""
 		{"role": "user", "content": prompt}
 	]
 	
-	response = cloud_client.chat_completion(messages, model)
+	response = await cloud_client.achat_completion(messages, model)
 	
 	# 改进的SQL清理逻辑
 	cleaned_response = response.strip()
@@ -319,7 +941,6 @@ SQL:"""
 	cleaned_response = cleaned_response.replace(' -', '')
 	
 	# 移除多余的空格
-	import re
 	cleaned_response = re.sub(r'\s+', ' ', cleaned_response)
 	
 	# 更严格的SQL清理：只保留SQL语句部分
@@ -343,8 +964,8 @@ SQL:"""
 	return cleaned_response.strip()
 
 
-async def _format_answer_with_cloud(question: str, sql_result: str, model: str = None) -> str:
-	"""使用云端模型格式化答案"""
+def _answer_messages(question: str, sql_result: str) -> List[Dict[str, str]]:
+	"""构造云端答案格式化的对话消息"""
 	prompt = f"""你是一个专业的数据分析师。请根据用户的原始问题和 SQL 查询结果，生成一个清晰、易懂的自然语言答案。
 
 用户问题：{question}
@@ -355,12 +976,15 @@ async def _format_answer_with_cloud(question: str, sql_result: str, model: str =
 
 答案："""
 	
-	messages = [
+	return [
 		{"role": "system", "content": "聊天记录中，请用中文回答。"},
 		{"role": "user", "content": prompt}
 	]
-	
-	return cloud_client.chat_completion(messages, model)
+
+
+async def _format_answer_with_cloud(question: str, sql_result: str, model: str = None) -> str:
+	"""使用云端模型格式化答案"""
+	return await cloud_client.achat_completion(_answer_messages(question, sql_result), model)
 
 
 async def _handle_weather_query(payload: ChatRequest) -> ChatResponse:
@@ -370,7 +994,7 @@ async def _handle_weather_query(payload: ChatRequest) -> ChatResponse:
 		weather_data = await fetch_weather("北京")  # 默认北京，可扩展地理编码
 		
 		# 2. 使用云端模型分析天气数据
-		answer = cloud_client.weather_analysis(weather_data, payload.question, payload.cloud_model)
+		answer = await cloud_client.aweather_analysis(weather_data, payload.question, payload.cloud_model)
 		
 		return ChatResponse(
 			answer=answer,
@@ -387,7 +1011,7 @@ async def _handle_weather_query(payload: ChatRequest) -> ChatResponse:
 async def _handle_general_qa(payload: ChatRequest) -> ChatResponse:
 	"""处理通用知识问答"""
 	try:
-		answer = cloud_client.general_qa(payload.question, payload.cloud_model)
+		answer = await cloud_client.ageneral_qa(payload.question, payload.cloud_model)
 		
 		return ChatResponse(
 			answer=answer,
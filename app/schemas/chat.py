@@ -1,14 +1,17 @@
 from pydantic import BaseModel, Field
-from typing import Optional, Any, List, Dict
+from typing import Optional, Any, List, Dict, Literal
 
 
 class ChatRequest(BaseModel):
 	user_id: str = Field(..., description="调用者的用户标识")
 	role: Optional[str] = Field(default=None, description="调用者角色（可直传或由后端根据 user_id 解析）")
 	question: str = Field(..., description="用户自然语言问题")
+	database: Optional[Literal["hospital", "warehouse"]] = Field(default=None, description="目标数据库：未指定时依次使用 X-Database 请求头、/api/switch_db 设置的会话 cookie 与默认库")
 	model_type: Optional[str] = Field(default="auto", description="模型类型：auto(自动选择), local(本地模型), cloud(云端模型)")
 	cloud_model: Optional[str] = Field(default=None, description="指定的云端模型名称")
+	sql_policy: Optional[str] = Field(default=None, description="auto 模式下的 SQL 生成策略：fallback(本地优先，失败降级云端), race(本地与云端并发，取先完成的可用结果，会消耗云端额度)")
 	enable_cross_db: Optional[bool] = Field(default=False, description="是否启用跨库查询功能")
+	answer_style: Optional[str] = Field(default="auto", description="答案风格：auto(简单结果按模板直接回答), narrative(始终由模型生成叙述性答案)")
 
 
 class ChatResponse(BaseModel):
@@ -22,6 +25,9 @@ class CrossDBRequest(BaseModel):
 	question: str = Field(..., description="跨库查询的自然语言问题")
 	model_type: Optional[str] = Field(default="auto", description="模型类型")
 	cloud_model: Optional[str] = Field(default=None, description="指定的云端模型名称")
+	federated: Optional[bool] = Field(default=False, description="联邦执行：由云端模型生成跨库执行计划，在进程内完成跨库连接与聚合（失败时改为分别查询各库）")
+	multi_step: Optional[bool] = Field(default=False, description="多步查询：由云端模型把问题拆成有依赖关系的子查询，上游结果作为参数传给下游（失败时改为分别查询各库）")
+	answer_style: Optional[str] = Field(default="auto", description="答案风格：auto(简单结果按模板直接回答), narrative(始终由模型生成叙述性答案)")
 
 
 class ExpertToolResult(BaseModel):
@@ -30,6 +36,7 @@ class ExpertToolResult(BaseModel):
 	query: str = Field(..., description="执行的查询")
 	result: Any = Field(..., description="查询结果")
 	success: bool = Field(..., description="查询是否成功")
+	truncated: bool = Field(default=False, description="结果是否因超出行数上限被截断")
 	error_message: Optional[str] = Field(default=None, description="错误信息")
 
 
@@ -1,5 +1,9 @@
-from typing import Dict, List
-import re
+from typing import Any, Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+from app.cache.lru import TTLCache
+from app.config import settings
+from app.db.manager import manager
+from app.security.sql_parser import ParsedSQL, lexing_dialect, parse_sql
 
 # 基于角色的表权限控制
 ROLE_TABLE_PERMS: Dict[str, Dict[str, List[str]]] = {
@@ -61,48 +65,124 @@ ROLE_TABLE_PERMS: Dict[str, Dict[str, List[str]]] = {
 }
 
 
-def extract_tables(sql: str) -> List[str]:
+def extract_tables(sql: str, dialect: Optional[str] = None) -> List[str]:
 	"""从 SQL 中提取表名"""
-	pattern = r"(?:from|join)\s+([a-zA-Z_][\w]*)"
-	return list({m.lower() for m in re.findall(pattern, sql, flags=re.IGNORECASE)})
+	return sorted(policy_engine.parse(sql, dialect).tables)
 
 
-def contains_denied_columns(sql: str, denied_columns: List[str]) -> bool:
-	"""检查是否包含被禁止的列"""
-	denied_columns_lower = [c.lower() for c in denied_columns]
-	for col in denied_columns_lower:
-		if re.search(rf"\b{re.escape(col)}\b", sql, flags=re.IGNORECASE):
-			return True
-	return False
+def contains_denied_columns(sql: str, denied_columns: List[str], dialect: Optional[str] = None) -> bool:
+	"""检查是否包含被禁止的列（无法确定如何解析时视为包含）"""
+	parsed = policy_engine.parse(sql, dialect)
+	return parsed.ambiguous or not parsed.columns.isdisjoint(c.lower() for c in denied_columns)
 
 
-def check_sql_permission(sql: str, role: str) -> tuple[bool, str]:
-	"""检查 SQL 权限"""
-	role = role.strip()
-	
-	# 查找匹配的角色权限
-	perms = None
-	for role_key, role_perms in ROLE_TABLE_PERMS.items():
-		if role_key.lower() == role.lower() or role.lower() in role_key.lower():
-			perms = role_perms
-			break
-	
-	if not perms:
-		return False, f"未知角色 '{role}'，无权限执行查询。支持的角色：{list(ROLE_TABLE_PERMS.keys())}"
-	
-	# 检查表权限
-	tables = extract_tables(sql)
-	allow_tables = perms["allow_tables"]
-	
-	for table in tables:
-		if allow_tables != ["*"] and table not in allow_tables:
-			return False, f"角色 '{role}' 无权访问表 '{table}'。允许的表：{allow_tables}"
-	
-	# 检查列权限
-	if contains_denied_columns(sql, perms.get("deny_columns", [])):
-		return False, f"角色 '{role}' 试图访问受限列：{perms['deny_columns']}"
-	
-	return True, f"权限检查通过。{perms.get('description', '')}"
+class CompiledPolicy(NamedTuple):
+	"""预编译的角色权限：允许的表（None 表示全部）与禁止的列均为小写 frozenset，allowed 为通过时的判定结果"""
+	allow_tables: Optional[FrozenSet[str]]
+	deny_columns: FrozenSet[str]
+	perms: Dict[str, Any]
+	allowed: Tuple[bool, str]
+
+
+class CheckEntry(NamedTuple):
+	"""一条 SQL 在某一方言下的解析结果，以及各角色对它的判定"""
+	parsed: ParsedSQL
+	decisions: Dict[str, Tuple[bool, str]]
+
+
+# 每条 SQL 最多缓存的角色判定数（角色名来自请求，避免单个条目无限增长）
+MAX_ROLES_PER_SQL = 64
+
+
+class PolicyEngine:
+	"""RBAC 策略引擎：角色权限只编译一次，同一方言下的 SQL 只解析一次，判定结果按 (SQL, 方言) 缓存在 LRU 中、条目内按角色区分
+
+	缓存键直接使用 SQL 字符串（str 的哈希值会被缓存），不再额外计算摘要；新角色校验已缓存的 SQL 时只需一次 LRU 查找。
+
+	修改 ROLE_TABLE_PERMS 后调用 load() 重新编译并清空缓存。
+	"""
+
+	def __init__(self, role_perms: Dict[str, Dict[str, Any]], cache_size: int = 4096):
+		self._parsed = TTLCache(max_entries=cache_size, ttl=float("inf"))
+		self._checks = TTLCache(max_entries=cache_size, ttl=float("inf"))
+		self.load(role_perms)
+
+	def load(self, role_perms: Dict[str, Dict[str, Any]]) -> None:
+		policies = []
+		for role_key, perms in role_perms.items():
+			allow = perms["allow_tables"]
+			policies.append((role_key.lower(), CompiledPolicy(
+				None if allow == ["*"] else frozenset(t.lower() for t in allow),
+				frozenset(c.lower() for c in perms.get("deny_columns", [])),
+				perms,
+				(True, f"权限检查通过。{perms.get('description', '')}")
+			)))
+		self._role_keys = list(role_perms.keys())
+		self._policies = policies
+		self._exact = {}
+		for role_key, policy in policies:
+			self._exact.setdefault(role_key, policy)
+		self._parsed.clear()
+		self._checks.clear()
+
+	def resolve(self, role: str) -> Optional[CompiledPolicy]:
+		"""角色名精确匹配（不区分大小写），否则取第一个包含该名称的角色"""
+		role = role.strip().lower()
+		policy = self._exact.get(role)
+		if policy is None:
+			policy = next((p for role_key, p in self._policies if role in role_key), None)
+		return policy
+
+	def parse(self, sql: str, dialect: Optional[str] = None) -> ParsedSQL:
+		# 与方言无关的 SQL（没有引号、注释等）各方言共用一份解析结果
+		key = (sql, lexing_dialect(sql, dialect))
+		parsed = self._parsed.get(key)
+		if parsed is None:
+			parsed = parse_sql(sql, key[1])
+			self._parsed.set(key, parsed)
+		return parsed
+
+	def check(self, sql: str, role: str, dialect: Optional[str] = None) -> Tuple[bool, str]:
+		"""dialect 为 SQL 将要执行的数据库的方言（mysql / postgresql），未知时按两种方言解析，任一解释越权即拒绝"""
+		key = (sql, lexing_dialect(sql, dialect))
+		entry = self._checks.get(key)
+		if entry is None:
+			entry = CheckEntry(self.parse(sql, key[1]), {})
+			self._checks.set(key, entry)
+		decision = entry.decisions.get(role)
+		if decision is None:
+			decision = self._decide(entry.parsed, role)
+			if len(entry.decisions) < MAX_ROLES_PER_SQL:
+				entry.decisions[role] = decision
+		return decision
+
+	def _decide(self, parsed: ParsedSQL, role: str) -> Tuple[bool, str]:
+		role = role.strip()
+		policy = self.resolve(role)
+		if policy is None:
+			return False, f"未知角色 '{role}'，无权限执行查询。支持的角色：{self._role_keys}"
+		
+		if parsed.ambiguous:
+			return False, "SQL 中有无法确定如何解析的引号或注释（未闭合、可执行注释或嵌套注释），拒绝执行"
+		
+		# 检查表权限
+		if policy.allow_tables is not None and not parsed.tables <= policy.allow_tables:
+			denied = sorted(parsed.tables - policy.allow_tables)
+			return False, f"角色 '{role}' 无权访问表 '{denied[0]}'。允许的表：{policy.perms['allow_tables']}"
+		
+		# 检查列权限
+		if not parsed.columns.isdisjoint(policy.deny_columns):
+			return False, f"角色 '{role}' 试图访问受限列：{policy.perms['deny_columns']}"
+		
+		return policy.allowed
+
+	def stats(self) -> Dict[str, Any]:
+		return {"roles": len(self._policies), "parsed": self._parsed.stats(), "decisions": self._checks.stats()}
+
+
+def check_sql_permission(sql: str, role: str, database: Optional[str] = None) -> tuple[bool, str]:
+	"""检查 SQL 权限；database 为执行该 SQL 的数据库，用于按其方言解析 SQL"""
+	return policy_engine.check(sql, role, manager.dialect(database) if database else None)
 
 
 def get_user_role_by_id(user_id: str, db_type: str) -> str:
@@ -134,3 +214,7 @@ def get_user_role_by_id(user_id: str, db_type: str) -> str:
 		return "test_user"
 	
 	return "admin"  # 默认管理员权限
+
+
+# 全局实例
+policy_engine = PolicyEngine(ROLE_TABLE_PERMS, settings.rbac_cache_size)
@@ -0,0 +1,336 @@
+import re
+from typing import List, NamedTuple, Optional, Pattern, Set, Tuple
+
+
+# 支持按方言词法解析的数据库；其他或未知方言按两种方言分别解析后取并集
+DIALECTS = ("mysql", "postgresql")
+
+SPACE = r"[ \t\n\r\f\v]+"
+NUMBER = r"\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+"
+IDENT = r"[A-Za-z_\x80-\U0010ffff][\w$\x80-\U0010ffff]*"
+# MySQL 的名字可以以 $ 开头
+MYSQL_IDENT = r"[A-Za-z_$\x80-\U0010ffff][\w$\x80-\U0010ffff]*"
+BACKTICK = r"`(?:[^`]|``)*`"
+DOLLAR_TAG = r"[A-Za-z_\x80-\U0010ffff][\w\x80-\U0010ffff]*"
+
+
+def _quoted(quote: str, backslash_escape: bool) -> str:
+	if backslash_escape:
+		return rf"{quote}(?:[^{quote}\\]|\\.|{quote}{quote})*{quote}"
+	return rf"{quote}(?:[^{quote}]|{quote}{quote})*{quote}"
+
+
+class Lexer(NamedTuple):
+	"""一种词法解释：pattern 每次匹配跳过空白、注释、字符串、数字与运算符，取出一个名字（可带 . 与引号）或括号、逗号、点、分号；
+	无法确定如何切分的位置（未闭合的引号与注释、MySQL 可执行注释、PostgreSQL 嵌套注释等）匹配为 bad 并吞掉剩余文本"""
+	dialect: str
+	pattern: Pattern
+	part: Pattern
+	token_group: int
+	bad_group: int
+
+
+def _lexer(dialect: str, single: str, double: str, skip: List[str], bad: str) -> Lexer:
+	name = f"(?:{MYSQL_IDENT}|{double}|{BACKTICK})" if dialect == "mysql" else f"(?:{IDENT}|{double})"
+	pattern = re.compile(
+		rf"(?:{'|'.join(skip)}|{single})*+(?:(?P<token>{name}(?:\.{name})*|[(),.;])|(?P<bad>(?:{bad}).*)|\Z)",
+		re.DOTALL
+	)
+	return Lexer(
+		dialect, pattern, re.compile(name, re.DOTALL),
+		pattern.groupindex["token"] - 1, pattern.groupindex["bad"] - 1
+	)
+
+
+def _mysql(single_escape: bool, double_escape: bool) -> Lexer:
+	"""MySQL：# 与 "-- "（第二个 - 后须为空白或控制字符）为行注释，块注释不嵌套，/*! */ 中的内容是否执行取决于服务器版本；
+	"..." 在默认模式下是字符串、ANSI_QUOTES 下是标识符，统一按名字处理（只会多计列名）"""
+	return _lexer(
+		"mysql", _quoted("'", single_escape), _quoted('"', double_escape),
+		[
+			SPACE, r"\#[^\n]*", r"--(?=[\x00-\x20]|\Z)[^\n]*", r"/\*(?!M?!).*?\*/", NUMBER,
+			r"(?!/\*|--[^\x21-\x7e])[^\w(),.;'\"`$\x80-\U0010ffff]"
+		],
+		r"/\*|--|['\"`]"
+	)
+
+
+def _postgresql(single_escape: bool) -> Lexer:
+	"""PostgreSQL：-- 注释到 \\n 或 \\r 为止，# 是运算符，块注释可以嵌套（嵌套时视为歧义），E'...' 总是支持反斜杠转义，
+	$tag$...$tag$ 为字符串，"..." 为标识符"""
+	return _lexer(
+		"postgresql", _quoted("'", single_escape), _quoted('"', False),
+		[
+			SPACE, r"--[^\n\r]*", r"/\*(?:(?!/\*).)*?\*/", r"[eE]" + _quoted("'", True),
+			rf"\$(?P<tag>(?:{DOLLAR_TAG})?)\$.*?\$(?P=tag)\$", r"\$\d+", NUMBER,
+			r"(?!/\*)[^\w(),.;'\"$\x80-\U0010ffff]"
+		],
+		r"/\*|['\"$]"
+	)
+
+
+# 没有引号、注释、反斜杠与 $ 的 SQL 在各方言下的词法相同，用不区分方言的简单模式；CTE 名按原样比较（对两种方言都只会多计表）
+DIALECT_MARKS = ("'", '"', "`", "#", "$", "\\", "--", "/*")
+SIMPLE_LEXER = Lexer(
+	"",
+	re.compile(rf"(?:[^\w(),.;\x80-\U0010ffff]+|{NUMBER})*+(?:({IDENT}(?:\.{IDENT})*|[(),.;])|\Z)"),
+	re.compile(IDENT),
+	0,
+	-1
+)
+
+# 反斜杠是否为转义字符取决于服务器设置（MySQL NO_BACKSLASH_ESCAPES / ANSI_QUOTES、PostgreSQL standard_conforming_strings），
+# SQL 中有反斜杠时按每种设置各解析一次；第一个为默认设置
+MYSQL_LEXERS = (_mysql(True, True), _mysql(True, False), _mysql(False, False))
+POSTGRESQL_LEXERS = (_postgresql(False), _postgresql(True))
+
+KEYWORDS = frozenset("""
+	select from where join inner left right full outer cross natural straight_join on using as and or not in is
+	null like ilike regexp rlike between exists group by order having limit offset fetch first next rows row only
+	union all distinct intersect except minus with recursive case when then else end asc desc true false into
+	insert update delete replace set values default returning window over partition lateral interval escape
+	top percent ties for share lock nowait skip locked collate binary unknown any some div mod xor table
+""".split())
+
+# 关键词（及括号、逗号、点、分号）在解析中的作用：之后跟表名（FROM 列表 / INTO、UPDATE、TABLE）、结束 FROM 列表的子句，以及 WITH 定义相关的几个词
+PLAIN_KIND, WITH_KIND, RECURSIVE_KIND, AS_KIND, NOT_KIND, FROM_KIND, INTO_KIND, CLAUSE_KIND, SELECT_KIND = range(9)
+KEYWORD_KINDS = {keyword: PLAIN_KIND for keyword in KEYWORDS}
+KEYWORD_KINDS.update({"with": WITH_KIND, "recursive": RECURSIVE_KIND, "as": AS_KIND, "not": NOT_KIND, "select": SELECT_KIND})
+KEYWORD_KINDS.update((keyword, FROM_KIND) for keyword in ("from", "join", "straight_join"))
+KEYWORD_KINDS.update((keyword, INTO_KIND) for keyword in ("into", "update", "table"))
+KEYWORD_KINDS.update((keyword, CLAUSE_KIND) for keyword in (
+	"where", "group", "order", "having", "limit", "offset", "union", "intersect", "except", "minus",
+	"set", "values", "window", "for", "returning", "fetch"
+))
+# 大写写法直接命中，省去 lower()
+KEYWORD_KINDS.update({keyword.upper(): kind for keyword, kind in KEYWORD_KINDS.items()})
+STRUCTURE_KIND = -1
+KEYWORD_KINDS.update((token, STRUCTURE_KIND) for token in "(),.;")
+STRUCTURE = frozenset("(),.;")
+
+
+class ParsedSQL(NamedTuple):
+	"""SQL 引用的真实表（不含 CTE 名）与列名（不含表、别名与函数名），均为小写；ambiguous 为无法确定词法时的标记，此时应拒绝"""
+	tables: frozenset
+	columns: frozenset
+	ambiguous: bool = False
+
+
+AMBIGUOUS = ParsedSQL(frozenset(), frozenset(), True)
+
+
+def _dialect_sensitive(sql: str) -> bool:
+	for mark in DIALECT_MARKS:
+		if mark in sql:
+			return True
+	return False
+
+
+def lexing_dialect(sql: str, dialect: Optional[str]) -> Optional[str]:
+	"""解析 SQL 时实际需要区分的方言：SQL 中没有与方言相关的字符时为 None（解析结果与方言无关，可以共用缓存）"""
+	return dialect if _dialect_sensitive(sql) else None
+
+
+def lexers(sql: str, dialect: Optional[str] = None) -> Tuple[Lexer, ...]:
+	"""SQL 在该方言下可能的词法解释"""
+	if not _dialect_sensitive(sql):
+		return (SIMPLE_LEXER,)
+	backslash = "\\" in sql
+	if dialect == "mysql":
+		return MYSQL_LEXERS if backslash else MYSQL_LEXERS[:1]
+	if dialect == "postgresql":
+		return POSTGRESQL_LEXERS if backslash else POSTGRESQL_LEXERS[:1]
+	if backslash:
+		return MYSQL_LEXERS + POSTGRESQL_LEXERS
+	return MYSQL_LEXERS[0], POSTGRESQL_LEXERS[0]
+
+
+def _scan(sql: str, lexer: Lexer) -> Optional[List[str]]:
+	"""按一种词法解释切分，有歧义时返回 None"""
+	found = lexer.pattern.findall(sql)
+	if lexer.bad_group < 0:
+		while found and not found[-1]:
+			found.pop()
+		return found
+	while found and not found[-1][lexer.token_group]:
+		if found[-1][lexer.bad_group]:
+			return None
+		found.pop()
+	index = lexer.token_group
+	return [item[index] for item in found]
+
+
+def tokenize(sql: str, dialect: Optional[str] = None) -> Optional[List[List[str]]]:
+	"""每种可能的词法解释一个词法单元列表（名字、括号、逗号、点、分号，均为小写）；有歧义时返回 None"""
+	variants = []
+	for lexer in lexers(sql, dialect):
+		tokens = _scan(sql, lexer)
+		if tokens is None:
+			return None
+		variants.append([token.lower() for token in tokens])
+	return variants
+
+
+def _unquote(part: str) -> str:
+	quote = part[0]
+	if quote in "\"`":
+		return part[1:-1].replace(quote * 2, quote)
+	return part
+
+
+def _parse(sql: str, lexer: Lexer) -> Optional[Tuple[Set[str], Set[str]]]:
+	"""一次扫描词法单元，跟踪每层括号的 FROM/JOIN 列表与 WITH 定义，返回 (表, 列)；有歧义时返回 None"""
+	tokens = _scan(sql, lexer)
+	if tokens is None:
+		return None
+	postgres = lexer.dialect == "postgresql"
+	tables: Set[str] = set()
+	columns: Set[str] = set()
+	# 每个未关闭的括号：(外层 in_from, 外层 in_with, 是否派生表, 外层待定义的 CTE 名, 是否为该 CTE 的定义)
+	stack: List[Tuple[bool, bool, bool, Optional[str], bool]] = []
+	# 已定义完毕且仍在作用域内的 CTE：(所在括号深度, 名称)
+	ctes: List[Tuple[int, str]] = []
+	in_from = expect_table = expect_alias = in_with = after_with = cte_as = False
+	# WITH 列表中已读到名字、尚未读到定义的 CTE；cte_as 表示已读到其后的 AS
+	cte_name: Optional[str] = None
+	n = len(tokens)
+	i = 0
+	while i < n:
+		token = tokens[i]
+		i += 1
+		kind = KEYWORD_KINDS.get(token)
+		if kind is None and not token.islower():
+			kind = KEYWORD_KINDS.get(token.lower())
+
+		if kind is not None:
+			if kind == STRUCTURE_KIND:
+				after = False
+				if token == "(":
+					# FROM/JOIN 之后的括号：后跟 SELECT/WITH 为派生表，否则是加了括号的表引用（如 FROM (a JOIN b ON ...)）
+					derived = expect_table and i < n and tokens[i].lower() in ("select", "with")
+					stack.append((in_from, in_with, derived, cte_name, cte_as))
+					in_from = expect_table = expect_table and not derived
+					in_with = expect_alias = cte_as = False
+					cte_name = None
+				elif token == ")":
+					if stack:
+						in_from, in_with, derived, cte_name, defining = stack.pop()
+						# 括号内定义的 CTE 离开作用域；CTE 的定义结束后才可见，定义中的同名引用指向真实表
+						depth = len(stack)
+						while ctes and ctes[-1][0] > depth:
+							ctes.pop()
+						if defining:
+							ctes.append((depth, cte_name))
+							cte_name = None
+						# 派生表关闭后可以跟别名
+						expect_alias = derived
+					expect_table = cte_as = False
+				elif token == ",":
+					if in_from:
+						expect_table = True
+					after = in_with
+					expect_alias = cte_as = False
+					cte_name = None
+				elif token == ";":
+					stack.clear()
+					ctes.clear()
+					in_from = expect_table = expect_alias = in_with = cte_as = False
+					cte_name = None
+				after_with = after
+				continue
+			# 关键词；WITH 列表中 CTE 名之后只能是 [(列...)] AS [NOT MATERIALIZED] (
+			if kind == AS_KIND:
+				cte_as = cte_name is not None
+				after_with = False
+				continue
+			if kind == WITH_KIND:
+				in_with = after_with = True
+			elif kind != RECURSIVE_KIND:
+				after_with = False
+			if kind != NOT_KIND:
+				cte_name, cte_as = None, False
+			if kind == FROM_KIND:
+				expect_table = in_from = True
+			elif kind == INTO_KIND:
+				expect_table = True
+			elif kind >= CLAUSE_KIND:
+				in_from = expect_table = False
+				if kind == SELECT_KIND:
+					in_with = False
+			expect_alias = False
+			continue
+
+		# 名字：带引号或 a.b 形式的取最后一段，带引号的名字不是关键词，限定名不会是 CTE
+		if '"' in token or "`" in token:
+			parts = lexer.part.findall(token)
+			raw = _unquote(parts[-1])
+			value = raw.lower()
+			if len(parts) > 1:
+				raw = None
+		elif "." in token:
+			value = token[token.rindex(".") + 1:].lower()
+			raw = None
+		else:
+			value = token.lower()
+			# CTE 名的比较：PostgreSQL 未加引号的名字折叠为小写，其他情况按原样（只会少认 CTE、多计表）
+			raw = value if postgres else token
+
+		if after_with or cte_as or cte_name is not None:
+			if after_with and raw is not None:
+				# WITH name [(列...)] AS (...)：CTE 名
+				cte_name, cte_as, after_with = raw, False, False
+				continue
+			after_with = False
+			if cte_as and value == "materialized":
+				continue
+			cte_name, cte_as = None, False
+
+		# a . b 形式（点两侧有空白或注释）
+		while i + 1 < n and tokens[i] == "." and tokens[i + 1][0] not in STRUCTURE:
+			value = _unquote(lexer.part.findall(tokens[i + 1])[-1]).lower()
+			raw = None
+			i += 2
+
+		if expect_table:
+			if raw is None or not ctes or all(raw != name for _, name in ctes):
+				tables.add(value)
+			expect_table = False
+			# 表名后的别名：AS x 或直接跟 x
+			if i < n:
+				following = tokens[i]
+				if following in ("as", "AS") or following.lower() == "as":
+					i += 1
+					following = tokens[i] if i < n else ")"
+				if following[0] not in STRUCTURE and (following[0] in "\"`" or following.lower() not in KEYWORD_KINDS):
+					i += 1
+		elif expect_alias:
+			# 派生表别名
+			expect_alias = False
+		elif i < n and tokens[i] == "(" and raw is not None:
+			# 函数名
+			pass
+		else:
+			columns.add(value)
+
+	return tables, columns
+
+
+def parse_sql(sql: str, dialect: Optional[str] = None) -> ParsedSQL:
+	"""解析 SQL 引用的表与列；dialect 为 mysql / postgresql，其他值按两种方言解析
+
+	- 词法按方言处理引号、转义、注释与美元符号字符串；依赖服务器设置的部分（反斜杠转义、ANSI_QUOTES）按每种设置各解析一次取并集，
+	  仍无法确定的（未闭合的引号或注释、MySQL 可执行注释、PostgreSQL 嵌套注释）标记为 ambiguous
+	- 表：FROM/JOIN/INTO/UPDATE 之后的名字（含逗号分隔的多表、库名.表名取表名），子查询中的表同样计入
+	- 括号：FROM/JOIN 后的 (SELECT ...) 为派生表，其余括号内仍按表引用处理
+	- CTE：WITH 定义结束后、在同一层括号内对该名字的引用不计为表；定义本身（包括递归引用）中的同名引用计为真实表
+	- 列：其余非关键词名字（a.b 取 b），函数名、表别名与派生表别名除外；字符串字面量与注释中的内容不计入
+	"""
+	tables: Set[str] = set()
+	columns: Set[str] = set()
+	for lexer in lexers(sql, dialect):
+		parsed = _parse(sql, lexer)
+		if parsed is None:
+			return AMBIGUOUS
+		tables |= parsed[0]
+		columns |= parsed[1]
+	return ParsedSQL(frozenset(tables), frozenset(columns))
@@ -3,29 +3,59 @@
 实现专门查询特定数据库的专家工具
 """
 
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import bindparam, text
+from starlette.concurrency import run_in_threadpool
+from app.config import settings
+from app.db.bounded import FetchResult, apply_row_cap, fetch_rows
 from app.db.manager import manager
-from app.llm.local_client import local_client
+from app.db.schema_registry import schema_registry
+from app.llm.health import model_health
+from app.llm.local_client import HEALTH_NAME_ANSWER, HEALTH_NAME_SQL, local_client, looks_like_query
 from app.llm.cloud_client import cloud_client
+from app.llm.schema_linker import schema_linker
+from app.llm.answer_templates import template_answer
+from app.llm.result_encoder import encode_result, tiktoken_counter
 from app.schemas.chat import ExpertToolResult
+from app.security.rbac import check_sql_permission
 
 
 class BaseExpertTool:
     """专家工具基类"""
     
-    def __init__(self, database_name: str, table_schema: str):
+    def __init__(self, database_name: str, database_key: str):
         self.database_name = database_name
-        self.table_schema = table_schema
+        self.database_key = database_key
         self.tool_name = f"{database_name}_Expert"
     
-    def _generate_sql(self, question: str, model_type: str = "auto", cloud_model: str = None) -> str:
-        """生成SQL查询语句"""
+    @property
+    def table_schema(self) -> str:
+        """注册表中当前版本的表结构"""
+        return schema_registry.prompt(self.database_key)
+    
+    def _linked_schema(self, question: str, role: str = None) -> str:
+        """指定角色时只保留角色可访问且与问题相关的表与列，否则为完整表结构"""
+        if role is None:
+            return self.table_schema
+        return schema_linker.link(schema_registry.snapshot(self.database_key), role, question).text
+    
+    def _use_local(self, model_type: str, health_name: str) -> bool:
+        """是否使用本地模型：local 时必须使用（不可用则报错），auto 时本地模型已加载且对应任务的熔断器放行才使用"""
+        if model_type == "local":
+            if not local_client.is_available():
+                raise RuntimeError(f"本地模型不可用: {local_client.get_error_message()}")
+            return True
+        return model_type == "auto" and local_client.is_available() and model_health.allow_request(health_name)
+    
+    async def _generate_sql(
+        self, question: str, table_schema: str, model_type: str = "auto", cloud_model: str = None
+    ) -> str:
+        """生成SQL查询语句：本地模型经推理队列执行，云端模型使用异步客户端，两者都计入健康统计"""
         prompt = f"""你是一个专业的SQL生成助手，专门负责查询{self.database_name}数据库。
 
 数据库表结构：
-{self.table_schema}
+{table_schema}
 
 用户问题：{question}
 
@@ -34,11 +64,17 @@ class BaseExpertTool:
 SQL:"""
         
         try:
-            if model_type == "local" or model_type == "auto":
-                if local_client.is_available():
-                    return local_client.generate_sql(question, self.table_schema)
-                elif model_type == "local":
-                    raise RuntimeError("本地模型不可用")
+            if self._use_local(model_type, HEALTH_NAME_SQL):
+                try:
+                    sql = await local_client.agenerate_sql(question, table_schema)
+                    if not looks_like_query(sql):
+                        raise RuntimeError(f"本地模型输出无法解析为 SQL: {sql[:80]}")
+                    return sql
+                except Exception as e:
+                    # auto 模式下本地模型失败时降级到云端模型
+                    if model_type == "local":
+                        raise
+                    print(f"{self.tool_name} 本地模型失败，降级到云端模型: {e}")
             
             # 使用云端模型
             messages = [
@@ -46,7 +82,7 @@ SQL:"""
                 {"role": "user", "content": prompt}
             ]
             
-            response = cloud_client.chat_completion(messages, cloud_model)
+            response = await cloud_client.achat_completion(messages, cloud_model)
             return self._clean_sql_response(response)
             
         except Exception as e:
@@ -86,39 +122,136 @@ SQL:"""
         
         return cleaned.strip()
     
-    def _execute_query(self, sql: str, db_session: Session) -> Any:
-        """执行SQL查询"""
+    def _execute_query(self, sql: str, db_session: Session) -> Tuple[List[Dict[str, Any]], bool]:
+        """执行SQL查询，返回 (结果, 是否截断)；按批读取服务端游标，行数不超过 DB_MAX_ROWS"""
         try:
-            result = db_session.execute(text(sql))
-            rows = result.fetchall()
-            
-            if rows:
-                columns = result.keys()
-                return [dict(zip(columns, row)) for row in rows]
-            else:
-                return []
+            sql, _ = apply_row_cap(sql, settings.db_max_rows)
+            result = db_session.execute(text(sql), execution_options={"stream_results": True})
+            try:
+                if not result.returns_rows:
+                    return [], False
+                columns = list(result.keys())
+                rows, truncated = fetch_rows(result, settings.db_max_rows, settings.db_fetch_batch_size)
+            finally:
+                result.close()
+            return [dict(zip(columns, row)) for row in rows], truncated
                 
         except Exception as e:
             raise RuntimeError(f"SQL执行失败: {str(e)}")
     
-    def _format_result(self, question: str, result: Any, model_type: str = "auto", cloud_model: str = None) -> str:
-        """格式化查询结果"""
+    def _run_query(self, sql: str) -> Tuple[List[Dict[str, Any]], bool]:
+        """在本库独立的会话中执行（从 DatabaseManager 借出连接，执行完即归还）"""
+        with manager.session_scope(self.database_key) as session:
+            return self._execute_query(sql, session)
+    
+    async def run(
+        self, question: str, model_type: str = "auto", cloud_model: str = None, role: str = None
+    ) -> ExpertToolResult:
+        """执行本库查询：生成 SQL →（指定角色时）权限校验 → 执行 → 格式化，供多个专家并发调用
+
+        只有执行阶段在线程池中借出数据库连接，两次模型调用期间不占用连接。
+        """
+        sql = ""
+        try:
+            # 1. 生成SQL（指定角色时按角色与问题裁剪表结构）
+            sql = await self._generate_sql(question, self._linked_schema(question, role), model_type, cloud_model)
+            
+            # 2. 权限校验
+            if role is not None:
+                has_permission, permission_msg = check_sql_permission(sql, role, self.database_key)
+                if not has_permission:
+                    raise PermissionError(f"权限不足：{permission_msg}")
+            
+            # 3. 执行查询
+            result, truncated = await run_in_threadpool(self._run_query, sql)
+            
+            # 4. 格式化结果
+            formatted_result = await self._format_result(question, result, model_type, cloud_model, truncated)
+            
+            return ExpertToolResult(
+                tool_name=self.tool_name,
+                database=self.database_name,
+                query=sql,
+                result=formatted_result,
+                success=True,
+                truncated=truncated
+            )
+            
+        except Exception as e:
+            return ExpertToolResult(
+                tool_name=self.tool_name,
+                database=self.database_name,
+                query=sql,
+                result="",
+                success=False,
+                error_message=str(e)
+            )
+    
+    def execute(self, sql: str, params: Optional[Dict[str, List[Any]]] = None, role: str = None) -> FetchResult:
+        """执行给定的 SQL（多步查询计划中的一步）：权限校验后在本库独立的会话中执行
+
+        params 为上游步骤传下来的值列表，按扩展参数绑定（SQL 中写作 IN :name），不拼接进 SQL 文本。
+        """
+        if role is not None:
+            has_permission, permission_msg = check_sql_permission(sql, role, self.database_key)
+            if not has_permission:
+                raise PermissionError(f"权限不足：{permission_msg}")
+        sql, _ = apply_row_cap(sql, settings.db_max_rows)
+        statement = text(sql)
+        if params:
+            statement = statement.bindparams(*(bindparam(name, expanding=True) for name in params))
+        with manager.session_scope(self.database_key) as session:
+            try:
+                result = session.execute(statement, params or {}, execution_options={"stream_results": True})
+                try:
+                    columns = list(result.keys())
+                    rows, truncated = fetch_rows(result, settings.db_max_rows, settings.db_fetch_batch_size)
+                finally:
+                    result.close()
+            except Exception as e:
+                raise RuntimeError(f"SQL执行失败: {str(e)}")
+        return FetchResult(columns, [tuple(row) for row in rows], truncated)
+    
+    async def _format_result(
+        self, question: str, result: Any, model_type: str = "auto", cloud_model: str = None, truncated: bool = False
+    ) -> str:
+        """格式化查询结果（结果按各模型的 token 预算紧凑编码后再交给模型；本地模型经推理队列执行，两者都计入健康统计）"""
         if not result:
             return f"在{self.database_name}数据库中没有找到相关信息。"
         
+        columns = list(result[0].keys())
+        rows = [tuple(row.values()) for row in result]
+        if settings.fast_answer:
+            # 单值、单行与小表按模板直接回答，不再调用模型
+            answer = template_answer(
+                question, columns, rows, truncated, settings.fast_answer_max_rows, settings.fast_answer_max_columns
+            )
+            if answer is not None:
+                return answer
+        
         try:
-            if model_type == "local" or model_type == "auto":
-                if local_client.is_available():
-                    return local_client.format_answer(question, str(result))
-                elif model_type == "local":
-                    raise RuntimeError("本地模型不可用")
+            if self._use_local(model_type, HEALTH_NAME_ANSWER):
+                encoded = encode_result(
+                    columns, rows, truncated, settings.result_token_budget_local, local_client.count_tokens
+                )
+                try:
+                    return await local_client.aformat_answer(question, encoded)
+                except Exception as e:
+                    if model_type == "local":
+                        raise
+                    print(f"{self.tool_name} 本地模型格式化失败，降级到云端模型: {e}")
             
             # 使用云端模型
+            encoded = encode_result(
+                columns, rows, truncated, settings.result_token_budget_cloud,
+                tiktoken_counter(cloud_client.resolve_model(cloud_model))
+            )
             prompt = f"""你是一个专业的数据分析师。请根据用户的原始问题和查询结果，生成一个清晰、易懂的自然语言答案。
 
 用户问题：{question}
 
-查询结果：{result}
+查询结果：
+{encoded}
 
 请生成一个简洁、专业的答案，直接回答用户的问题。用中文回答。
 
@@ -129,137 +262,26 @@ SQL:"""
                 {"role": "user", "content": prompt}
             ]
             
-            return cloud_client.chat_completion(messages, cloud_model)
+            return await cloud_client.achat_completion(messages, cloud_model)
             
         except Exception as e:
             # 返回简单的格式化结果
-            return f"查询到 {len(result)} 条记录：{result}"
+            return encode_result(columns, rows, truncated, settings.result_token_budget_cloud)
 
 
 class HospitalExpertTool(BaseExpertTool):
     """医疗数据库专家工具"""
     
     def __init__(self):
-        table_schema = """
-医疗数据库 (hospital_db) 表结构：
-
-1. doctors (医生信息表)
-   - doctor_id: VARCHAR(10) - 医生ID (主键)
-   - doctor_name: VARCHAR(50) - 医生姓名
-   - department: VARCHAR(50) - 所属科室
-   - title: VARCHAR(50) - 职称/角色
-
-2. patients (病人信息表)
-   - patient_id: VARCHAR(10) - 病人ID (主键)
-   - patient_name: VARCHAR(50) - 病人姓名
-   - gender: VARCHAR(10) - 性别
-   - birth_date: DATE - 出生日期
-   - contact_number: VARCHAR(20) - 联系电话
-   - primary_doctor_id: VARCHAR(10) - 主治医生ID (外键关联doctors.doctor_id)
-
-3. medical_records (诊疗记录表)
-   - record_id: INT - 记录ID (主键，自增)
-   - patient_id: VARCHAR(10) - 病人ID (外键关联patients.patient_id)
-   - doctor_id: VARCHAR(10) - 看诊医生ID (外键关联doctors.doctor_id)
-   - visit_date: DATETIME - 就诊日期
-   - diagnosis: TEXT - 诊断结果
-   - prescription: TEXT - 处方
-"""
-        super().__init__("hospital_db", table_schema)
-    
-    def query(self, question: str, db_session: Session, model_type: str = "auto", cloud_model: str = None) -> ExpertToolResult:
-        """执行医疗数据库查询"""
-        try:
-            # 1. 生成SQL
-            sql = self._generate_sql(question, model_type, cloud_model)
-            
-            # 2. 执行查询
-            result = self._execute_query(sql, db_session)
-            
-            # 3. 格式化结果
-            formatted_result = self._format_result(question, result, model_type, cloud_model)
-            
-            return ExpertToolResult(
-                tool_name=self.tool_name,
-                database=self.database_name,
-                query=sql,
-                result=formatted_result,
-                success=True
-            )
-            
-        except Exception as e:
-            return ExpertToolResult(
-                tool_name=self.tool_name,
-                database=self.database_name,
-                query="",
-                result="",
-                success=False,
-                error_message=str(e)
-            )
+        super().__init__("hospital_db", "hospital")
 
 
 class WarehouseExpertTool(BaseExpertTool):
     """仓储数据库专家工具"""
     
     def __init__(self):
-        table_schema = """
-仓储数据库 (warehouse_db) 表结构：
-
-1. warehouse_staff (仓库员工表)
-   - staff_id: VARCHAR(10) - 员工ID (主键)
-   - staff_name: VARCHAR(50) - 员工姓名
-   - role: VARCHAR(50) - 角色/岗位 (Manager/Operator)
+        super().__init__("warehouse_db", "warehouse")
 
-2. products (商品信息表)
-   - product_id: VARCHAR(10) - 商品ID (主键)
-   - product_name: VARCHAR(100) - 商品名称
-   - description: TEXT - 商品描述
-   - price: DECIMAL(10,2) - 单价
-   - supplier: VARCHAR(100) - 供应商
 
-3. inventory (库存表)
-   - inventory_id: INT - 库存记录ID (主键，自增)
-   - product_id: VARCHAR(10) - 商品ID (外键关联products.product_id)
-   - warehouse_location: VARCHAR(20) - 仓库位置
-   - quantity: INT - 库存数量
-   - last_updated: TIMESTAMP - 最后更新时间
-
-4. shipments (出入库记录表)
-   - shipment_id: INT - 记录ID (主键，自增)
-   - product_id: VARCHAR(10) - 商品ID (外键关联products.product_id)
-   - staff_id: VARCHAR(10) - 操作员工ID (外键关联warehouse_staff.staff_id)
-   - quantity_change: INT - 数量变化 (正数入库, 负数出库)
-   - record_time: DATETIME - 记录时间
-   - type: VARCHAR(20) - 类型 (INBOUND/OUTBOUND)
-"""
-        super().__init__("warehouse_db", table_schema)
-    
-    def query(self, question: str, db_session: Session, model_type: str = "auto", cloud_model: str = None) -> ExpertToolResult:
-        """执行仓储数据库查询"""
-        try:
-            # 1. 生成SQL
-            sql = self._generate_sql(question, model_type, cloud_model)
-            
-            # 2. 执行查询
-            result = self._execute_query(sql, db_session)
-            
-            # 3. 格式化结果
-            formatted_result = self._format_result(question, result, model_type, cloud_model)
-            
-            return ExpertToolResult(
-                tool_name=self.tool_name,
-                database=self.database_name,
-                query=sql,
-                result=formatted_result,
-                success=True
-            )
-            
-        except Exception as e:
-            return ExpertToolResult(
-                tool_name=self.tool_name,
-                database=self.database_name,
-                query="",
-                result="",
-                success=False,
-                error_message=str(e)
-            )
+# 全局实例
+expert_tools: List[BaseExpertTool] = [HospitalExpertTool(), WarehouseExpertTool()]
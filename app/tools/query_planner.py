@@ -0,0 +1,224 @@
+"""
+多步查询规划模块
+把问题拆成跨库子查询的依赖图（DAG），无依赖关系的步骤并发执行，上游结果作为绑定参数传给下游
+"""
+
+import asyncio
+import json
+import re
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from app.cache.lru import TTLCache
+from app.cache.sql_cache import normalize_question
+from app.config import settings
+from app.db.bounded import FetchResult, is_query_sql
+from app.db.schema_registry import schema_registry
+from app.llm.cloud_client import cloud_client
+from app.llm.schema_linker import schema_linker
+from app.tools.cross_db_experts import BaseExpertTool, expert_tools
+
+
+STEP_ID = re.compile(r"^[A-Za-z_]\w*$")
+# 模型偶尔写成 IN (:name)，扩展参数需要 IN :name
+PARENTHESIZED_PARAM = re.compile(r"\(\s*:(\w+)\s*\)")
+
+PLAN_PROMPT = """你是多步查询规划助手。有些问题需要先查出一批值，再用这些值查询其他表或另一个数据库。请把问题拆成若干步，每步是某一个库上的一条只读 SELECT。
+
+{schemas}
+
+用户问题：{question}
+
+只返回一个 JSON 对象，不要任何解释或 markdown，格式如下：
+{{
+  "steps": [
+    {{"id": "s1", "database": "hospital", "sql": "SELECT doctor_id FROM medical_records WHERE diagnosis LIKE '%高血压%'"}},
+    {{"id": "s2", "database": "hospital", "sql": "SELECT doctor_name, department FROM doctors WHERE doctor_id IN :doctor_ids", "params": {{"doctor_ids": "s1.doctor_id"}}}}
+  ]
+}}
+
+规则：
+1. database 只能是 {databases}，sql 只能使用该库的表，能在一条 SQL 内完成的部分不要拆开；
+2. 需要上游结果时，在 params 中把参数名映射到 "步骤id.列名"，SQL 中写作 列 IN :参数名，上游该列的所有值会作为列表绑定；
+3. 互不依赖的步骤会并发执行，最后没有被其他步骤引用的步骤的结果用于回答问题；
+4. 最多 {max_steps} 步。"""
+
+
+class PlanStep(NamedTuple):
+	id: str
+	database: str
+	sql: str
+	# 参数名 -> (上游步骤, 列名)
+	params: Dict[str, Tuple[str, str]]
+	depends_on: Tuple[str, ...]
+
+
+class QueryPlan(NamedTuple):
+	"""按拓扑顺序排列的步骤"""
+	steps: Tuple[PlanStep, ...]
+
+	def sinks(self) -> List[PlanStep]:
+		"""没有被其他步骤依赖的步骤，其结果用于回答问题"""
+		used = {dep for step in self.steps for dep in step.depends_on}
+		return [step for step in self.steps if step.id not in used]
+
+
+class StepResult(NamedTuple):
+	step: PlanStep
+	fetched: Optional[FetchResult]
+	error: Optional[str]
+	elapsed: float
+
+
+def parse_query_plan(data: Dict[str, Any], databases: Sequence[str], max_steps: int) -> QueryPlan:
+	"""校验 JSON 形式的计划（数据库、只读 SQL、参数引用、无环）并按拓扑顺序排列步骤，格式错误时抛出 ValueError"""
+	if not isinstance(data, dict) or not isinstance(data.get("steps"), list) or not data["steps"]:
+		raise ValueError("执行计划应包含非空的 steps 数组")
+	if len(data["steps"]) > max_steps:
+		raise ValueError(f"执行计划步骤数超过上限 {max_steps}")
+
+	steps: Dict[str, PlanStep] = {}
+	for item in data["steps"]:
+		step_id, database = str(item.get("id", "")), str(item.get("database", ""))
+		if not STEP_ID.match(step_id) or step_id in steps:
+			raise ValueError(f"步骤 id 无效或重复: {step_id}")
+		if database not in databases:
+			raise ValueError(f"未知数据库: {database}")
+		sql = str(item.get("sql", "")).strip().rstrip(";")
+		if not is_query_sql(sql):
+			raise ValueError(f"步骤 {step_id} 只能是 SELECT")
+		params = {}
+		for name, ref in (item.get("params") or {}).items():
+			source, _, column = str(ref).partition(".")
+			if not column or not STEP_ID.match(str(name)):
+				raise ValueError(f"步骤 {step_id} 的参数 {name} 应引用 步骤id.列名")
+			if f":{name}" not in sql:
+				raise ValueError(f"步骤 {step_id} 的 SQL 中没有使用参数 :{name}")
+			params[str(name)] = (source, column)
+		sql = PARENTHESIZED_PARAM.sub(lambda m: f":{m.group(1)}" if m.group(1) in params else m.group(0), sql)
+		depends_on = tuple(sorted({source for source, _ in params.values()} | {str(d) for d in item.get("depends_on") or ()}))
+		steps[step_id] = PlanStep(step_id, database, sql, params, depends_on)
+
+	# Kahn 拓扑排序，同时检查依赖是否存在与是否有环
+	for step in steps.values():
+		missing = [dep for dep in step.depends_on if dep not in steps or dep == step.id]
+		if missing:
+			raise ValueError(f"步骤 {step.id} 依赖的步骤不存在: {missing}")
+	ordered: List[PlanStep] = []
+	done = set()
+	pending = list(steps.values())
+	while pending:
+		ready = [step for step in pending if all(dep in done for dep in step.depends_on)]
+		if not ready:
+			raise ValueError("执行计划中存在循环依赖")
+		ordered.extend(ready)
+		done.update(step.id for step in ready)
+		pending = [step for step in pending if step.id not in done]
+	return QueryPlan(tuple(ordered))
+
+
+def bound_values(fetched: FetchResult, column: str) -> List[Any]:
+	"""上游结果某一列去重后的非空值，作为下游的绑定参数"""
+	lowered = [c.lower() for c in fetched.columns]
+	if column.lower() not in lowered:
+		raise ValueError(f"上游结果中没有列 {column}，可用列：{fetched.columns}")
+	index = lowered.index(column.lower())
+	return list(dict.fromkeys(row[index] for row in fetched.rows if row[index] is not None))
+
+
+class QueryPlanner:
+	"""多步查询规划与执行
+
+	计划按 (归一化问题, 各库角色, 各库表结构版本) 缓存，所有步骤都成功的计划才写入缓存；
+	重复的问题直接复用计划，不再调用规划模型。
+	"""
+
+	def __init__(self, tools: Sequence[BaseExpertTool], cache_size: int = 256, ttl: float = 3600.0, max_steps: int = 6):
+		self.tools = {tool.database_key: tool for tool in tools}
+		self.max_steps = max_steps
+		self._plans = TTLCache(max_entries=cache_size, ttl=ttl)
+
+	def _key(self, question: str, roles: Dict[str, str]) -> tuple:
+		return (
+			normalize_question(question),
+			tuple(sorted((database, role.strip().lower()) for database, role in roles.items())),
+			tuple(schema_registry.version(database) for database in sorted(self.tools))
+		)
+
+	async def generate(self, question: str, roles: Dict[str, str], cloud_model: str = None) -> QueryPlan:
+		"""由云端模型根据各库（按角色与问题裁剪后）的表结构生成计划"""
+		schemas = "\n\n".join(
+			schema_linker.link(schema_registry.snapshot(database), roles[database], question).text
+			for database in self.tools
+		)
+		prompt = PLAN_PROMPT.format(
+			schemas=schemas, question=question, databases=" 或 ".join(self.tools), max_steps=self.max_steps
+		)
+		messages = [
+			{"role": "system", "content": "你是多步查询规划助手，只输出符合要求的 JSON。"},
+			{"role": "user", "content": prompt}
+		]
+		response = await cloud_client.achat_completion(messages, cloud_model)
+		start, end = response.find("{"), response.rfind("}")
+		if start < 0 or end < start:
+			raise ValueError("模型没有返回执行计划")
+		return parse_query_plan(json.loads(response[start:end + 1]), list(self.tools), self.max_steps)
+
+	async def execute(self, plan: QueryPlan, roles: Dict[str, str], timeout: float) -> Dict[str, StepResult]:
+		"""按依赖关系执行：每个步骤等待其上游完成后立即开始，互不依赖的步骤在线程池中并发执行；上游失败的步骤跳过"""
+		results: Dict[str, StepResult] = {}
+		tasks: Dict[str, "asyncio.Task"] = {}
+
+		async def run_step(step: PlanStep) -> None:
+			if step.depends_on:
+				await asyncio.gather(*(tasks[dep] for dep in step.depends_on))
+			failed = [dep for dep in step.depends_on if results[dep].error is not None]
+			if failed:
+				results[step.id] = StepResult(step, None, f"依赖的步骤失败: {', '.join(failed)}", 0.0)
+				return
+			started = time.perf_counter()
+			try:
+				params = {name: bound_values(results[source].fetched, column) for name, (source, column) in step.params.items()}
+				fetched = await asyncio.wait_for(
+					run_in_threadpool(self.tools[step.database].execute, step.sql, params, roles[step.database]),
+					timeout=timeout
+				)
+				# 上游结果被截断时，本步骤的输入不完整
+				if any(results[dep].fetched.truncated for dep in step.depends_on):
+					fetched = fetched._replace(truncated=True)
+				results[step.id] = StepResult(step, fetched, None, time.perf_counter() - started)
+			except asyncio.TimeoutError:
+				results[step.id] = StepResult(step, None, f"执行超时（{timeout:g} 秒）", time.perf_counter() - started)
+			except Exception as e:
+				results[step.id] = StepResult(step, None, str(e), time.perf_counter() - started)
+
+		for step in plan.steps:
+			tasks[step.id] = asyncio.ensure_future(run_step(step))
+		await asyncio.gather(*tasks.values())
+		return results
+
+	async def run(
+		self, question: str, roles: Dict[str, str], cloud_model: str = None, timeout: float = 60.0
+	) -> Tuple[QueryPlan, Dict[str, StepResult], bool]:
+		"""取缓存的计划或生成新计划并执行，返回 (计划, 各步骤结果, 是否命中计划缓存)"""
+		key = self._key(question, roles)
+		plan = self._plans.get(key)
+		cached = plan is not None
+		if plan is None:
+			plan = await self.generate(question, roles, cloud_model)
+		results = await self.execute(plan, roles, timeout)
+		if not cached and all(result.error is None for result in results.values()):
+			self._plans.set(key, plan)
+		return plan, results, cached
+
+	def clear(self) -> int:
+		return self._plans.clear()
+
+	def stats(self) -> Dict[str, Any]:
+		return self._plans.stats()
+
+
+# 全局实例
+query_planner = QueryPlanner(expert_tools, settings.plan_cache_size, settings.plan_cache_ttl, settings.plan_max_steps)
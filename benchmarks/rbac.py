@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+RBAC 权限校验微基准测试
+比较原实现（逐角色模糊匹配 + 每次正则提取表名、逐列 re.search）与预编译策略引擎（未命中/命中判定缓存）的单次耗时
+
+用法: python benchmarks/rbac.py [--iterations 20000]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.security.rbac import ROLE_TABLE_PERMS, PolicyEngine
+
+SAMPLE_SQL = [
+    "SELECT doctor_name, department FROM doctors;",
+    "SELECT p.name, i.quantity FROM products p JOIN inventory i ON p.product_id = i.product_id WHERE i.quantity < 10;",
+    "SELECT product_id, quantity FROM inventory;",
+    "SELECT name, price FROM products ORDER BY price DESC LIMIT 5;",
+    "SELECT COUNT(*) FROM patients;",
+    "SELECT d.doctor_name FROM doctors d WHERE d.doctor_id IN (SELECT doctor_id FROM medical_records WHERE diagnosis LIKE '%flu%');",
+    "SELECT s.shipment_id, l.location_name FROM shipments s JOIN locations l ON s.location_id = l.location_id;",
+]
+ROLES = ["doctor", "patient", "Manager", "Operator", "admin", "test_user", "主治医师"]
+# 各角色所在库的方言：医疗库为 MySQL，仓储库为 PostgreSQL
+DIALECTS = {"Manager": "postgresql", "Operator": "postgresql"}
+# 绕过尝试：(SQL, 角色, 方言, 是否应允许)；方言为 None 时按两种方言解析
+BYPASS_CASES = [
+    ("SELECT /*!50000 price */ FROM products", "Operator", "mysql", False),
+    ("SELECT /*! price */ FROM products", "Operator", "mysql", False),
+    ("SELECT product_id FROM products /*!50000 WHERE price > 1 */", "Operator", "mysql", False),
+    ("WITH price AS (SELECT 1) SELECT price FROM products", "Operator", None, False),
+    ("SELECT * FROM (medical_records)", "patient", None, False),
+    ("SELECT * FROM ((medical_records))", "patient", None, False),
+    ("SELECT * FROM (doctors JOIN medical_records ON doctors.doctor_id = medical_records.doctor_id)", "patient", None, False),
+    ("SELECT * FROM (doctors JOIN medical_records ON doctors.doctor_id = medical_records.doctor_id)", "doctor", None, True),
+    ("SELECT * FROM (doctors), medical_records", "patient", None, False),
+    ("SELECT d.doctor_name FROM (SELECT doctor_name FROM doctors) AS d", "patient", None, True),
+    ("SELECT x.doctor_id FROM (SELECT doctor_id FROM medical_records) x", "patient", None, False),
+    ("WITH d AS (SELECT doctor_name FROM doctors) SELECT doctor_name FROM d", "patient", None, True),
+    ("SELECT product_id FROM products WHERE note = '/*! price */'", "Operator", None, True),
+    # CTE 与真实表同名：定义中的引用指向真实表；先于 CTE 定义或在其作用域外的引用同样指向真实表
+    ("WITH warehouse_staff AS (SELECT * FROM warehouse_staff) SELECT * FROM warehouse_staff", "Operator", "postgresql", False),
+    ("WITH warehouse_staff AS (SELECT * FROM warehouse_staff) SELECT * FROM warehouse_staff", "Operator", "mysql", False),
+    ("WITH x AS (SELECT * FROM warehouse_staff), warehouse_staff AS (SELECT 1) SELECT * FROM x", "Operator", None, False),
+    ("SELECT * FROM warehouse_staff WHERE 1 IN (WITH warehouse_staff AS (SELECT 1) SELECT 1 FROM warehouse_staff)", "Operator", None, False),
+    ('WITH "WAREHOUSE_STAFF" AS (SELECT 1) SELECT * FROM warehouse_staff', "Operator", "postgresql", False),
+    ("WITH products AS (SELECT product_id FROM inventory) SELECT product_id FROM products", "Operator", None, True),
+    # 方言相关的词法：反斜杠转义、# 注释、美元符号字符串、双引号、-- 注释的写法
+    ("SELECT 'a\\' , staff_name FROM warehouse_staff --'", "Operator", "postgresql", False),
+    ("SELECT 'a\\' , staff_name FROM warehouse_staff --'", "Operator", "mysql", False),
+    ("SELECT 'a\\' , staff_name FROM warehouse_staff --'", "Operator", None, False),
+    ("SELECT 1 # 1, staff_name FROM warehouse_staff", "Operator", "postgresql", False),
+    ("SELECT 1 # 1, staff_name FROM warehouse_staff", "Operator", None, False),
+    ("SELECT $x$ ' $x$, staff_name FROM warehouse_staff -- '", "Operator", "postgresql", False),
+    ("SELECT $x$ ' $x$, staff_name FROM warehouse_staff -- '", "Operator", None, False),
+    ("SELECT $A$ $a$ ' $A$, staff_name FROM warehouse_staff -- '", "Operator", "postgresql", False),
+    ("SELECT E'\\' ' , staff_name FROM warehouse_staff --'", "Operator", "postgresql", False),
+    ('SELECT "a\\" FROM products", staff_name FROM warehouse_staff', "Operator", "mysql", False),
+    ('SELECT "a\\" FROM products", staff_name FROM warehouse_staff', "Operator", None, False),
+    ("SELECT 1 --1, staff_name FROM warehouse_staff", "Operator", "mysql", False),
+    ("SELECT 1 --x\r, staff_name FROM warehouse_staff", "Operator", "postgresql", False),
+    ("SELECT 1 /* /* */ ' */ , staff_name FROM warehouse_staff -- '", "Operator", "postgresql", False),
+    ("SELECT a[(SELECT staff_name FROM warehouse_staff LIMIT 1)] FROM products", "Operator", "postgresql", False),
+    ("SELECT * FROM public . warehouse_staff", "Operator", None, False),
+    ("SELECT 'a\\' , price FROM products --'", "Operator", "postgresql", False),
+    ("SELECT 1 # 1, price FROM products", "Operator", "postgresql", False),
+    ("SELECT $x$ ' $x$, price FROM products -- '", "Operator", "postgresql", False),
+    ('SELECT "a\\" FROM products", price FROM products', "Operator", "mysql", False),
+    ("SELECT product_id FROM products WHERE name = 'it''s'", "Operator", None, True),
+    ("SELECT product_id FROM products -- price", "Operator", None, True),
+    ("SELECT product_id FROM products WHERE name = $$ price $$", "Operator", "postgresql", True),
+    # 未闭合的引号或注释无法确定如何解析，直接拒绝
+    ("SELECT product_id FROM products WHERE name = 'x", "Operator", None, False),
+    ("SELECT product_id FROM products /* price", "Operator", None, False),
+]
+
+
+def naive_check(sql, role, dialect=None):
+    """原实现"""
+    role = role.strip()
+    perms = None
+    for role_key, role_perms in ROLE_TABLE_PERMS.items():
+        if role_key.lower() == role.lower() or role.lower() in role_key.lower():
+            perms = role_perms
+            break
+    if not perms:
+        return False
+    tables = {m.lower() for m in re.findall(r"(?:from|join)\s+([a-zA-Z_][\w]*)", sql, flags=re.IGNORECASE)}
+    allow_tables = perms["allow_tables"]
+    for table in tables:
+        if allow_tables != ["*"] and table not in allow_tables:
+            return False
+    for col in perms.get("deny_columns", []):
+        if re.search(rf"\b{re.escape(col.lower())}\b", sql, flags=re.IGNORECASE):
+            return False
+    return True
+
+
+def bench(name, func, cases, iterations, repeat=5):
+    """取 repeat 轮中最快的一轮，减少机器负载波动的影响"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(iterations):
+            func(*cases[i % len(cases)])
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<24} {best / iterations * 1e6:10.2f} µs/次")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RBAC 权限校验微基准测试")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    # 同一条 SQL 依次由各角色（同方言的相邻）校验，解析结果跨角色复用；parse_cases 每次都是另一条 SQL
+    roles = sorted(ROLES, key=lambda role: DIALECTS.get(role, "mysql"))
+    cases = [(sql, role, DIALECTS.get(role, "mysql")) for sql in SAMPLE_SQL for role in roles]
+    parse_cases = [(sql, role, DIALECTS.get(role, "mysql")) for role in ROLES for sql in SAMPLE_SQL]
+    engine = PolicyEngine(ROLE_TABLE_PERMS)
+
+    # 样例 SQL 上两种实现的判定应一致
+    for sql, role, dialect in cases:
+        assert naive_check(sql, role) == engine.check(sql, role, dialect)[0], f"判定不一致: {role} {sql}"
+    for sql, role, dialect, expected in BYPASS_CASES:
+        assert engine.check(sql, role, dialect)[0] == expected, f"绕过检查失败: {role} {dialect} {sql}"
+
+    naive = bench("原实现", naive_check, cases, args.iterations)
+    # 容量为 1 的缓存：cases 上判定总是未命中、解析结果由同一 SQL 的下一个角色复用；parse_cases 上每次都要解析 SQL
+    uncached = bench("引擎（判定未缓存）", PolicyEngine(ROLE_TABLE_PERMS, cache_size=1).check, cases, args.iterations)
+    parsed = bench("引擎（每次解析）", PolicyEngine(ROLE_TABLE_PERMS, cache_size=1).check, parse_cases, args.iterations)
+    cached = bench("引擎（命中缓存）", engine.check, cases, args.iterations)
+    print(
+        f"\n加速比: 判定未缓存 {naive / uncached:.1f}x，每次解析 {naive / parsed:.1f}x，命中缓存 {naive / cached:.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+路由匹配微基准测试
+比较逐集合子串扫描（any(k in q for k in ...)）与 Aho-Corasick 自动机在大关键词量下的单问题耗时
+
+用法: python benchmarks/router.py [--keywords 10000] [--questions 2000]
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.llm.keyword_matcher import KeywordMatcher
+from app.llm.router import DEFAULT_KEYWORDS
+
+SAMPLE_QUESTIONS = [
+    "查询所有医生的信息",
+    "仓库里还有多少库存",
+    "今天北京的天气怎么样",
+    "介绍一下你自己",
+    "列出 inventory 表中数量小于 10 的 products",
+    "哪个科室的病人最多",
+    "最近一周的出入库记录",
+    "what is the weather like tomorrow",
+]
+
+
+def make_keyword_sets(total, seed=42):
+    """在默认关键词之外生成随机关键词，均分到各集合"""
+    rng = random.Random(seed)
+    alphabet = string.ascii_lowercase + "库存医生病人商品查询记录天气温度"
+    keyword_sets = {label: list(keywords) for label, keywords in DEFAULT_KEYWORDS.items()}
+    labels = list(keyword_sets)
+    extra = total - sum(len(v) for v in keyword_sets.values())
+    for i in range(max(0, extra)):
+        keyword = "".join(rng.choice(alphabet) for _ in range(rng.randint(3, 8)))
+        keyword_sets[labels[i % len(labels)]].append(keyword)
+    return keyword_sets
+
+
+def naive_route(keyword_sets, question):
+    """原实现：每个集合分别做子串扫描"""
+    q = question.lower().strip()
+    matches = {}
+    for label, keywords in keyword_sets.items():
+        hit = [k for k in keywords if k in q]
+        if hit:
+            matches[label] = hit
+    return matches
+
+
+def bench(name, func, questions):
+    start = time.perf_counter()
+    for q in questions:
+        func(q)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<14} {elapsed / len(questions) * 1e6:10.2f} µs/问题")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="路由匹配微基准测试")
+    parser.add_argument("--keywords", type=int, default=10000)
+    parser.add_argument("--questions", type=int, default=2000)
+    args = parser.parse_args()
+
+    keyword_sets = make_keyword_sets(args.keywords)
+    questions = [SAMPLE_QUESTIONS[i % len(SAMPLE_QUESTIONS)] for i in range(args.questions)]
+
+    start = time.perf_counter()
+    matcher = KeywordMatcher(keyword_sets)
+    build = time.perf_counter() - start
+    print(f"关键词 {matcher.keyword_count} 个，自动机状态 {matcher.state_count} 个，构建耗时 {build * 1000:.1f} ms\n")
+
+    # 两种实现的命中结果应一致（按集合比较命中的关键词集合）
+    for q in SAMPLE_QUESTIONS:
+        expected = {k: set(v) for k, v in naive_route(keyword_sets, q).items()}
+        actual = {k: set(v) for k, v in matcher.find(q.strip()).items()}
+        assert expected == actual, f"结果不一致: {q}"
+
+    naive = bench("子串扫描", lambda q: naive_route(keyword_sets, q), questions)
+    compiled = bench("Aho-Corasick", matcher.find, questions)
+    print(f"\n加速比: {naive / compiled:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
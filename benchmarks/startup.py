@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+启动耗时基准测试
+测量从启动 uvicorn 进程到首个响应（serving）以及本地模型预热完成（warm）的耗时
+
+用法: python benchmarks/startup.py [--runs 3] [--port 8765] [--warm-timeout 300]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_once(port, warm_timeout):
+    """启动一次服务，返回 (首个响应耗时, 本地模型就绪耗时或 None, 本地模型状态)"""
+    url = f"http://127.0.0.1:{port}/api/ready"
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    first_response = None
+    warm = None
+    state = "unknown"
+    try:
+        while time.perf_counter() - start < warm_timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f"服务进程已退出，返回码 {proc.returncode}")
+            try:
+                data = requests.get(url, timeout=1).json()
+            except requests.RequestException:
+                time.sleep(0.01)
+                continue
+            if first_response is None:
+                first_response = time.perf_counter() - start
+            state = data["local_model"]["state"]
+            if data["status"] == "warm":
+                warm = time.perf_counter() - start
+                break
+            if state == "failed":
+                break
+            time.sleep(0.05)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return first_response, warm, state
+
+
+def summarize(name, values):
+    values = [v for v in values if v is not None]
+    if not values:
+        print(f"{name:<12} 无数据")
+        return
+    print(f"{name:<12} 中位数 {statistics.median(values):.3f}s  最小 {min(values):.3f}s  最大 {max(values):.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量服务启动到首个响应的耗时")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--warm-timeout", type=float, default=300.0)
+    args = parser.parse_args()
+
+    serving, warm = [], []
+    for i in range(args.runs):
+        first_response, warm_at, state = measure_once(args.port, args.warm_timeout)
+        serving.append(first_response)
+        warm.append(warm_at)
+        warm_text = f"{warm_at:.3f}s" if warm_at is not None else f"未就绪 ({state})"
+        print(f"第 {i + 1} 次: 首个响应 {first_response:.3f}s, 本地模型就绪 {warm_text}")
+
+    print()
+    summarize("serving", serving)
+    summarize("warm", warm)
+
+
+if __name__ == "__main__":
+    main()
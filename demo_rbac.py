@@ -9,6 +9,8 @@ import json
 import time
 
 BASE_URL = "http://localhost:8000"
+# 目标数据库记在会话 cookie 中，切换数据库与后续请求需使用同一会话
+session = requests.Session()
 
 def demo_rbac_functionality():
     """演示RBAC功能"""
@@ -17,7 +19,7 @@ def demo_rbac_functionality():
     
     # 检查服务状态
     try:
-        health_response = requests.get(f"{BASE_URL}/health", timeout=5)
+        health_response = session.get(f"{BASE_URL}/health", timeout=5)
         if health_response.status_code != 200:
             print("❌ 服务未运行，请先启动服务：python -m app.main")
             return
@@ -32,7 +34,7 @@ def demo_rbac_functionality():
     
     # 切换到仓储数据库
     try:
-        requests.post(f"{BASE_URL}/api/switch_db", json={"database": "warehouse"})
+        session.post(f"{BASE_URL}/api/switch_db", json={"target": "warehouse"})
         print("✅ 已切换到仓储数据库")
     except:
         print("❌ 数据库切换失败")
@@ -41,7 +43,7 @@ def demo_rbac_functionality():
     # 测试仓库操作员查询库存（应该成功）
     print("\n🔍 测试：仓库操作员查询库存信息")
     try:
-        response = requests.post(f"{BASE_URL}/api/chat", json={
+        response = session.post(f"{BASE_URL}/api/chat", json={
             "user_id": "S1002",
             "role": "Operator",
             "question": "查询所有商品的库存数量",
@@ -63,7 +65,7 @@ def demo_rbac_functionality():
     # 测试仓库操作员查询价格（应该失败）
     print("\n🔍 测试：仓库操作员查询商品价格")
     try:
-        response = requests.post(f"{BASE_URL}/api/chat", json={
+        response = session.post(f"{BASE_URL}/api/chat", json={
             "user_id": "S1002",
             "role": "Operator",
             "question": "查询所有商品的价格信息",
@@ -89,7 +91,7 @@ def demo_rbac_functionality():
     # 测试仓库经理查询价格（应该成功）
     print("\n🔍 测试：仓库经理查询商品价格")
     try:
-        response = requests.post(f"{BASE_URL}/api/chat", json={
+        response = session.post(f"{BASE_URL}/api/chat", json={
             "user_id": "S1001",
             "role": "Manager",
             "question": "查询所有商品的价格信息",
@@ -114,7 +116,7 @@ def demo_rbac_functionality():
     
     # 切换到医疗数据库
     try:
-        requests.post(f"{BASE_URL}/api/switch_db", json={"database": "hospital"})
+        session.post(f"{BASE_URL}/api/switch_db", json={"target": "hospital"})
         print("✅ 已切换到医疗数据库")
     except:
         print("❌ 数据库切换失败")
@@ -123,7 +125,7 @@ def demo_rbac_functionality():
     # 测试医生查询病人信息（应该成功）
     print("\n🔍 测试：医生查询病人信息")
     try:
-        response = requests.post(f"{BASE_URL}/api/chat", json={
+        response = session.post(f"{BASE_URL}/api/chat", json={
             "user_id": "D101",
             "role": "doctor",
             "question": "查询所有病人信息",
@@ -145,7 +147,7 @@ def demo_rbac_functionality():
     # 测试医生查询仓库信息（应该失败）
     print("\n🔍 测试：医生查询仓库信息（跨数据库）")
     try:
-        response = requests.post(f"{BASE_URL}/api/chat", json={
+        response = session.post(f"{BASE_URL}/api/chat", json={
             "user_id": "D101",
             "role": "doctor",
             "question": "查询仓库库存信息",
@@ -273,7 +273,7 @@ async function switchDatabase(target) {
     }
 }
 
-// 发送消息
+// 发送消息（流式接口：逐阶段显示进度，答案逐字渲染）
 async function sendMessage() {
     const question = questionInput.value.trim();
     if (!question) return;
@@ -287,10 +287,18 @@ async function sendMessage() {
     // 禁用发送按钮
     sendBtn.disabled = true;
     
+    // 先创建空的助手消息，收到答案片段后逐步填充
+    const messageDiv = addMessage('', 'assistant');
+    const messageContent = messageDiv.querySelector('.message-content');
+    const stageDiv = document.createElement('div');
+    stageDiv.className = 'message-meta';
+    stageDiv.textContent = '🧭 正在分析问题...';
+    messageDiv.appendChild(stageDiv);
+    
     try {
         showLoading(true);
         
-        const response = await fetch('/api/chat', {
+        const response = await fetch('/api/chat/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -303,15 +311,32 @@ async function sendMessage() {
             })
         });
 
-        if (response.ok) {
-            const result = await response.json();
-            addMessage(result.answer, 'assistant', result.meta);
-        } else {
+        if (!response.ok || !response.body) {
             const errorData = await response.json();
-            addMessage('抱歉，处理您的请求时出现错误: ' + errorData.detail, 'assistant', { error: true });
+            throw new Error(errorData.detail || '请求失败');
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder('utf-8');
+        let buffer = '';
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            
+            // SSE 事件以空行分隔
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                handleStreamEvent(parseSSE(rawEvent), messageDiv, messageContent, stageDiv);
+            }
         }
     } catch (error) {
-        addMessage('网络错误，请检查连接后重试', 'assistant', { error: true });
+        stageDiv.remove();
+        messageContent.textContent = '抱歉，处理您的请求时出现错误: ' + error.message;
+        renderMeta(messageDiv, { error: true });
     } finally {
         showLoading(false);
         sendBtn.disabled = false;
@@ -319,6 +344,43 @@ async function sendMessage() {
     }
 }
 
+// 解析一条 SSE 事件
+function parseSSE(rawEvent) {
+    let event = 'message';
+    let data = '';
+    rawEvent.split('\n').forEach(line => {
+        if (line.startsWith('event:')) {
+            event = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+            data += line.slice(5).trim();
+        }
+    });
+    return { event: event, data: data ? JSON.parse(data) : {} };
+}
+
+// 处理流式事件
+function handleStreamEvent({ event, data }, messageDiv, messageContent, stageDiv) {
+    if (event === 'route') {
+        stageDiv.textContent = data.path === 'text_to_sql' ? '🧭 正在生成 SQL...' : '🧭 正在生成答案...';
+    } else if (event === 'sql') {
+        stageDiv.textContent = `🔍 已生成 SQL${data.sql_cache === 'hit' ? '（缓存）' : ''}，正在校验权限...`;
+    } else if (event === 'rbac') {
+        stageDiv.textContent = data.permission ? '🔐 权限校验通过，正在查询...' : '🔐 权限不足';
+    } else if (event === 'rows') {
+        stageDiv.textContent = `📊 查询到 ${data.count} 条记录${data.truncated ? '（已截断）' : ''}，正在生成答案...`;
+    } else if (event === 'token') {
+        messageContent.textContent += data.text;
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+    } else if (event === 'done') {
+        stageDiv.remove();
+        renderMeta(messageDiv, data);
+    } else if (event === 'error') {
+        stageDiv.remove();
+        messageContent.textContent = '抱歉，处理您的请求时出现错误: ' + data.detail;
+        renderMeta(messageDiv, { error: true });
+    }
+}
+
 // 添加消息到聊天区域
 function addMessage(content, type, meta = {}) {
     const messageDiv = document.createElement('div');
@@ -331,6 +393,17 @@ function addMessage(content, type, meta = {}) {
     messageDiv.appendChild(messageContent);
     
     // 添加元数据
+    renderMeta(messageDiv, meta);
+    
+    chatMessages.appendChild(messageDiv);
+    
+    // 滚动到底部
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+    return messageDiv;
+}
+
+// 渲染消息元数据
+function renderMeta(messageDiv, meta) {
     if (meta && Object.keys(meta).length > 0) {
         const metaDiv = document.createElement('div');
         metaDiv.className = 'message-meta';
@@ -342,7 +415,7 @@ function addMessage(content, type, meta = {}) {
                 <strong>🔍 查询信息</strong><br>
                 SQL: <code>${meta.sql}</code><br>
                 角色: ${meta.role} | 数据库: ${meta.database}<br>
-                结果数量: ${meta.result_count || 0}
+                结果数量: ${meta.result_count || 0}${meta.truncated ? '（已截断）' : ''}
             `;
         } else if (meta.tool) {
             metaDiv.innerHTML = `<strong>🌤️ 天气工具</strong> | 数据源: ${meta.data_source}`;
@@ -352,11 +425,6 @@ function addMessage(content, type, meta = {}) {
         
         messageDiv.appendChild(metaDiv);
     }
-    
-    chatMessages.appendChild(messageDiv);
-    
-    // 滚动到底部
-    chatMessages.scrollTop = chatMessages.scrollHeight;
 }
 
 // 测试数据库连接
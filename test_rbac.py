@@ -7,6 +7,8 @@ import requests
 import json
 
 BASE_URL = "http://localhost:8000"
+# 目标数据库记在会话 cookie 中，切换数据库与后续请求需使用同一会话
+session = requests.Session()
 
 def test_rbac():
     """测试RBAC功能"""
@@ -17,8 +19,8 @@ def test_rbac():
     
     # 1. 切换到仓储数据库
     try:
-        db_response = requests.post(f"{BASE_URL}/api/switch_db", 
-                                  json={"database": "warehouse"}, timeout=10)
+        db_response = session.post(f"{BASE_URL}/api/switch_db", 
+                                 json={"target": "warehouse"}, timeout=10)
         if db_response.status_code != 200:
             print("❌ 数据库切换失败")
             return
@@ -30,7 +32,7 @@ def test_rbac():
     # 2. 测试仓库操作员查询库存(应该成功)
     print("\n🔍 测试1: 查询库存信息(应该成功)")
     try:
-        response = requests.post(f"{BASE_URL}/api/chat", json={
+        response = session.post(f"{BASE_URL}/api/chat", json={
             "user_id": "S1002",
             "role": "Operator", 
             "question": "查询所有商品的库存数量",
@@ -53,7 +55,7 @@ def test_rbac():
     # 3. 测试仓库操作员查询价格(应该失败)
     print("\n🔍 测试2: 查询商品价格(应该失败)")
     try:
-        response = requests.post(f"{BASE_URL}/api/chat", json={
+        response = session.post(f"{BASE_URL}/api/chat", json={
             "user_id": "S1002",
             "role": "Operator",
             "question": "查询所有商品的价格信息", 
@@ -75,7 +77,7 @@ def test_rbac():
     # 4. 测试仓库经理权限
     print("\n🔍 测试3: 仓库经理查询价格(应该成功)")
     try:
-        response = requests.post(f"{BASE_URL}/api/chat", json={
+        response = session.post(f"{BASE_URL}/api/chat", json={
             "user_id": "S1001",
             "role": "Manager",
             "question": "查询所有商品的价格信息",
@@ -101,7 +103,7 @@ if __name__ == "__main__":
     
     # 检查服务状态
     try:
-        health_response = requests.get(f"{BASE_URL}/health", timeout=5)
+        health_response = session.get(f"{BASE_URL}/health", timeout=5)
         if health_response.status_code == 200:
             print("✅ 服务运行正常")
             test_rbac()